@@ -5,7 +5,7 @@ from setuptools import setup, Extension
 from smbpi.version import __version__
 
 dpmem_direct_ext = Extension('smbpi.dpmem_direct_ext',
-                             sources = ['smbpi/dpmem_direct_ext.c'],
+                             sources = ['smbpi/dpmem_direct_ext.c', 'smbpi/c_gpio.c'],
                              libraries = ['wiringPi'])
 
 wd37c65_direct_ext = Extension('smbpi.wd37c65_direct_ext',
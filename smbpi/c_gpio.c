@@ -48,6 +48,35 @@ void myGpioInit(void)
     gpio = (volatile uint32_t *)gpio_map;
 }
 
+/* Map the GPIO registers through /dev/gpiomem, which needs neither root nor
+ * the peripheral base address, so it works on any pi. Returns NULL with
+ * errno set instead of exiting, for use from python extensions.
+ */
+volatile uint32_t *myGpioMap(void)
+{
+    int fd;
+    void *map;
+
+    if (gpio != NULL) {
+        return gpio;
+    }
+
+    fd = open("/dev/gpiomem", O_RDWR|O_SYNC);
+    if (fd == -1) {
+        return NULL;
+    }
+
+    map = mmap(NULL, BLOCK_SIZE, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED) {
+        return NULL;
+    }
+
+    gpio_map = map;
+    gpio = (volatile uint32_t *)gpio_map;
+    return gpio;
+}
+
 unsigned int myDigitalRead(unsigned int pin)
 {
   return GPIO_LEV(pin);
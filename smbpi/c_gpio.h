@@ -1,5 +1,8 @@
+#include <stdint.h>
+
 void myGpioInit(void);
 unsigned int myDigitalRead(unsigned int pin);
 void myDigitalWrite(unsigned int pin, unsigned int val);
 void myPinModeInput(unsigned int pin);
 void myPinModeOutput(unsigned int pin);
+volatile uint32_t *myGpioMap(void);
@@ -10,7 +10,7 @@ WPI_IN = 0
 WPI_OUT = 1
 
 class DualPortMemory():
-  def __init__(self, n_address_bits=10, enable_reset=True, support_read=True):
+  def __init__(self, n_address_bits=10, enable_reset=True, support_read=True, registers=True):
       self.n_address_bits = n_address_bits
       self.support_read = support_read
 
@@ -38,12 +38,25 @@ class DualPortMemory():
           wiringpi.pinMode(ISA_RESET, WPI_OUT)
           wiringpi.digitalWrite(ISA_RESET, 0)
 
+      # the pins are set up; from here on the extension can drive them
+      # through the GPIO registers, if we're allowed to map them
+      self.registers = False
+      if registers:
+          try:
+              dpmem_direct_ext.enable_registers()
+              self.registers = True
+          except OSError, e:
+              print >> sys.stderr, "dpmem: using wiringPi,", e
+
   def read(self, addr):
       return dpmem_direct_ext.read_byte(addr, self.n_address_bits)
 
   def read_block(self, addr, count):
       return dpmem_direct_ext.read_block(addr, self.n_address_bits, count)
 
+  def read_block_into(self, addr, buf, offset, count):
+      dpmem_direct_ext.read_block_into(addr, self.n_address_bits, buf, offset, count)
+
   def write(self, addr, val):
       dpmem_direct_ext.write_byte(addr, self.n_address_bits, val)
 
@@ -105,7 +118,12 @@ def help():
     print "waitint"
 
 def main():
-    mem = DualPortMemory()
+    registers = True
+    if "--wiringpi" in sys.argv:
+        sys.argv.remove("--wiringpi")
+        registers = False
+
+    mem = DualPortMemory(registers=registers)
 
     if sys.argv[1] == "read":
         addr = str_to_int(sys.argv[2])
@@ -145,6 +163,15 @@ def main():
         print "elapsed =", elapsed, "ops/s = ", 100.0/elapsed, "KB/s =", 100.0/elapsed*512/1024
         return
 
+    elif sys.argv[1] == "benchreadinto":
+        buf = bytearray(512)
+        t=time.time()
+        for i in range(0,100):
+            mem.read_block_into(0,buf,0,512)
+        elapsed = time.time()-t
+        print "elapsed =", elapsed, "ops/s = ", 100.0/elapsed, "KB/s =", 100.0/elapsed*512/1024
+        return
+
     elif sys.argv[1] == "benchwrite":
         controlblock = ""
         for i in range(0, 512):
@@ -1,6 +1,10 @@
 #include <Python.h>
 #include <wiringPi.h>
 #include <unistd.h>
+#include <errno.h>
+#include <string.h>
+#include <pthread.h>
+#include "c_gpio.h"
 
 #define DP_W 5
 #define DP_R 6
@@ -10,9 +14,96 @@ const int DP_ADDRPINS[] = { 13, 19, 26, 21, 20, 16, 12, 7, 8, 18 };
 const int DP_DATAPINS[] = { 24, 25, 04, 17, 27, 22, 10, 9 };
 const int DP_DATAPINS_REVERSED[] = { 9, 10, 22, 27, 17, 04, 25, 24 };
 
+/* Bus access from python runs with the GIL released so other threads are not
+ * frozen while we bang the bus. bus_lock keeps two threads off the bus at
+ * once; only take it with the GIL released, or we can deadlock.
+ */
+static pthread_mutex_t bus_lock = PTHREAD_MUTEX_INITIALIZER;
+
+#define BUS_BEGIN Py_BEGIN_ALLOW_THREADS pthread_mutex_lock(&bus_lock);
+#define BUS_END pthread_mutex_unlock(&bus_lock); Py_END_ALLOW_THREADS
+
+/* Register backend. Once enable_registers() has mapped the GPIO block, the
+ * pins are driven through the BCM GPSET0/GPCLR0/GPLEV0 registers instead of
+ * one wiringPi call per pin. Every address and data value has its set and
+ * clear masks worked out in advance, so putting an address or a byte on the
+ * bus is two register writes, and reading the data pins is one GPLEV0 read
+ * gathered back into a byte a register byte at a time.
+ */
+#define GPFSEL0 0
+#define GPSET0 7
+#define GPCLR0 10
+#define GPLEV0 13
+
+static volatile uint32_t *regs = NULL;
+
+static uint32_t addr_set[1024], addr_clr[1024];
+static uint32_t addr_pins[11];         /* pins used by the low n address bits */
+static uint32_t data_set[256], data_clr[256];
+static unsigned char data_gather[4][256]; /* GPLEV0 byte -> its data bits */
+static uint32_t fsel_mask[3], fsel_out[3];  /* GPFSEL0-2 bits for the data pins */
+
+static void dpmem_build_tables(void)
+{
+  int i, bit;
+
+  for (i=0; i<1024; i++) {
+    addr_set[i] = 0;
+    addr_clr[i] = 0;
+    for (bit=0; bit<10; bit++) {
+      if (i & (1<<bit)) {
+        addr_set[i] |= 1 << DP_ADDRPINS[bit];
+      } else {
+        addr_clr[i] |= 1 << DP_ADDRPINS[bit];
+      }
+    }
+  }
+
+  addr_pins[0] = 0;
+  for (bit=0; bit<10; bit++) {
+    addr_pins[bit+1] = addr_pins[bit] | (1 << DP_ADDRPINS[bit]);
+  }
+
+  memset(data_gather, 0, sizeof(data_gather));
+  for (i=0; i<256; i++) {
+    data_set[i] = 0;
+    data_clr[i] = 0;
+    for (bit=0; bit<8; bit++) {
+      if (i & (1<<bit)) {
+        data_set[i] |= 1 << DP_DATAPINS[bit];
+      } else {
+        data_clr[i] |= 1 << DP_DATAPINS[bit];
+      }
+    }
+  }
+  for (bit=0; bit<8; bit++) {
+    int pin = DP_DATAPINS[bit];
+    for (i=0; i<256; i++) {
+      if (i & (1 << (pin % 8))) {
+        data_gather[pin / 8][i] |= 1 << bit;
+      }
+    }
+  }
+
+  /* all of the data pins are below 30, so they live in GPFSEL0-2 */
+  memset(fsel_mask, 0, sizeof(fsel_mask));
+  memset(fsel_out, 0, sizeof(fsel_out));
+  for (bit=0; bit<8; bit++) {
+    int pin = DP_DATAPINS[bit];
+    fsel_mask[pin / 10] |= 7 << ((pin % 10) * 3);
+    fsel_out[pin / 10] |= 1 << ((pin % 10) * 3);
+  }
+}
+
 void dpmem_config_input(void)
 {
   int i;
+  if (regs) {
+    for (i=0; i<3; i++) {
+      regs[GPFSEL0 + i] &= ~fsel_mask[i];
+    }
+    return;
+  }
   for (i=0; i<8; i++) {
     pinMode(DP_DATAPINS[i], INPUT);
   }
@@ -21,6 +112,12 @@ void dpmem_config_input(void)
 void dpmem_config_output(void)
 {
   int i;
+  if (regs) {
+    for (i=0; i<3; i++) {
+      regs[GPFSEL0 + i] = (regs[GPFSEL0 + i] & ~fsel_mask[i]) | fsel_out[i];
+    }
+    return;
+  }
   for (i=0; i<8; i++) {
     pinMode(DP_DATAPINS[i], OUTPUT);
   }
@@ -29,12 +126,55 @@ void dpmem_config_output(void)
 void dpmem_set_addr_nbits(unsigned int addr, unsigned int nbits)
 {
   int i;
+  if (regs) {
+    if (nbits > 10) {
+      nbits = 10;
+    }
+    addr &= (1 << nbits) - 1;
+    regs[GPSET0] = addr_set[addr];
+    regs[GPCLR0] = addr_clr[addr] & addr_pins[nbits];
+    return;
+  }
   for (i=0; i<nbits; i++) {
     digitalWrite(DP_ADDRPINS[i], addr & 0x01);
     addr = addr >> 1;
   }
 }
 
+/* Like dpmem_set_addr_nbits, but only drives the pins whose bits differ
+ * from prev, which has to be the address already on the bus. Going from
+ * one address to the next usually changes just the low bit or two.
+ */
+void dpmem_change_addr_nbits(unsigned int prev, unsigned int addr, unsigned int nbits)
+{
+  int i;
+  unsigned int changed;
+
+  if (nbits > 10) {
+    nbits = 10;
+  }
+  addr &= (1 << nbits) - 1;
+  changed = (prev ^ addr) & ((1 << nbits) - 1);
+
+  if (regs) {
+    /* addr_set of the changed bits is the mask of their pins */
+    uint32_t pins = addr_set[changed];
+    if (addr_set[addr] & pins) {
+      regs[GPSET0] = addr_set[addr] & pins;
+    }
+    if (addr_clr[addr] & pins) {
+      regs[GPCLR0] = addr_clr[addr] & pins;
+    }
+    return;
+  }
+  for (i=0; changed != 0; i++) {
+    if (changed & 0x01) {
+      digitalWrite(DP_ADDRPINS[i], (addr >> i) & 0x01);
+    }
+    changed = changed >> 1;
+  }
+}
+
 void dpmem_set_addr(unsigned int addr)
 {
   dpmem_set_addr_nbits(addr, 10);
@@ -43,6 +183,11 @@ void dpmem_set_addr(unsigned int addr)
 void dpmem_set_data(unsigned int data)
 {
   int i;
+  if (regs) {
+    regs[GPSET0] = data_set[data & 0xFF];
+    regs[GPCLR0] = data_clr[data & 0xFF];
+    return;
+  }
   for (i=0; i<8; i++) {
     digitalWrite(DP_DATAPINS[i], data & 0x01);
     data = data >> 1;
@@ -53,6 +198,11 @@ unsigned int dpmem_get_data(void)
 {
   int i;
   int data = 0;
+  if (regs) {
+    uint32_t lev = regs[GPLEV0];
+    return data_gather[0][lev & 0xFF] | data_gather[1][(lev >> 8) & 0xFF] |
+           data_gather[2][(lev >> 16) & 0xFF] | data_gather[3][lev >> 24];
+  }
   for (i=0; i<8; i++) {
     data = data << 1;
     data = data | digitalRead(DP_DATAPINS_REVERSED[i]);
@@ -60,6 +210,26 @@ unsigned int dpmem_get_data(void)
   return data;
 }
 
+/* The control pins go through here, so they take the same path as the rest */
+void dpmem_control(int pin, int value)
+{
+  if (regs) {
+    regs[value ? GPSET0 : GPCLR0] = 1 << pin;
+  } else {
+    digitalWrite(pin, value);
+  }
+}
+
+/* see the comment in dpmem_read_block */
+void dpmem_discard_read(void)
+{
+  if (regs) {
+    (void) regs[GPLEV0];
+  } else {
+    digitalRead(DP_DATAPINS_REVERSED[0]);
+  }
+}
+
 void short_delay(void)
 {
     // Just do nothing for a while. This is to allow the RAM some time to do it's work.
@@ -77,7 +247,9 @@ static PyObject *dpmem_direct_set_addr(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &i)) {  
     return NULL;    
   }
+  BUS_BEGIN
   dpmem_set_addr(i);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -87,7 +259,9 @@ static PyObject *dpmem_direct_set_addr_nbits(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "ii", &addr, &nbits)) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_set_addr_nbits(addr, nbits);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -97,16 +271,23 @@ static PyObject *dpmem_direct_set_data(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &i)) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_set_data(i);
+  BUS_END
   return Py_BuildValue("");
 }
 
 static PyObject *dpmem_direct_get_data(PyObject *self, PyObject *args)
 {
+  unsigned int data;
+
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
-  return Py_BuildValue("i", dpmem_get_data());
+  BUS_BEGIN
+  data = dpmem_get_data();
+  BUS_END
+  return Py_BuildValue("i", data);
 }
 
 static PyObject *dpmem_direct_config_input(PyObject *self, PyObject *args)
@@ -114,7 +295,9 @@ static PyObject *dpmem_direct_config_input(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_config_input();
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -123,7 +306,9 @@ static PyObject *dpmem_direct_config_output(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_config_output();
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -134,15 +319,17 @@ static PyObject *dpmem_direct_read_byte(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "ii", &addr, &nbits)) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_config_input();
   dpmem_set_addr_nbits(addr, nbits);
-  digitalWrite(DP_CE,0);
-  digitalWrite(DP_R,0);
+  dpmem_control(DP_CE, 0);
+  dpmem_control(DP_R, 0);
   // see comment in dpmem_direct_read_block. Just to be safe...
-  digitalRead(DP_DATAPINS_REVERSED[0]);
+  dpmem_discard_read();
   data = dpmem_get_data();
-  digitalWrite(DP_R,1);
-  digitalWrite(DP_CE,1);
+  dpmem_control(DP_R, 1);
+  dpmem_control(DP_CE, 1);
+  BUS_END
   return Py_BuildValue("i", data);
 }
 
@@ -152,73 +339,163 @@ static PyObject *dpmem_direct_write_byte(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "iii", &addr, &nbits, &data)) {
     return NULL;
   }
+  BUS_BEGIN
   dpmem_config_output();
   dpmem_set_addr_nbits(addr, nbits);
   dpmem_set_data(data);
-  digitalWrite(DP_CE,0);
-  digitalWrite(DP_W,0);
-  digitalWrite(DP_W,1);
-  digitalWrite(DP_CE,1);
+  dpmem_control(DP_CE, 0);
+  dpmem_control(DP_W, 0);
+  dpmem_control(DP_W, 1);
+  dpmem_control(DP_CE, 1);
+  BUS_END
   return Py_BuildValue("");
 }
 
-static PyObject *dpmem_direct_read_block(PyObject *self, PyObject *args)
+void dpmem_read_block(unsigned int addr, unsigned int nbits, char *buf, unsigned int count)
 {
-  unsigned int addr, nbits, count;
-  char buf[1024];
   int i;
 
-  if (!PyArg_ParseTuple(args, "iii", &addr, &nbits, &count)) {
-    return NULL;
-  }
-
-  if (count > 1024) {
-      // throw exception?
-      return NULL;
-  }
-
   dpmem_config_input();
 
   for (i=0; i<count; i++) {
-      dpmem_set_addr_nbits(addr + i, nbits);
-      digitalWrite(DP_CE,0);
-      digitalWrite(DP_R,0);
+      if (i == 0) {
+          dpmem_set_addr_nbits(addr, nbits);
+      } else {
+          dpmem_change_addr_nbits(addr + i - 1, addr + i, nbits);
+      }
+      dpmem_control(DP_CE, 0);
+      dpmem_control(DP_R, 0);
       // For some reason, the first bit we get will occasionally glitch. Originally I thought it was due to lack
       // of time between signaling the control pins and reading the first data bit, but injecting NOPs doesn't
       // seem to help. What does work is just throwing away the first bit and re-reading it. Go figure.
-      digitalRead(DP_DATAPINS_REVERSED[0]);
+      dpmem_discard_read();
       buf[i] = dpmem_get_data();
-      digitalWrite(DP_R,1);
-      digitalWrite(DP_CE,1);
+      dpmem_control(DP_R, 1);
+      dpmem_control(DP_CE, 1);
   }
-
-  return Py_BuildValue("s#", buf, count);
 }
 
-static PyObject *dpmem_direct_write_block(PyObject *self, PyObject *args)
+void dpmem_write_block(unsigned int addr, unsigned int nbits, const char *buf, unsigned int count)
 {
-  unsigned int addr, nbits;
-  const char *buf;
-  unsigned int buf_len, count;
   int i;
 
-  if (!PyArg_ParseTuple(args, "iis#i", &addr, &nbits, &buf, &buf_len, &count)) {
-    return NULL;
-  }
-
   dpmem_config_output();
 
   for (i=0; i<count; i++) {
-      dpmem_set_addr_nbits(addr, nbits);
+      if (i == 0) {
+          dpmem_set_addr_nbits(addr, nbits);
+      } else {
+          dpmem_change_addr_nbits(addr - 1, addr, nbits);
+      }
       dpmem_set_data(*buf);
-      digitalWrite(DP_CE,0);
-      digitalWrite(DP_W,0);
+      dpmem_control(DP_CE, 0);
+      dpmem_control(DP_W, 0);
       short_delay();
-      digitalWrite(DP_W,1);
-      digitalWrite(DP_CE,1);
+      dpmem_control(DP_W, 1);
+      dpmem_control(DP_CE, 1);
       addr++;
       buf++;
   }
+}
+
+static PyObject *dpmem_direct_read_block(PyObject *self, PyObject *args)
+{
+  unsigned int addr, nbits, count;
+  PyObject *data;
+
+  if (!PyArg_ParseTuple(args, "iii", &addr, &nbits, &count)) {
+    return NULL;
+  }
+
+  data = PyString_FromStringAndSize(NULL, count);
+  if (data == NULL) {
+    return NULL;
+  }
+
+  BUS_BEGIN
+  dpmem_read_block(addr, nbits, PyString_AS_STRING(data), count);
+  BUS_END
+
+  return data;
+}
+
+/* read_block_into(addr, nbits, buffer, offset, count)
+ *
+ * Like read_block, but fills a caller-supplied bytearray or writable
+ * memoryview instead of allocating a new string.
+ */
+static PyObject *dpmem_direct_read_block_into(PyObject *self, PyObject *args)
+{
+  unsigned int addr, nbits;
+  Py_ssize_t offset, count;
+  Py_buffer view;
+
+  if (!PyArg_ParseTuple(args, "iiw*nn", &addr, &nbits, &view, &offset, &count)) {
+    return NULL;
+  }
+
+  if ((offset < 0) || (count < 0) || (offset > view.len - count)) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "offset and count are outside the buffer");
+    return NULL;
+  }
+
+  BUS_BEGIN
+  dpmem_read_block(addr, nbits, (char *) view.buf + offset, (unsigned int) count);
+  BUS_END
+
+  PyBuffer_Release(&view);
+
+  return Py_BuildValue("");
+}
+
+static PyObject *dpmem_direct_write_block(PyObject *self, PyObject *args)
+{
+  unsigned int addr, nbits, count;
+  Py_buffer view;
+
+  if (!PyArg_ParseTuple(args, "iis*i", &addr, &nbits, &view, &count)) {
+    return NULL;
+  }
+
+  if (count > view.len) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "buffer is shorter than count");
+    return NULL;
+  }
+
+  BUS_BEGIN
+  dpmem_write_block(addr, nbits, view.buf, count);
+  BUS_END
+
+  PyBuffer_Release(&view);
+
+  return Py_BuildValue("");
+}
+
+/* enable_registers()
+ *
+ * Switch to driving the pins through the GPIO registers. Raises OSError if
+ * /dev/gpiomem can't be mapped, in which case wiringPi stays in use.
+ */
+static PyObject *dpmem_direct_enable_registers(PyObject *self, PyObject *args)
+{
+  volatile uint32_t *map;
+
+  if (!PyArg_ParseTuple(args, "")) {
+    return NULL;
+  }
+
+  map = myGpioMap();
+  if (map == NULL) {
+    return PyErr_SetFromErrnoWithFilename(PyExc_OSError, "/dev/gpiomem");
+  }
+
+  BUS_BEGIN
+  dpmem_build_tables();
+  regs = map;
+  BUS_END
+
   return Py_BuildValue("");
 }
 
@@ -232,7 +509,9 @@ static PyMethodDef dpmem_direct_methods[] = {
   {"read_byte", dpmem_direct_read_byte, METH_VARARGS, "Read byte at address"},
   {"write_byte", dpmem_direct_write_byte, METH_VARARGS, "Write byte at address"},
   {"read_block", dpmem_direct_read_block, METH_VARARGS, "Read block at address"},
+  {"read_block_into", dpmem_direct_read_block_into, METH_VARARGS, "Read block at address into a buffer"},
   {"write_block", dpmem_direct_write_block, METH_VARARGS, "Write block at address"},
+  {"enable_registers", dpmem_direct_enable_registers, METH_VARARGS, "Drive the pins through the GPIO registers instead of wiringPi"},
   {NULL, NULL, 0, NULL}
 };
 
@@ -0,0 +1,277 @@
+# FAT12 filesystem reader on top of FDC
+# Scott Baker, https://www.smbaker.com/
+#
+# Reads files off a PC floppy without imaging the whole disk. The boot
+# sector, FAT, and root directory are read once and kept until the disk is
+# changed. File data is read by resolving the cluster chain to sectors and
+# handing them to FDC.readMany, which sorts them into a few multi-sector
+# reads per track.
+#
+#     fs = FAT12(fdc)
+#     for entry in fs.listdir("/"):
+#         print(entry.name, entry.size)
+#     data = "".join(fs.readFile("/AUTOEXEC.BAT"))
+
+from __future__ import print_function
+import argparse
+import struct
+import sys
+
+from fdc import FDC
+
+ATTR_READONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+
+DIRENT_SIZE = 32
+
+class FAT12Exception(Exception):
+    pass
+
+def _splitPath(path):
+    return [x for x in path.replace("\\", "/").split("/") if x]
+
+def _shortName(name):
+    # "readme.txt" -> "README  TXT", the way it's stored in a directory entry
+    if "." in name:
+        (base, ext) = name.rsplit(".", 1)
+    else:
+        (base, ext) = (name, "")
+    return base.upper()[:8].ljust(8) + ext.upper()[:3].ljust(3)
+
+
+class DirEntry:
+    def __init__(self, raw):
+        self.rawName = raw[0:11]
+        self.attr = ord(raw[11])
+        (self.time, self.date, self.cluster, self.size) = struct.unpack("<HHHI", raw[22:32])
+
+        base = self.rawName[0:8].rstrip()
+        ext = self.rawName[8:11].rstrip()
+        if base.startswith("\x05"):
+            # 0xE5 really is the first character
+            base = "\xE5" + base[1:]
+        if ext:
+            self.name = base + "." + ext
+        else:
+            self.name = base
+
+    def isDir(self):
+        return (self.attr & ATTR_DIRECTORY) != 0
+
+    def __repr__(self):
+        return "<DirEntry %s attr=%02X cluster=%d size=%d>" % (self.name, self.attr, self.cluster, self.size)
+
+
+class FAT12:
+    def __init__(self, fdc, retries=2, batchTracks=2):
+        # batchTracks is how many tracks of a file are read before they're
+        # handed out by readFile; two is a cylinder
+        self.fdc = fdc
+        self.retries = retries
+        self.batchTracks = batchTracks
+        self.mounted = None
+
+    def mount(self):
+        # Read the boot sector, FAT, and root directory. Called as needed;
+        # only goes to the disk again after a disk change.
+        if (self.mounted is not None) and (self.mounted == self.fdc.changeCount):
+            return
+        self.mounted = None
+
+        boot = self._readSectors([0])[0]
+        (self.bytesPerSector, self.sectorsPerCluster, self.reservedSectors, self.numFATs,
+         self.rootEntries, self.totalSectors, self.mediaByte, self.sectorsPerFAT,
+         self.sectorsPerTrack, self.numHeads) = struct.unpack("<HBHBHHBHHH", boot[11:28])
+
+        if (self.bytesPerSector not in [128, 256, 512, 1024]) or (self.sectorsPerCluster == 0) or (self.numFATs == 0):
+            raise FAT12Exception("No FAT filesystem on the disk")
+        if (self.bytesPerSector != self.fdc.secSize) or (self.sectorsPerTrack != self.fdc.secCount) or \
+           (self.numHeads != self.fdc.numHead):
+            raise FAT12Exception("Filesystem geometry %d/%d/%d doesn't match the media" % \
+                                 (self.bytesPerSector, self.sectorsPerTrack, self.numHeads))
+
+        self.fatStart = self.reservedSectors
+        self.rootStart = self.fatStart + self.numFATs * self.sectorsPerFAT
+        self.rootSectors = (self.rootEntries * DIRENT_SIZE + self.bytesPerSector - 1) // self.bytesPerSector
+        self.dataStart = self.rootStart + self.rootSectors
+        self.numClusters = (self.totalSectors - self.dataStart) // self.sectorsPerCluster
+
+        # the first FAT and the root directory in one go
+        lbas = range(self.fatStart, self.fatStart + self.sectorsPerFAT) + \
+               range(self.rootStart, self.rootStart + self.rootSectors)
+        sectors = self._readSectors(lbas)
+        self.fat = "".join(sectors[:self.sectorsPerFAT])
+        self.root = self._parseDir("".join(sectors[self.sectorsPerFAT:]))
+        self.dirs = {}
+
+        self.mounted = self.fdc.changeCount
+
+    def listdir(self, path="/"):
+        self.mount()
+        return [e for e in self._dir(_splitPath(path)) if not (e.attr & ATTR_VOLUME)]
+
+    def stat(self, path):
+        self.mount()
+        parts = _splitPath(path)
+        if not parts:
+            raise FAT12Exception("The root directory has no entry")
+        want = _shortName(parts[-1])
+        for entry in self._dir(parts[:-1]):
+            if (entry.rawName == want) and not (entry.attr & ATTR_VOLUME):
+                return entry
+        raise FAT12Exception("%s not found" % path)
+
+    def readFile(self, path):
+        # Generator over the contents of the file at path, in chunks of
+        # up to batchTracks tracks.
+        entry = self.stat(path)
+        if entry.isDir():
+            raise FAT12Exception("%s is a directory" % path)
+
+        remaining = entry.size
+        for data in self._readChain(entry.cluster):
+            if remaining <= 0:
+                break
+            yield data[:remaining]
+            remaining -= len(data)
+
+        if remaining > 0:
+            raise FAT12Exception("%s is shorter on disk than its directory entry" % path)
+
+    def _dir(self, parts):
+        entries = self.root
+        walked = ""
+        for part in parts:
+            walked = walked + "/" + part.upper()
+            want = _shortName(part)
+            match = [e for e in entries if (e.rawName == want) and e.isDir()]
+            if not match:
+                raise FAT12Exception("%s is not a directory" % walked)
+            if walked not in self.dirs:
+                self.dirs[walked] = self._parseDir("".join(self._readChain(match[0].cluster)))
+            entries = self.dirs[walked]
+        return entries
+
+    def _parseDir(self, data):
+        entries = []
+        for offset in range(0, len(data), DIRENT_SIZE):
+            raw = data[offset:offset + DIRENT_SIZE]
+            if raw[0] == "\x00":
+                # end of directory
+                break
+            if (raw[0] == "\xE5") or (ord(raw[11]) == ATTR_LFN):
+                continue
+            entry = DirEntry(raw)
+            if entry.name in [".", ".."]:
+                continue
+            entries.append(entry)
+        return entries
+
+    def _fatEntry(self, cluster):
+        offset = cluster * 3 // 2
+        value = ord(self.fat[offset]) | (ord(self.fat[offset + 1]) << 8)
+        if cluster & 1:
+            return value >> 4
+        return value & 0xFFF
+
+    def _chain(self, cluster):
+        clusters = []
+        while (cluster >= 2) and (cluster < 0xFF0):
+            if (cluster - 2 >= self.numClusters) or (len(clusters) > self.numClusters):
+                raise FAT12Exception("Broken cluster chain at %d" % cluster)
+            clusters.append(cluster)
+            cluster = self._fatEntry(cluster)
+        return clusters
+
+    def _readChain(self, cluster):
+        # The sectors of a cluster chain in file order, read in batches that
+        # cover at most batchTracks tracks each
+        lbas = []
+        for c in self._chain(cluster):
+            first = self.dataStart + (c - 2) * self.sectorsPerCluster
+            lbas.extend(range(first, first + self.sectorsPerCluster))
+
+        batch = []
+        tracks = set()
+        for lba in lbas:
+            track = lba // self.sectorsPerTrack
+            if (track not in tracks) and (len(tracks) >= self.batchTracks):
+                yield "".join(self._readSectors(batch))
+                batch = []
+                tracks = set()
+            tracks.add(track)
+            batch.append(lba)
+        if batch:
+            yield "".join(self._readSectors(batch))
+
+    def _chs(self, lba):
+        spt = self.fdc.secCount
+        heads = self.fdc.numHead
+        return (lba // (spt * heads), (lba // spt) % heads, (lba % spt) + self.fdc.sot)
+
+    def _readSectors(self, lbas):
+        # list of sector data, in the order of lbas
+        keys = [self._chs(lba) for lba in lbas]
+        results = self.fdc.readMany(keys, self.retries)
+        for (lba, key) in zip(lbas, keys):
+            if results[key] is None:
+                raise FAT12Exception("Can't read sector %d (%d,%d,%d)" % ((lba,) + key))
+        return [results[key] for key in keys]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAT12 floppy reader")
+    parser.add_argument("--media", default="auto", help="media type: 144, 720, 360, 120, 111, or auto")
+    parser.add_argument("--drive", type=int, default=0, help="drive select, 0 or 1")
+    parser.add_argument("--emulate", default=None, metavar="IMAGE", help="use an emulated controller with a disk made from IMAGE")
+    subparsers = parser.add_subparsers(dest="command")
+
+    ls_parser = subparsers.add_parser("ls", help="list a directory")
+    ls_parser.add_argument("path", nargs="?", default="/")
+
+    get_parser = subparsers.add_parser("get", help="copy a file off the disk")
+    get_parser.add_argument("path")
+    get_parser.add_argument("dest", nargs="?", default=None, help="local file (default: same name, - for stdout)")
+
+    args = parser.parse_args()
+
+    backend = None
+    if args.emulate:
+        from wd37c65_emul import WD37C65Emulator, emulatedDisk, imageMedia
+        disk = emulatedDisk(imageMedia(args.emulate) if args.media == "auto" else args.media, args.emulate)
+        backend = WD37C65Emulator(disks=[None] * args.drive + [disk])
+
+    fdc = FDC(media="144" if args.media == "auto" else args.media, verbose=False, backend=backend)
+    fdc.init()
+    fdc.select(args.drive)
+    try:
+        if args.media == "auto":
+            fdc.detectMedia()
+        fs = FAT12(fdc)
+        if args.command == "ls":
+            for entry in fs.listdir(args.path):
+                if entry.isDir():
+                    print("%-12s   <DIR>" % entry.name)
+                else:
+                    print("%-12s %8d" % (entry.name, entry.size))
+        elif args.command == "get":
+            dest = args.dest or _splitPath(args.path)[-1]
+            if dest == "-":
+                f = sys.stdout
+            else:
+                f = open(dest, "wb")
+            for data in fs.readFile(args.path):
+                f.write(data)
+            if f is not sys.stdout:
+                f.close()
+    finally:
+        fdc.done(now=True)
+
+
+if __name__ == "__main__":
+    main()
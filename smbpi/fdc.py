@@ -4,16 +4,22 @@
 # Borrowed liberally from the RomWBW floppy driver
 
 from __future__ import print_function
+import argparse
+import atexit
+import collections
+import json
+import os
+import Queue
 import sys
+import threading
 import time
+import weakref
 
 # MSR is CS=FDC, A0=0
 # DATA is CS=FDC, A0=1
 # DOR is CS=DOR
 # DCR is CS=DCR
 
-import wd37c65_direct_ext
-
 FDM720 = 0
 FDM144 = 1
 FDM360 = 2
@@ -49,6 +55,35 @@ FRC_SHORT = 0x21
 FRC_LONG = 0x22
 FRC_INPROGRESS = 0x23
 
+FRC_NAME = {FRC_OK: "OK",
+            FRC_NOTIMPL: "NOTIMPL",
+            FRC_CMDERR: "CMDERR",
+            FRC_ERROR: "ERROR",
+            FRC_ABORT: "ABORT",
+            FRC_BUFMAX: "BUFMAX",
+            FRC_ABTERM: "ABTERM",
+            FRC_INVCMD: "INVCMD",
+            FRC_DSKCHG: "DSKCHG",
+            FRC_ENDCYL: "ENDCYL",
+            FRC_DATAERR: "DATAERR",
+            FRC_OVERRUN: "OVERRUN",
+            FRC_NODATA: "NODATA",
+            FRC_NOTWRIT: "NOTWRIT",
+            FRC_MISADR: "MISADR",
+            FRC_TOFDRRDY: "TOFDRRDY",
+            FRC_TOSNDCMD: "TOSNDCMD",
+            FRC_TOGETRES: "TOGETRES",
+            FRC_TOEXEC: "TOEXEC",
+            FRC_TOSEEKWT: "TOSEEKWT",
+            FRC_OVER_DRAIN: "OVER_DRAIN",
+            FRC_OVER_CMDRES: "OVER_CMDRES",
+            FRC_TO_READRES: "TO_READRES",
+            FRC_READ_ERROR: "READ_ERROR",
+            FRC_WRITE_ERROR: "WRITE_ERROR",
+            FRC_SHORT: "SHORT",
+            FRC_LONG: "LONG",
+            FRC_INPROGRESS: "INPROGRESS"}
+
 CFD_READ	 =	0B00000110	# CMD,HDS/DS,C,H,R,N,EOT,GPL,DTL --> ST0,ST1,ST2,C,H,R,N
 CFD_READDEL	 =	0B00001100	# CMD,HDS/DS,C,H,R,N,EOT,GPL,DTL --> ST0,ST1,ST2,C,H,R,N
 CFD_WRITE	 =	0B00000101	# CMD,HDS/DS,C,H,R,N,EOT,GPL,DTL --> ST0,ST1,ST2,C,H,R,N
@@ -66,6 +101,26 @@ CFD_DRVSTAT	 =  0B00000100	# CMD,HDS/DS --> ST3
 CFD_SEEK	 =  0B00001111	# CMD,HDS/DS --> <EMPTY>
 CFD_VERSION	 =  0B00010000	# CMD --> ST0
 
+# (data rate, N, sectors per track, more than 40 cylinders) -> media
+MEDIA_BY_GEOMETRY = {(500, 2, 18, True): "144",
+                     (500, 2, 15, True): "120",
+                     (500, 2, 15, False): "111",
+                     (250, 2, 9, True): "720",
+                     (250, 2, 9, False): "360",
+                     (250, 1, 15, False): "9836"}
+
+# execution-phase kinds for wd37c65_direct_ext.execute
+EXEC_NONE = 0
+EXEC_READ = 1
+EXEC_WRITE = 2
+EXEC_READID = 3
+EXEC_SCAN = 4
+
+# scan modes for FDC.scan
+SCAN_MODES = {"eq": CFD_SCANEQ,
+              "le": CFD_SCANLOEQ,
+              "ge": CFD_SCANHIEQ}
+
 CFD_NAME = {CFD_READ: "READ",
             CFD_READDEL: "READDEL",
             CFD_WRITE: "WRITE",
@@ -90,10 +145,345 @@ class FDCException(Exception):
         Exception.__init__(self, msg)
         self.fstRC = fstRC
 
+def _elevatorOrder(cyls, start):
+    # SCAN order: sweep up from the current cylinder, then come back down
+    up = sorted([c for c in cyls if c >= start])
+    down = sorted([c for c in cyls if c < start], reverse=True)
+    return up + down
+
+def _coalesceRecords(records):
+    # turn a list of records into (first, count) runs of adjacent records
+    runs = []
+    for r in sorted(set(records)):
+        if runs and (runs[-1][0] + runs[-1][1] == r):
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((r, 1))
+    return runs
+
+def _rotateRuns(runs, nextRecord):
+    # start with the first run that hasn't passed under the head yet
+    for i in range(0, len(runs)):
+        if runs[i][0] >= nextRecord:
+            return runs[i:] + runs[:i]
+    return runs
+
+def _fopString(entry):
+    (fcp, fstRC, frb, elapsed) = entry
+    return "FOP <%s> %s -> [result %02X] %s (%d us)" % \
+           (CFD_NAME.get(ord(fcp[0]) & 0x1F, "UNKNOWN"), " ".join(["%02X" % ord(x) for x in fcp]),
+            fstRC, " ".join(["%02X" % ord(x) for x in frb]), elapsed)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _fitLine(points):
+    # least squares fit of y = slope * x + intercept to [(x, y), ...]
+    n = len(points)
+    sx = sum([x for (x, y) in points])
+    sy = sum([y for (x, y) in points])
+    sxx = sum([x * x for (x, y) in points])
+    sxy = sum([x * y for (x, y) in points])
+    slope = float(n * sxy - sx * sy) / (n * sxx - sx * sx)
+    return (slope, (sy - slope * sx) / float(n))
+
+
+# LRU cache of whole tracks, keyed by (ds, cyl, head, media)
+class TrackCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tracks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.tracks.pop(key, None)
+        if data is None:
+            self.misses += 1
+            return None
+        # re-insert to make it the most recently used
+        self.tracks[key] = data
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.tracks.pop(key, None)
+        self.tracks[key] = data
+        while len(self.tracks) > self.capacity:
+            self.tracks.popitem(last=False)
+
+    def update(self, key, offset, data):
+        # write-through; tracks that aren't cached stay uncached
+        track = self.tracks.get(key)
+        if track is None:
+            return
+        self.tracks[key] = track[:offset] + data + track[offset+len(data):]
+
+    def discard(self, key):
+        self.tracks.pop(key, None)
+
+    def invalidate(self):
+        self.tracks.clear()
+
+
+# Reads tracks on its own thread and hands them over through a bounded queue,
+# so the drive keeps working while the consumer processes the previous track.
+class TrackReader(threading.Thread):
+    def __init__(self, fdc, tracks, readAhead, retries):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fdc = fdc
+        self.tracks = tracks
+        self.retries = retries
+        self.queue = Queue.Queue(maxsize=readAhead)
+        self.stopped = False
+
+    def run(self):
+        try:
+            for (cyl, head) in self.tracks:
+                if self.stopped:
+                    return
+                status = self.fdc.readTrack(cyl, head, self.retries)
+                self.queue.put((cyl, head, status, self.fdc.dskBuf))
+            self.queue.put(None)
+        except Exception, e:
+            self.queue.put(e)
+
+    def stop(self):
+        self.stopped = True
+        # unblock the reader if it is waiting on a full queue
+        while self.isAlive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+# Every MotorManager, so that motors are turned off when the process exits.
+# Weak, so that atexit doesn't keep every FDC ever made alive.
+_motorManagers = weakref.WeakSet()
+
+def _shutdownMotors():
+    for manager in list(_motorManagers):
+        manager.shutdown()
+
+atexit.register(_shutdownMotors)
+
+# Keeps the motor spinning for idleTime seconds after the last operation,
+# then turns it off from a timer thread. Callers hold fdc.lock.
+class MotorManager:
+    def __init__(self, fdc, idleTime):
+        self.fdc = fdc
+        self.idleTime = idleTime
+        self.lastActivity = 0
+        self.timer = None
+        _motorManagers.add(self)
+
+    def touch(self):
+        self.lastActivity = time.time()
+        if (self.timer is None) and (self.idleTime > 0):
+            self._arm(self.idleTime)
+
+    def _arm(self, delay):
+        self.timer = threading.Timer(delay, self._expired)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _expired(self):
+        with self.fdc.lock:
+            self.timer = None
+            idle = time.time() - self.lastActivity
+            if idle < self.idleTime:
+                # somebody used the drive since the timer was armed
+                self._arm(self.idleTime - idle)
+                return
+            if self.fdc.anyMotorOn():
+                self.fdc.log(">>> motor idle timeout")
+                self.fdc._motorOff()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def shutdown(self):
+        # don't leave the motor running when the process exits
+        with self.fdc.lock:
+            self.cancel()
+            if self.fdc.anyMotorOn():
+                self.fdc._motorOff()
+
+
+# geometry and media settings that FDC keeps per drive
+MEDIA_FIELDS = ["numCyl", "numHead", "sot", "secCount", "eot", "secSize", "N", "gapLengthRW",
+                "gapLengthFormat", "stepRate", "headLoadTimeNonDma", "DOR", "DCR", "media",
+                "mediaName", "detectedMedia"]
+
+# The WD37C65 has motor enables for two drives
+NUM_DRIVES = 2
+
+# seek distances, in cylinders, that FDC.calibrate() times
+SEEK_DISTANCES = [1, 2, 3, 5, 10, 20, 40, 79]
+
+class DriveState:
+    # What FDC remembers about each drive while another one is selected
+    def __init__(self, ds):
+        self.ds = ds
+        self.track = 0xFF          # cylinder the head is on; 0xFF until recalibrated
+        self.spinningUp = False    # motor was started by spinUp() and hasn't been waited for
+        self.media = None          # MEDIA_FIELDS values, saved while the drive isn't selected
+        self.profile = {}          # media name -> timing from FDC.calibrate(), used by SPECIFY
+
+    def calibrated(self):
+        return self.track != 0xFF
+
+
+# What to do before retrying a failed read, write, or format. Each step
+# costs more than the one before it.
+RETRY_REREAD = "reread"        # just try again on the next revolution
+RETRY_RESEEK = "reseek"        # seek to the cylinder again
+RETRY_RECAL = "recal"          # recalibrate, then seek
+RETRY_STEPAWAY = "stepaway"    # seek a couple of cylinders away and come back
+
+class RetryPolicy:
+    # Decides how to retry, and keeps error counts per (ds, cyl, head).
+    # Subclass and override action() or retryable() to change the strategy.
+    def __init__(self, ladder=None):
+        if ladder is None:
+            ladder = [RETRY_REREAD, RETRY_RESEEK, RETRY_RECAL, RETRY_STEPAWAY]
+        self.ladder = ladder
+        self.errors = {}       # (ds, cyl, head) -> {fstRC: count}
+        self.recovered = {}    # (ds, cyl, head) -> operations that needed retries, but worked
+        self.failed = {}       # (ds, cyl, head) -> operations that ran out of retries
+
+    def action(self, attempt, fstRC):
+        if fstRC in [FRC_NODATA, FRC_MISADR, FRC_ABTERM, FRC_TOSEEKWT]:
+            # can't find the sector, so reading again won't help; we may be on the wrong track
+            attempt += 1
+        return self.ladder[min(attempt, len(self.ladder) - 1)]
+
+    def retryable(self, fstRC):
+        return fstRC not in [FRC_NOTWRIT, FRC_INVCMD, FRC_CMDERR]
+
+    def recordError(self, key, fstRC):
+        counts = self.errors.setdefault(key, {})
+        counts[fstRC] = counts.get(fstRC, 0) + 1
+
+    def recordSuccess(self, key, attempts):
+        if attempts > 0:
+            self.recovered[key] = self.recovered.get(key, 0) + 1
+
+    def recordFailure(self, key):
+        self.failed[key] = self.failed.get(key, 0) + 1
+
+    def reset(self):
+        self.errors = {}
+        self.recovered = {}
+        self.failed = {}
+
+    def report(self):
+        # Error counts per track, worst first, and totals per drive
+        tracks = []
+        drives = {}
+        for key in set(self.errors.keys()) | set(self.failed.keys()):
+            (ds, cyl, head) = key
+            errors = self.errors.get(key, {})
+            entry = {"ds": ds, "cyl": cyl, "head": head,
+                     "errors": dict(errors),
+                     "errorCount": sum(errors.values()),
+                     "recovered": self.recovered.get(key, 0),
+                     "failed": self.failed.get(key, 0)}
+            tracks.append(entry)
+
+            drive = drives.setdefault(ds, {"errorCount": 0, "recovered": 0, "failed": 0, "badTracks": 0})
+            drive["errorCount"] += entry["errorCount"]
+            drive["recovered"] += entry["recovered"]
+            drive["failed"] += entry["failed"]
+            if entry["failed"]:
+                drive["badTracks"] += 1
+
+        tracks.sort(key=lambda x: (-x["failed"], -x["errorCount"], x["ds"], x["cyl"], x["head"]))
+        return {"tracks": tracks, "drives": drives}
+
+
+# The last size controller operations, and latency histograms per command.
+# record() only keeps the raw command and result bytes (the result starts
+# with ST0-ST2); nothing is formatted until someone dumps the trace.
+class FopTrace:
+    def __init__(self, size=256):
+        self.entries = collections.deque(maxlen=size)    # (fcp, fstRC, frb, micros)
+        self.histograms = {}   # command -> operations per power of two microseconds
+        self.micros = {}       # command -> total microseconds
+
+    def record(self, fcp, fstRC, frb, elapsed):
+        self.entries.append((fcp, fstRC, frb, elapsed))
+        cmd = ord(fcp[0]) & 0x1F
+        buckets = self.histograms.get(cmd)
+        if buckets is None:
+            buckets = self.histograms[cmd] = [0] * 33
+            self.micros[cmd] = 0
+        buckets[min(elapsed.bit_length(), 32)] += 1
+        self.micros[cmd] += elapsed
+
+    def reset(self):
+        self.entries.clear()
+        self.histograms = {}
+        self.micros = {}
+
+    def dump(self, f=sys.stderr):
+        for entry in self.entries:
+            print(_fopString(entry), file=f)
+
+    def report(self):
+        # Per command: count, total and mean microseconds, and the
+        # histogram as {upper bound in microseconds: count}
+        commands = {}
+        for (cmd, buckets) in self.histograms.items():
+            count = sum(buckets)
+            commands[CFD_NAME.get(cmd, "UNKNOWN")] = {
+                "count": count,
+                "micros": self.micros[cmd],
+                "meanMicros": self.micros[cmd] // count,
+                "histogram": dict([(1 << i, n) for (i, n) in enumerate(buckets) if n])}
+        return commands
+
+
 class FDC:
-    def __init__(self, media = "144", verbose=True):
+    def __init__(self, media = "144", verbose=True, cacheTracks=0, motorIdleTime=2.0, spinUpTime=1.0, backend=None,
+                 retryPolicy=None, traceSize=256):
         self.verbose = verbose
 
+        # traceSize=0 turns the trace off
+        if traceSize > 0:
+            self.trace = FopTrace(traceSize)
+        else:
+            self.trace = None
+
+        # backend is anything with the wd37c65_direct_ext function surface,
+        # for example a wd37c65_emul.WD37C65Emulator
+        if backend is None:
+            import wd37c65_direct_ext
+            backend = wd37c65_direct_ext
+        self.ext = backend
+
+        # serializes access to the controller between the caller, the
+        # read-ahead thread, and the motor timer
+        self.lock = threading.RLock()
+
+        # motorIdleTime=0 turns the motor off as soon as done() is called
+        self.motor = MotorManager(self, motorIdleTime)
+        self.spinUpTime = spinUpTime
+
+        if retryPolicy is None:
+            retryPolicy = RetryPolicy()
+        self.retryPolicy = retryPolicy
+
+        if cacheTracks > 0:
+            self.cache = TrackCache(cacheTracks)
+        else:
+            self.cache = None
+
         self.DOR_INIT = 0B00001100
         self.DOR_BR250 = self.DOR_INIT
         self.DOR_BR500 = self.DOR_INIT
@@ -102,6 +492,9 @@ class FDC:
 
         # dynamic
         self.ds = 0
+        self.drives = [DriveState(ds) for ds in range(0, NUM_DRIVES)]
+        self.drive = self.drives[0]
+        self.specified = None
         self.cyl = 0
         self.head = 0
         self.record = 0
@@ -109,11 +502,22 @@ class FDC:
         self.dop = 0
         self.idleCount = 0
         self.to = 0
+        self.secXfer = 1
+        self.readInto = None
+        self.probing = False
+        self.scanBuf = ""
+        self.timeExec = False
+        self.execTimes = ()
+        self.lastRetries = 0
+        self.rawTrack = []
+        self.rotationTime = None
+        self.mediaName = None
+        self.detectedMedia = None
+        # bumped on every disk change, so callers holding on to what they
+        # read off the disk know when to read it again
+        self.changeCount = 0
         self.fdcReady = False
 
-        # unit data
-        self.track = 0xFF
-
         self.dor = 0
 
         self.setMedia(media)
@@ -121,17 +525,195 @@ class FDC:
     def setMedia(self, what):
         if (what == "144") or (what == "pc144") or (what == "14.4") or (what == "1440") or (what == "pc1440"):
             self.set144()
+            self.mediaName = "144"
         elif (what == "720") or (what == "pc720"):
             self.set720()
+            self.mediaName = "720"
         elif (what == "360") or (what == "pc360"):
             self.set360()
+            self.mediaName = "360"
         elif (what == "120") or (what == "pc120"):
             self.set120()
+            self.mediaName = "120"
         elif (what == "111") or (what == "pc111"):
             self.set111()
+            self.mediaName = "111"
+        elif (what == "9836") or (what == "hp9836"):
+            self.set9836()
+            self.mediaName = "9836"
         else:
             raise Exception("Unknown media %s"% what)
 
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    def detectMedia(self, probeCyl=60, retries=0):
+        # Work out what's in the drive and switch to it. Each data rate is
+        # tried with READ ID on cylinder 0, starting with the current one;
+        # the IDs around the track give the sector size and count, and
+        # whether an ID can be read on probeCyl tells 80 cylinder media from
+        # 40. The answer is kept until the next disk change. Returns the
+        # media name, as taken by setMedia.
+        if self.detectedMedia is not None:
+            if self.mediaName != self.detectedMedia:
+                self.setMedia(self.detectedMedia)
+            return self.detectedMedia
+
+        rates = [(500, self.set144), (250, self.set720)]
+        if self.DCR == self.DCR_BR250:
+            rates.reverse()
+
+        for (rate, setRate) in rates:
+            setRate()
+            for i in range(0, retries + 1):
+                geometry = self._probeGeometry(rate, probeCyl)
+                if geometry is not None:
+                    break
+            if geometry is None:
+                self.log(">>> detectMedia: nothing at %d kbps" % rate)
+                continue
+
+            name = MEDIA_BY_GEOMETRY.get(geometry)
+            if name is None:
+                self.setMedia(self.mediaName)
+                raise FDCException(FRC_ERROR, "Unknown format: %d kbps, N=%d, %d sectors, %s cylinders" % \
+                                   (rate, geometry[1], geometry[2], geometry[3] and "80" or "40"))
+            self.log(">>> detectMedia: %s" % name)
+            self.setMedia(name)
+            self.detectedMedia = name
+            return name
+
+        self.setMedia(self.mediaName)
+        raise FDCException(FRC_MISADR, "No readable ID at any data rate")
+
+    def _probeGeometry(self, rate, probeCyl):
+        self.cyl = 0
+        self.head = 0
+        if (self._start() != FRC_OK) or (self.readID() != FRC_OK):
+            return None
+
+        ids = self._sweepIDs(64)
+        if not ids:
+            return None
+        n = ids[0][1][3]
+        secCount = max([chrn[2] for (t, chrn) in ids])
+
+        # A 40 cylinder disk has nothing on probeCyl, or, in a 40 track
+        # drive, we never get there
+        self.cyl = probeCyl
+        inner = (self._start() == FRC_OK) and (self.readID() == FRC_OK) and (ord(self.frb[3]) == probeCyl)
+        return (rate, n, secCount, inner)
+
+    def calibrate(self, trials=3, margin=1, fileName=None):
+        # Time the drive and find the fastest step rate it keeps up with on
+        # the current media; needs a readable disk. Step rates are tried
+        # fastest first, down to the media default, and one that loses
+        # track on any seek is out. margin backs off that many step rate
+        # settings from the fastest that worked. The result goes in the
+        # drive's profile, which SPECIFY uses from then on, and is saved to
+        # fileName if given. Returns the profile entry.
+        with self.lock:
+            self.drive.profile.pop(self.mediaName, None)
+            (defaultStep, hlt) = self._timing()
+
+            self.cyl = 0
+            self.head = 0
+            if (self._start() != FRC_OK) or (self.readID() != FRC_OK):
+                raise FDCException(self.fstRC, "Calibration needs a readable disk")
+
+            periods = []
+            for i in range(0, trials):
+                self._sweepIDs(2 * self.secCount + 2)
+                if self.rotationTime:
+                    periods.append(self.rotationTime)
+            if not periods:
+                raise FDCException(FRC_MISADR, "Can't time a revolution")
+
+            best = None
+            for srt in range(15, (defaultStep >> 4) - 1, -1):
+                stepRate = (srt << 4) | (defaultStep & 0x0F)
+                if self._seeksHold(stepRate, hlt, trials):
+                    best = srt
+                    break
+                self.log(">>> calibrate: step rate %02X loses track" % stepRate)
+            if best is None:
+                srt = defaultStep >> 4
+            else:
+                srt = max(defaultStep >> 4, best - margin)
+
+            entry = {"DCR": self.DCR,
+                     "stepRate": (srt << 4) | (defaultStep & 0x0F),
+                     "headLoadTimeNonDma": hlt,
+                     "rotationTime": _median(periods)}
+            self.drive.profile[self.mediaName] = entry
+
+            # seek times at the new step rate; the straight line through
+            # them gives the time per step and the fixed cost of a seek,
+            # which is the head settling plus a little rotational latency
+            seekTimes = {}
+            for distance in [d for d in SEEK_DISTANCES if d < self.numCyl]:
+                seekTimes[distance] = _median([self._timeSeek(distance) for i in range(0, trials)])
+            (stepTime, settleTime) = _fitLine(seekTimes.items())
+            entry["seekTimes"] = dict([(str(d), t) for (d, t) in seekTimes.items()])
+            entry["stepTime"] = int(stepTime)
+            entry["settleTime"] = int(settleTime)
+
+            if fileName:
+                self.saveProfile(fileName)
+            return entry
+
+    def _seeksHold(self, stepRate, hlt, trials):
+        # Try out a step rate with long and short seeks in both directions,
+        # checking where the head ended up after each. On the way out, the
+        # head is put back on cylinder 0 at the default step rate.
+        self.drive.profile[self.mediaName] = {"DCR": self.DCR, "stepRate": stepRate, "headLoadTimeNonDma": hlt}
+        last = self.numCyl - 1
+        middle = self.numCyl // 2
+        ok = True
+        for i in range(0, trials):
+            for cyl in [last, 0, middle, middle + 1, middle - 1, 1, last - 1, 0]:
+                self.cyl = cyl
+                if (self._start() != FRC_OK) or (self.readID() != FRC_OK) or (ord(self.frb[3]) != cyl):
+                    ok = False
+                    break
+            if not ok:
+                break
+
+        del self.drive.profile[self.mediaName]
+        self.drive.track = 0xFF
+        self.cyl = 0
+        self._start()
+        return ok
+
+    def _timeSeek(self, distance):
+        # Microseconds from starting a seek of distance cylinders, out from
+        # cylinder 0, until an ID can be read. The controller reports the
+        # seek done as soon as the steps are out, so it takes the READ ID
+        # to see the settling time.
+        self.cyl = 0
+        self._start()
+        start = self.ext.micros()
+        self.cyl = distance
+        self._start()
+        self.readID()
+        return (self.ext.micros() - start) & 0xFFFFFFFF
+
+    def loadProfile(self, fileName, ds=None):
+        # Load a drive profile saved by calibrate(); ds defaults to the
+        # selected drive
+        if ds is None:
+            ds = self.ds
+        with open(fileName) as f:
+            profile = json.load(f)
+        with self.lock:
+            self.drives[ds].profile = dict([(str(name), entry) for (name, entry) in profile["media"].items()])
+
+    def saveProfile(self, fileName, ds=None):
+        if ds is None:
+            ds = self.ds
+        with open(fileName, "w") as f:
+            json.dump({"ds": ds, "media": self.drives[ds].profile}, f, indent=2, sort_keys=True)
+
     def set360(self):
         self.numCyl = 0x28
         self.numHead = 2
@@ -246,33 +828,33 @@ class FDC:
     # ------------ chip funcs -----------------
 
     def readDataBlock(self, count):
-        status, blk = wd37c65_direct_ext.read_block(count)
+        status, blk = self.ext.read_block(count)
         if status not in [FRC_OK, FRC_READ_ERROR]:
             raise FDCException(status)
 
         self.dskBuf = blk
 
     def writeDataBlock(self, count, autoTerminate=True):
-        status = wd37c65_direct_ext.write_block(self.dskBuf, count, autoTerminate)
+        status = self.ext.write_block(self.dskBuf, count, autoTerminate)
         if status not in [FRC_OK, FRC_WRITE_ERROR]:
             raise FDCException(status)
 
     def writeData(self, d):
-        wd37c65_direct_ext.write_data(d)
+        self.ext.write_data(d)
 
     def drain(self):
-        status = wd37c65_direct_ext.drain()
+        status = self.ext.drain()
         if status != 0:
             raise FDCException(status)
 
     def wait_msr(self, mask, val):
-        return wd37c65_direct_ext.wait_msr(mask, val)
+        return self.ext.wait_msr(mask, val)
 
     def get_msr(self):
-        return wd37c65_direct_ext.get_msr()
+        return self.ext.get_msr()
 
     def readResult(self):
-        status, blk = wd37c65_direct_ext.read_result()
+        status, blk = self.ext.read_result()
         if status != 0:
             raise FDCException(status)
 
@@ -280,17 +862,17 @@ class FDC:
         self.frbLen = len(self.frb)
 
     def resetFDC(self):
-        wd37c65_direct_ext.reset(self.dor)
+        self.ext.reset(self.dor)
 
     def initFDC(self):
-        wd37c65_direct_ext.init()
+        self.ext.init()
 
     def writeDOR(self, dor):
-        wd37c65_direct_ext.write_dor(dor)
+        self.ext.write_dor(dor)
         self.dor = dor
 
     def writeDCR(self, dcr):
-        wd37c65_direct_ext.write_dcr(dcr)
+        self.ext.write_dcr(dcr)
         self.dcr = dcr
     
     # -----------------------------------------
@@ -304,42 +886,591 @@ class FDC:
         self._clearDiskChange()
         self.fdcReady = True
 
-    def done(self):
-        self._motorOff()
+    def done(self, now=False):
+        # Normally the motor keeps running until the idle timer expires, so
+        # that the next burst of work doesn't have to wait for spin-up.
+        with self.lock:
+            if now or (self.motor.idleTime <= 0):
+                self.motor.cancel()
+                self._motorOff()
 
     def _reset(self):
         self.resetFDC()
         self._clearDiskChange()
-        self.track = 0xFF  # mark needing recal
+        for drive in self.drives:
+            drive.track = 0xFF  # mark needing recal
+        self.specified = None
         self.fdcReady = True
 
+    def select(self, ds):
+        # Switch to drive ds. Each drive keeps its own head position and
+        # media, so switching back and forth doesn't cost a recal or a seek.
+        if (ds < 0) or (ds >= NUM_DRIVES):
+            raise FDCException(FRC_CMDERR, "No drive %d" % ds)
+        if ds == self.ds:
+            return
+        with self.lock:
+            self.drive.media = dict([(name, getattr(self, name)) for name in MEDIA_FIELDS])
+            self.ds = ds
+            self.drive = self.drives[ds]
+            if self.drive.media is not None:
+                for (name, value) in self.drive.media.items():
+                    setattr(self, name, value)
+
+    def spinUp(self, ds):
+        # Start drive ds's motor without selecting it or waiting, so that
+        # it spins up while the current drive is busy. The first command on
+        # it still waits until it's ready.
+        with self.lock:
+            motorMask = (1 << (ds+4))
+            if (self.dor & motorMask) == 0:
+                self.writeDOR(self.dor | motorMask)
+                self.drives[ds].spinningUp = True
+                self.motor.touch()
+
     def read(self, cyl=None, head=None, record=None, retries=0):
-        if cyl is not None:
-            self.cyl = cyl
-        if head is not None:
-            self.head = head
-        if record is not None:
-            self.record = record
+        return self.readSectors(cyl, head, record, 1, retries)
 
-        while (retries >= 0):
-            retries -= 1
-            self._start()
-            if (self.fstRC != FRC_OK):
-                print("*** read _start retry %02X" % self.fstRC, file=sys.stderr)
-                continue
+    def write(self, cyl=None, head=None, record=None, retries=0):
+        return self.writeSectors(cyl, head, record, 1, retries=retries)
 
-            self._setupIO(CFD_READ | 0B11100000)
-            self._fop()
+    def readTrack(self, cyl=None, head=None, retries=0):
+        return self.readSectors(cyl, head, self.sot, self.secCount, retries)
 
-            if self.fstRC == FRC_OK:
-                return self.fstRC
+    def writeTrack(self, cyl=None, head=None, data=None, retries=0):
+        return self.writeSectors(cyl, head, self.sot, self.secCount, data, retries)
+
+    def readSectors(self, cyl=None, head=None, first=None, count=1, retries=0):
+        # Reads count consecutive sectors starting at first with a single
+        # command. The data ends up in self.dskBuf.
+        self._setupXfer(cyl, head, first, count)
+
+        if self.cache is not None:
+            return self._readCached(retries)
+
+        return self._readXfer(retries)
+
+    def readMany(self, requests, retries=0):
+        # Read a batch of (cyl, head, record) sectors. The requests are
+        # serviced in elevator order by cylinder, then head, then rotational
+        # position, and adjacent records are read with one multi-sector
+        # command. Returns a dict mapping each (cyl, head, record) to its
+        # data, or to None if it couldn't be read.
+        tracks = {}
+        for (cyl, head, record) in requests:
+            tracks.setdefault(cyl, {}).setdefault(head, []).append(record)
+
+        if self.drive.track == 0xFF:
+            startCyl = 0
+        else:
+            startCyl = self.drive.track
+
+        results = {}
+        for cyl in _elevatorOrder(tracks.keys(), startCyl):
+            nextRecord = self.sot
+            for head in sorted(tracks[cyl].keys()):
+                for (first, count) in _rotateRuns(_coalesceRecords(tracks[cyl][head]), nextRecord):
+                    self._readRun(cyl, head, first, count, retries, results)
+                    nextRecord = first + count
+
+        return results
+
+    def readTracks(self, tracks=None, readAhead=2, retries=0):
+        # Generator over whole tracks, yielding (cyl, head, status, data). By
+        # default, all tracks are visited in cylinder order, both heads on a
+        # cylinder before moving on. With readAhead > 0, up to readAhead
+        # tracks are read ahead on a separate thread while the caller is
+        # busy with the current one; don't use the FDC for anything else
+        # until the generator is exhausted or closed.
+        if tracks is None:
+            tracks = [(cyl, head) for cyl in range(0, self.numCyl) for head in range(0, self.numHead)]
+
+        if readAhead <= 0:
+            for (cyl, head) in tracks:
+                status = self.readTrack(cyl, head, retries)
+                yield (cyl, head, status, self.dskBuf)
+            return
+
+        reader = TrackReader(self, tracks, readAhead, retries)
+        reader.start()
+        try:
+            while True:
+                item = reader.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            reader.stop()
+
+    def imageDisk(self, fileName, retries=2, mapFileName=None):
+        # Stream the whole disk into fileName, one track at a time. Tracks are
+        # visited in serpentine order, and sectors that can't be read are
+        # zero-filled and recorded in a sidecar bad-sector map. Running again
+        # with the same map resumes where the last run left off and retries
+        # the bad sectors. Returns the number of sectors that are still bad.
+        if mapFileName is None:
+            mapFileName = fileName + ".map"
+
+        badMap = self._loadBadMap(mapFileName)
+        done = set([tuple(x) for x in badMap["done"]])
+        bad = dict([((c, h, r), status) for (c, h, r, status) in badMap["bad"]])
+
+        # one buffer for every track; readSectorsInto fills it in place
+        self.trackBuf = bytearray(self.secCount * self.secSize)
+
+        if os.path.exists(fileName):
+            f = open(fileName, "r+b")
+        else:
+            f = open(fileName, "w+b")
+
+        try:
+            # first pass: whole tracks, cylinders ascending, alternating head order
+            for cyl in range(0, self.numCyl):
+                heads = range(0, self.numHead)
+                if (cyl % 2) == 1:
+                    heads.reverse()
+                for head in heads:
+                    if (cyl, head) in done:
+                        continue
+                    self._imageTrack(f, cyl, head, bad)
+                    done.add((cyl, head))
+                    self._saveBadMap(mapFileName, done, bad, f)
+
+            # second pass: retry the bad sectors on the way back down
+            if bad:
+                results = self.readMany(bad.keys(), retries)
+                for (key, data) in results.items():
+                    if data is not None:
+                        self._imageWrite(f, key[0], key[1], key[2], data)
+                        del bad[key]
+                self._saveBadMap(mapFileName, done, bad, f)
+        finally:
+            f.close()
+
+        return len(bad)
+
+    def readMaster(self, retries=2):
+        # Read the whole disk in the current drive into memory for
+        # writeCopy. Returns a dict of (cyl, head) -> track data. Raises
+        # FDCException if any sector can't be read.
+        master = {}
+        badTracks = []
+        for (cyl, head, status, data) in self.readTracks(retries=retries):
+            if status == FRC_OK:
+                master[(cyl, head)] = data
+            else:
+                badTracks.append((cyl, head))
+
+        # pick up what we can a sector at a time, now the read-ahead thread is done
+        for (cyl, head) in badTracks:
+            records = range(self.sot, self.sot + self.secCount)
+            results = self.readMany([(cyl, head, r) for r in records], retries)
+            missing = [r for r in records if results[(cyl, head, r)] is None]
+            if missing:
+                raise FDCException(FRC_DATAERR, "Master has unreadable sectors on (%d,%d): %s" % \
+                                   (cyl, head, " ".join([str(r) for r in missing])))
+            master[(cyl, head)] = "".join([results[(cyl, head, r)] for r in records])
+
+        return master
+
+    def writeCopy(self, master, formatMode="auto", verify=True, retries=2):
+        # Write a disk read by readMaster to the disk in the current drive.
+        # With formatMode "auto", a track is only formatted if it can't be
+        # read; "always" formats every track (fastest for blanks), "never"
+        # formats none. Sectors that already hold the right data are left
+        # alone. Each track is checked with one read and compared in bulk;
+        # the runs of sectors that differ are written with multi-sector
+        # writes, and only those are read back to verify. Returns a dict of
+        # counts, and the tracks that couldn't be made right in "badTracks".
+        # "differing" is how many sectors needed writing; "written" falls
+        # short of it if some couldn't be.
+        stats = {"formatted": 0, "differing": 0, "written": 0, "skipped": 0, "rewritten": 0, "badTracks": []}
+        buf = bytearray(self.secCount * self.secSize)
+        for (cyl, head) in sorted(master.keys()):
+            if not self._syncTrack(cyl, head, master[(cyl, head)], buf, formatMode, verify, retries, stats):
+                stats["badTracks"].append((cyl, head))
+        return stats
+
+    def restoreImage(self, fileName, formatMode="auto", verify=True, retries=2):
+        # Write an image file, as made by imageDisk, to the disk in the
+        # current drive. Goes through writeCopy, so refreshing a disk that's
+        # nearly right only writes the sectors that differ. Returns
+        # writeCopy's counts.
+        trackSize = self.secCount * self.secSize
+        data = open(fileName, "rb").read()
+        if len(data) != self.numCyl * self.numHead * trackSize:
+            raise FDCException(FRC_CMDERR, "%s is not an image for %s media" % (fileName, self.mediaName))
+
+        master = {}
+        for cyl in range(0, self.numCyl):
+            for head in range(0, self.numHead):
+                offset = ((cyl * self.numHead) + head) * trackSize
+                master[(cyl, head)] = data[offset:offset + trackSize]
+        return self.writeCopy(master, formatMode, verify, retries)
+
+    def _syncTrack(self, cyl, head, data, buf, formatMode, verify, retries, stats):
+        records = range(self.sot, self.sot + self.secCount)
+        if len(data) != len(buf):
+            raise FDCException(FRC_CMDERR, "Master track (%d,%d) is for different media" % (cyl, head))
+
+        if formatMode == "always":
+            statuses = None
+        elif self._probeTrack(buf, cyl, head) == FRC_OK:
+            statuses = [FRC_OK] * self.secCount
+        elif self.fstRC == FRC_DATAERR:
+            # the IDs are there, so only the sectors that won't read need writing
+            statuses = self.readTrackSectors(buf, cyl, head)
+        else:
+            statuses = None
+
+        if statuses is not None:
+            differing = [r for r in self._differingRecords(buf, data, records) if statuses[r - self.sot] == FRC_OK] + \
+                        [r for r in records if statuses[r - self.sot] != FRC_OK]
+            stats["skipped"] += len(records) - len(differing)
+        elif formatMode == "never":
+            differing = records
+        else:
+            if self.format(cyl, head, retries) != FRC_OK:
+                return False
+            stats["formatted"] += 1
+            differing = records
+        stats["differing"] += len(differing)
+
+        # writeSectors does its own retries, so going around again is only
+        # for sectors that wrote without error but didn't verify
+        if verify:
+            passes = retries + 1
+        else:
+            passes = 1
+
+        for attempt in range(0, passes):
+            writeFailed = False
+            for (first, count) in _coalesceRecords(differing):
+                offset = (first - self.sot) * self.secSize
+                if self.writeSectors(cyl, head, first, count, data[offset:offset + count * self.secSize], retries) != FRC_OK:
+                    writeFailed = True
+                    continue
+                if attempt == 0:
+                    stats["written"] += count
+                else:
+                    stats["rewritten"] += count
+
+            if writeFailed:
+                return False
+            if not verify:
+                return True
+
+            # read back just what was written
+            failed = []
+            for (first, count) in _coalesceRecords(differing):
+                offset = (first - self.sot) * self.secSize
+                if self.readSectorsInto(buf, offset, cyl, head, first, count) == FRC_OK:
+                    failed.extend(self._differingRecords(buf, data, range(first, first + count)))
+                else:
+                    failed.extend(range(first, first + count))
+            if not failed:
+                return True
+            differing = failed
+
+        return False
+
+    def _differingRecords(self, buf, data, records):
+        size = self.secSize
+        differing = []
+        for r in records:
+            offset = (r - self.sot) * size
+            if buf[offset:offset + size] != data[offset:offset + size]:
+                differing.append(r)
+        return differing
+
+    def _imageTrack(self, f, cyl, head, bad):
+        statuses = self.readTrackSectors(self.trackBuf, cyl, head)
+        for (i, status) in enumerate(statuses):
+            if status == FRC_OK:
+                bad.pop((cyl, head, self.sot + i), None)
+            else:
+                bad[(cyl, head, self.sot + i)] = status
+        self._imageWrite(f, cyl, head, self.sot, self.trackBuf)
+
+    def readTrackSectors(self, buf, cyl, head, retries=0):
+        # Read a whole track into buf. If that fails, go sector by sector,
+        # with retries for each, and zero-fill the ones that can't be read.
+        # Returns the status of each sector, in record order.
+        if self._probeTrack(buf, cyl, head) == FRC_OK:
+            return [FRC_OK] * self.secCount
+
+        # something on the track is bad; find out which sectors
+        statuses = []
+        for record in range(self.sot, self.sot + self.secCount):
+            offset = (record - self.sot) * self.secSize
+            if self.readSectorsInto(buf, offset, cyl, head, record, 1, retries) != FRC_OK:
+                buf[offset:offset + self.secSize] = "\0" * self.secSize
+            statuses.append(self.fstRC)
+        return statuses
+
+    def _probeTrack(self, buf, cyl, head):
+        # One try at reading the whole track into buf, without retries and
+        # without counting a failure against the track; a caller that gets
+        # an error goes on to read the sectors on their own.
+        self.probing = True
+        try:
+            return self.readSectorsInto(buf, 0, cyl, head, self.sot, self.secCount)
+        finally:
+            self.probing = False
+
+    def _imageWrite(self, f, cyl, head, record, data):
+        f.seek((((cyl * self.numHead) + head) * self.secCount + (record - self.sot)) * self.secSize)
+        f.write(data)
+
+    def _geometry(self):
+        return {"media": self.media,
+                "numCyl": self.numCyl,
+                "numHead": self.numHead,
+                "secCount": self.secCount,
+                "secSize": self.secSize}
+
+    def _loadBadMap(self, mapFileName):
+        if not os.path.exists(mapFileName):
+            return {"geometry": self._geometry(), "done": [], "bad": []}
+
+        badMap = json.load(open(mapFileName))
+        if badMap["geometry"] != self._geometry():
+            raise FDCException(FRC_CMDERR, "Bad sector map %s is for different media" % mapFileName)
+        return badMap
+
+    def _saveBadMap(self, mapFileName, done, bad, imageFile):
+        # The image data has to be on the disk before a map that says it's
+        # done, or a crash could leave tracks marked done that never got
+        # written, and resuming would skip them
+        imageFile.flush()
+        os.fsync(imageFile.fileno())
+
+        badMap = {"geometry": self._geometry(),
+                  "done": sorted(done),
+                  "bad": sorted([list(key) + [status] for (key, status) in bad.items()])}
+        # write it out and rename, so a crash never leaves a half-written map
+        f = open(mapFileName + ".tmp", "w")
+        json.dump(badMap, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(mapFileName + ".tmp", mapFileName)
+
+    def scan(self, pattern, mode="eq", cylRange=None, offset=0, retries=0):
+        # Search the disk on the controller with the SCAN commands. Every
+        # sector has the bytes at offset compared against pattern; with
+        # mode "eq" they must be equal, with "le" the disk bytes must be <=
+        # pattern and with "ge" they must be >=. 0xFF bytes, in the pattern
+        # or on the disk, match anything. No sector data is transferred.
+        # Returns a dict with the (cyl, head, record) that matched in
+        # "matches", the sectors skipped over because of a data error in
+        # "bad", and the (cyl, head) that couldn't be scanned in "badTracks".
+        if mode not in SCAN_MODES:
+            raise FDCException(FRC_CMDERR, "Unknown scan mode %s" % mode)
+        pattern = str(pattern)
+        if offset + len(pattern) > self.secSize:
+            raise FDCException(FRC_CMDERR, "Scan pattern at %d doesn't fit in a %d byte sector" % (offset, self.secSize))
+        sector = "\xFF" * offset + pattern + "\xFF" * (self.secSize - offset - len(pattern))
+
+        if cylRange is None:
+            cylRange = range(0, self.numCyl)
+
+        result = {"matches": [], "bad": [], "badTracks": []}
+        for cyl in cylRange:
+            for head in range(0, self.numHead):
+                self._scanTrack(cyl, head, SCAN_MODES[mode], sector, retries, result)
+        return result
+
+    def _scanTrack(self, cyl, head, cmd, sector, retries, result):
+        record = self.sot
+        while record <= self.eot:
+            self._setupXfer(cyl, head, record, self.eot - record + 1)
+            # one copy of the comparison data for every sector left on the track
+            self.scanBuf = sector * self.secXfer
+
+            # not being satisfied by the end of the track isn't an error
+            self._retry("scan", retries, lambda: self._setupScan(cmd), [FRC_ENDCYL, FRC_ABTERM])
+            if (self.fcpCmd != cmd) or (self.frbLen < 7):
+                # never got as far as running the scan
+                self.log("*** scan of (%d,%d) failed, status %02X" % (cyl, head, self.fstRC))
+                result["badTracks"].append((cyl, head))
+                return
 
-            print("*** read retry %02X" % self.fstRC, file=sys.stderr)
+            frb = self.frb
+            st0 = ord(frb[0])
+            st1 = ord(frb[1])
+            st2 = ord(frb[2])
+            r = ord(frb[5])
+            if (st0 & 0B11000000) == 0:
+                # satisfied; the controller leaves R on the sector that matched
+                result["matches"].append((cyl, head, r))
+                record = r + 1
+            elif (st2 & 0x04) or (st1 & 0x80):
+                # not satisfied by the end of the track
+                return
+            elif (st1 & 0x20) and (r >= record):
+                # a bad sector ends the scan; carry on after it
+                self.log("*** scan data error at (%d,%d,%d)" % (cyl, head, r))
+                result["bad"].append((cyl, head, r))
+                record = r + 1
+            else:
+                self.log("*** scan of (%d,%d) failed, ST0-2 %02X %02X %02X" % (cyl, head, st0, st1, st2))
+                result["badTracks"].append((cyl, head))
+                return
+
+    def readRawTrack(self, cyl=None, head=None, retries=0):
+        # Read the whole track in physical order with READ TRACK, starting at
+        # the index hole. self.rawTrack is left with one
+        # (c, h, r, n, offset, data) per sector, where offset is the arrival
+        # time in microseconds relative to the first sector after the index
+        # hole. The IDs come from a sweep of READ IDs, since READ TRACK
+        # doesn't return them; an ID that wasn't seen is None. The sector
+        # order gives the interleave, and the offset of a given record on
+        # neighbouring tracks gives the skew. self.rotationTime is the
+        # measured time for one revolution.
+        self._setupXfer(cyl, head, self.sot, self.secCount)
+
+        self.rawTrack = []
+        self.execTimes = ()
+        self.timeExec = True
+        try:
+            # no data just means the IDs weren't in order from sot
+            self._retry("readRawTrack", retries, lambda: self._setupIO(CFD_READTRK | 0B01000000), [FRC_NODATA])
+        finally:
+            self.timeExec = False
+        if self.fcpCmd == CFD_READTRK:
+            times = self.execTimes[1:]
+        else:
+            times = ()
 
-        # retries exhausted
+        if (len(times) < self.secXfer) or (self.fstRC not in [FRC_OK, FRC_NODATA, FRC_DATAERR]):
+            # a track with a bad sector on it is still worth having
+            return self.fstRC
+
+        status = self.fstRC
+        if status == FRC_NODATA:
+            status = FRC_OK
+        ids = self._sweepIDs(2 * self.secXfer + 2)
+        period = self.rotationTime
+
+        for i in range(0, self.secXfer):
+            offset = (times[i] - times[0]) & 0xFFFFFFFF
+            data = self.dskBuf[i * self.secSize:(i + 1) * self.secSize]
+            sectorId = (None, None, None, None)
+            if period:
+                # the ID is the last one to go by before the data
+                best = None
+                for (t, chrn) in ids:
+                    lead = (times[i] - t) % period
+                    if (best is None) or (lead < best):
+                        best = lead
+                        sectorId = chrn
+                if best > period // (2 * self.secXfer):
+                    sectorId = (None, None, None, None)
+            self.rawTrack.append(sectorId + (offset, data))
+
+        self.fstRC = status
         return self.fstRC
 
-    def write(self, cyl=None, head=None, record=None, retries=0):
+    def _sweepIDs(self, maxIDs):
+        # READ ID one after another for a little over a revolution. Returns
+        # a list of (micros, (c, h, r, n)) and sets self.rotationTime from
+        # the first ID coming around again.
+        ids = []
+        self.rotationTime = None
+        self.timeExec = True
+        try:
+            while len(ids) < maxIDs:
+                if (self.readID() != FRC_OK) or (self.frbLen < 7) or (len(self.execTimes) < 2):
+                    break
+                chrn = tuple([ord(x) for x in self.frb[3:7]])
+                t = self.execTimes[1]
+                if ids and (chrn == ids[0][1]):
+                    self.rotationTime = (t - ids[0][0]) & 0xFFFFFFFF
+                    break
+                ids.append((t, chrn))
+        finally:
+            self.timeExec = False
+        return ids
+
+    def _readRun(self, cyl, head, first, count, retries, results):
+        if self.readSectors(cyl, head, first, count, retries) == FRC_OK:
+            buf = self.dskBuf
+            for i in range(0, count):
+                results[(cyl, head, first + i)] = buf[i * self.secSize:(i + 1) * self.secSize]
+            return
+
+        if count == 1:
+            results[(cyl, head, first)] = None
+            return
+
+        # one bad sector shouldn't cost us the rest of the run
+        for i in range(0, count):
+            self._readRun(cyl, head, first + i, 1, retries, results)
+
+    def readSectorsInto(self, buf, offset, cyl=None, head=None, first=None, count=1, retries=0):
+        # Like readSectors, but the data is read straight into buf (a
+        # bytearray or writable memoryview) at offset, and self.dskBuf is
+        # left alone. Bypasses the track cache.
+        self._setupXfer(cyl, head, first, count)
+        if offset + count * self.secSize > len(buf):
+            raise FDCException(FRC_BUFMAX, "Read of %d sectors doesn't fit in the buffer" % count)
+
+        self.readInto = (buf, offset)
+        try:
+            return self._readXfer(retries)
+        finally:
+            self.readInto = None
+
+    def _readCached(self, retries):
+        first = self.record
+        count = self.secXfer
+        key = self._trackKey()
+
+        track = self.cache.get(key)
+        if track is None:
+            # fill the cache with the whole track; _readXfer stores it
+            self.record = self.sot
+            self.secXfer = self.secCount
+            if self._readXfer(0) == FRC_OK:
+                track = self.dskBuf
+            self.record = first
+            self.secXfer = count
+
+        if track is None:
+            # something on the track is unreadable; just go after what was asked for
+            return self._readXfer(retries)
+
+        offset = (first - self.sot) * self.secSize
+        self.dskBuf = track[offset:offset + count * self.secSize]
+        self.fstRC = FRC_OK
+        return self.fstRC
+
+    def _readXfer(self, retries):
+        self._retry("read", retries, lambda: self._setupIO(CFD_READ | 0B11100000))
+        if (self.fstRC == FRC_OK) and (self.cache is not None) and (self.secXfer == self.secCount) and (self.readInto is None):
+            self.cache.put(self._trackKey(), self.dskBuf)
+        return self.fstRC
+
+    def writeSectors(self, cyl=None, head=None, first=None, count=1, data=None, retries=0):
+        # Writes count consecutive sectors starting at first with a single
+        # command. If data is None, the data is taken from self.dskBuf.
+        self._setupXfer(cyl, head, first, count)
+
+        if data is not None:
+            self.dskBuf = data
+        if len(self.dskBuf) < count * self.secSize:
+            raise FDCException(FRC_CMDERR, "Write of %d sectors needs %d bytes, got %d" % (count, count * self.secSize, len(self.dskBuf)))
+
+        self._retry("write", retries, lambda: self._setupIO(CFD_WRITE | 0B11000000))
+        if (self.fstRC == FRC_OK) and (self.cache is not None):
+            self.cache.update(self._trackKey(), (self.record - self.sot) * self.secSize,
+                              str(self.dskBuf[:count * self.secSize]))
+        return self.fstRC
+
+    def _setupXfer(self, cyl, head, record, count):
         if cyl is not None:
             self.cyl = cyl
         if head is not None:
@@ -347,23 +1478,25 @@ class FDC:
         if record is not None:
             self.record = record
 
-        while (retries >= 0):
-            retries -= 1
-            self._start()
-            if (self.fstRC != FRC_OK):
-                print("*** write _start retry %02X" % self.fstRC, file=sys.stderr)
-                continue
+        if (count < 1) or (self.record < self.sot) or (self.record + count - 1 > self.eot):
+            raise FDCException(FRC_CMDERR, "Sectors %d-%d are not on the track" % (self.record, self.record + count - 1))
 
-            self._setupIO(CFD_WRITE | 0B11000000)
-            self._fop()
+        # The controller runs through consecutive sectors up to EOT on its
+        # own; the transfer is terminated after secXfer sectors.
+        self.secXfer = count
 
-            if self.fstRC == FRC_OK:
-                return self.fstRC
+    def _trackKey(self):
+        return (self.ds, self.cyl, self.head, (self.media, self.secCount, self.secSize))
 
-            print("*** write retry %02X" % self.fstRC, file=sys.stderr)
-
-        # retries exhausted
-        return self.fstRC
+    def _diskChanged(self, ds):
+        self.log(">>> disk change %d" % ds)
+        self.changeCount += 1
+        if ds == self.ds:
+            self.detectedMedia = None
+        elif (ds < NUM_DRIVES) and (self.drives[ds].media is not None):
+            self.drives[ds].media["detectedMedia"] = None
+        if self.cache is not None:
+            self.cache.invalidate()
 
     def format(self, cyl=None, head=None, retries=0):
         if cyl is not None:
@@ -371,30 +1504,146 @@ class FDC:
         if head is not None:
             self.head = head
 
-        self.dskBuf = ""
+        self.dskBuf = bytearray(4 * self.secCount)
         for i in range(0, self.secCount):
-            self.dskBuf += chr(self.cyl)
-            self.dskBuf += chr(self.head)
-            self.dskBuf += chr(i+1)  # secNum
-            self.dskBuf += chr(self.N)  # 2 = 512 bytes per sector
-
-        while (retries >= 0):
-            retries -= 1
+            self.dskBuf[i*4] = self.cyl
+            self.dskBuf[i*4+1] = self.head
+            self.dskBuf[i*4+2] = i+1  # secNum
+            self.dskBuf[i*4+3] = self.N  # 2 = 512 bytes per sector
+
+        if self.cache is not None:
+            self.cache.discard(self._trackKey())
+        return self._retry("format", retries, lambda: self._setupFormat(CFD_FMTTRK | 0B01000000))
+
+    def _retry(self, what, retries, setup, accept=None):
+        # Run the command set up by setup() until it works or retries run
+        # out. Before each retry, self.retryPolicy picks how hard to try to
+        # get the head back on track. Every failure is counted against the
+        # track, except while probing. The command finishing with a status
+        # in accept ends it too, without counting as an error.
+        key = (self.ds, self.cyl, self.head)
+        attempt = 0
+        while True:
+            self.lastRetries = attempt
             self._start()
-            if (self.fstRC != FRC_OK):
-                print("*** format _start retry %02X" % self.fstRC, file=sys.stderr)
-                continue
-
-            self._setupFormat(CFD_FMTTRK | 0B01000000)
-            self._fop()
+            if self.fstRC == FRC_OK:
+                setup()
+                self._fop()
+                if (accept is not None) and (self.fstRC in accept):
+                    self.retryPolicy.recordSuccess(key, attempt)
+                    return self.fstRC
 
             if self.fstRC == FRC_OK:
+                self.retryPolicy.recordSuccess(key, attempt)
                 return self.fstRC
 
-            print("*** format retry %02X" % self.fstRC, file=sys.stderr)
+            if self.probing:
+                # the caller finds out what's wrong and that gets counted
+                return self.fstRC
 
-        # retries exhausted
-        return self.fstRC
+            self.retryPolicy.recordError(key, self.fstRC)
+            if (attempt >= retries) or not self.retryPolicy.retryable(self.fstRC):
+                self.retryPolicy.recordFailure(key)
+                return self.fstRC
+
+            action = self.retryPolicy.action(attempt, self.fstRC)
+            self.log("*** %s (%d,%d) error %02X, retry %d: %s" % (what, self.cyl, self.head, self.fstRC, attempt + 1, action))
+            self._recover(action)
+            attempt += 1
+
+    def _recover(self, action):
+        fstRC = self.fstRC
+        if action == RETRY_RESEEK:
+            # if the head has wandered to another cylinder, go straight to recal
+            if (self.readID() == FRC_OK) and (ord(self.frb[3]) != self.cyl):
+                self.log(">>> recover: head is on cylinder %d, not %d" % (ord(self.frb[3]), self.cyl))
+                action = RETRY_RECAL
+            else:
+                # makes _start seek again
+                self.drive.track = 0xFE
+        if action == RETRY_RECAL:
+            self.drive.track = 0xFF
+        elif action == RETRY_STEPAWAY:
+            # come back to the track from a couple of cylinders away, toward the middle of the disk
+            cyl = self.cyl
+            if cyl < self.numCyl // 2:
+                self.cyl = cyl + 2
+            else:
+                self.cyl = cyl - 2
+            self._start()
+            self.cyl = cyl
+        self.fstRC = fstRC
+
+    def healthReport(self):
+        return self.retryPolicy.report()
+
+    def surfaceScan(self, fileName=None, retries=2):
+        # Read every sector and record how it went: the final status, the
+        # retries it took, and how many microseconds it took to come in.
+        # Tracks are read whole with the controller timing each sector;
+        # only tracks with errors are gone over sector by sector. Returns
+        # the report, and writes it to fileName as JSON if given.
+        tracks = []
+        for cyl in range(0, self.numCyl):
+            for head in range(0, self.numHead):
+                (statuses, tries, micros) = self._surfaceTrack(cyl, head, retries)
+                tracks.append({"cyl": cyl, "head": head, "status": statuses, "retries": tries, "micros": micros})
+
+        # The first sector of each track also waited for the disk to come
+        # around, so it's left out of the timing figures
+        counts = {}
+        times = []
+        retried = 0
+        for track in tracks:
+            for (i, status) in enumerate(track["status"]):
+                name = FRC_NAME.get(status, "%02X" % status)
+                counts[name] = counts.get(name, 0) + 1
+                if track["retries"][i]:
+                    retried += 1
+                if (i > 0) and (status == FRC_OK):
+                    times.append(track["micros"][i])
+
+        report = {"geometry": self._geometry(),
+                  "summary": {"sectors": sum(counts.values()),
+                              "status": counts,
+                              "retried": retried,
+                              "bad": sum(counts.values()) - counts.get("OK", 0),
+                              "microsMedian": times and _median(times) or None,
+                              "microsMax": times and max(times) or None},
+                  "tracks": tracks}
+        if fileName:
+            f = open(fileName, "w")
+            json.dump(report, f, sort_keys=True)
+            f.close()
+        return report
+
+    def _surfaceTrack(self, cyl, head, retries):
+        # (statuses, retries, micros) for the sectors of a track, in record order
+        # the whole track is a probe; what's wrong with it is counted below
+        self._setupXfer(cyl, head, self.sot, self.secCount)
+        self.timeExec = True
+        self.probing = True
+        try:
+            self._retry("read", 0, lambda: self._setupIO(CFD_READ | 0B11100000))
+        finally:
+            self.timeExec = False
+            self.probing = False
+        times = self.execTimes
+        if (self.fstRC == FRC_OK) and (len(times) > self.secCount):
+            return ([FRC_OK] * self.secCount, [0] * self.secCount,
+                    [(times[i + 1] - times[i]) & 0xFFFFFFFF for i in range(0, self.secCount)])
+
+        statuses = []
+        tries = []
+        micros = []
+        for record in range(self.sot, self.sot + self.secCount):
+            start = self.ext.micros()
+            self._setupXfer(cyl, head, record, 1)
+            self._retry("read", retries, lambda: self._setupIO(CFD_READ | 0B11100000))
+            micros.append((self.ext.micros() - start) & 0xFFFFFFFF)
+            statuses.append(self.fstRC)
+            tries.append(self.lastRetries)
+        return (statuses, tries, micros)
 
     def readID(self):
         self._setupCommand(CFD_READID | 0B01000000)
@@ -407,15 +1656,25 @@ class FDC:
     def _senseInt(self):
         self._setupCommand(CFD_SENSEINT)
         self.fcpLen = 1
-        return self._fop()       
-
-    def _specify(self, stepRate=None, headLoadTimeNonDma=None):
-        if stepRate:
-            self.stepRate = stepRate
-        if headLoadTimeNonDma:
-            self.headLoadTimeNonDma = headLoadTimeNonDma
-        self._setupSpecify()
-        return self._fop()
+        self._fop()
+        if self.fstRC == FRC_DSKCHG:
+            self._diskChanged(ord(self.frb[0]) & 0x03)
+        return self.fstRC
+
+    def _specify(self):
+        timing = self._timing()
+        self._setupSpecify(*timing)
+        if self._fop() == FRC_OK:
+            self.specified = timing
+        return self.fstRC
+
+    def _timing(self):
+        # (stepRate, headLoadTimeNonDma) for SPECIFY: what calibrate() found
+        # for this drive and media, or else the media's defaults
+        entry = self.drive.profile.get(self.mediaName)
+        if entry and (entry["DCR"] == self.DCR):
+            return (entry["stepRate"], entry["headLoadTimeNonDma"])
+        return (self.stepRate, self.headLoadTimeNonDma)
 
     def _seek(self):
         self._setupSeek()
@@ -430,21 +1689,29 @@ class FDC:
 
         self._motorOn()
 
-        if self.track == 0xFF:
+        drive = self.drive
+        if drive.track == 0xFF:
             self.log(">>> start:driveReset")
             self._driveReset()
             if self.fstRC != FRC_OK:
                 return self.fstRC
+            drive.track = 0
+
+        if self.specified != self._timing():
+            # SPECIFY is for the whole controller; the other drive's media may have needed different timing
+            self._specify()
+            if self.fstRC != FRC_OK:
+                return self.fstRC
 
-        if self.track != self.cyl:
-            self.log(">>> start:seek (%d,%d)" % (self.track, self.cyl))
+        if drive.track != self.cyl:
+            self.log(">>> start:seek (%d,%d)" % (drive.track, self.cyl))
             self._seek()
             if self.fstRC != FRC_OK:
                 return self.fstRC
             self._waitSeek()
             if self.fstRC != FRC_OK:
                 return self.fstRC
-            self.track = self.cyl
+            drive.track = self.cyl
 
         self.fstRC = FRC_OK
         return self.fstRC
@@ -476,17 +1743,48 @@ class FDC:
         # DOR bit 4 is motor enable for ds0
         # DOR bit 5 is motor enable for ds1
         motorMask = (1 << (self.ds+4))
+        wasOn = (self.dor & motorMask) != 0
         self.writeDOR(self.dor & 0B11111100 | self.ds | motorMask)
         self.writeDCR(self.DCR)
+        self.motor.touch()
 
-        if (self.dor & motorMask)==0:
+        if (not wasOn) or self.drive.spinningUp:
             self.log(">>> motor delay")
-            # motor delay
-            time.sleep(1)
+            self._waitSpinUp()
+            self.drive.spinningUp = False
+
+    def _waitSpinUp(self):
+        # The drive is up to speed once it reports ready and an ID field can
+        # be read. Blank or unreadable media never get there, and wait the
+        # full spinUpTime. Time is kept on the backend's clock, which also
+        # counts the READ IDs that fail while the disk is still slow.
+        start = self.ext.micros()
+        while ((self.ext.micros() - start) & 0xFFFFFFFF) < self.spinUpTime * 1000000:
+            if self._driveReady() and (self.readID() == FRC_OK):
+                self.log(">>> motor ready")
+                return
+            self.ext.delay_microseconds(50000)
+
+    def _driveReady(self):
+        self._setupCommand(CFD_DRVSTAT)
+        if (self._fop() != FRC_OK) or (self.frbLen < 1):
+            return False
+        # ST3 bit 5 is ready
+        return (ord(self.frb[0]) & 0x20) != 0
+
+    def motorIsOn(self, ds=None):
+        if ds is None:
+            ds = self.ds
+        return (self.dor & (1 << (ds+4))) != 0
+
+    def anyMotorOn(self):
+        return (self.dor & 0B00110000) != 0
 
     def _motorOff(self):
         self.dor = self.DOR_INIT
         self.writeDOR(self.dor)
+        for drive in self.drives:
+            drive.spinningUp = False
 
     def _clearDiskChange(self):
         for i in range(0, 5):
@@ -506,10 +1804,10 @@ class FDC:
         self.fcpBuf[2] = self.cyl
         self.fcpLen = 3
 
-    def _setupSpecify(self):
+    def _setupSpecify(self, stepRate, headLoadTimeNonDma):
         self._setupCommand(CFD_SPECIFY)
-        self.fcpBuf[1] = self.stepRate
-        self.fcpBuf[2] = self.headLoadTimeNonDma
+        self.fcpBuf[1] = stepRate
+        self.fcpBuf[2] = headLoadTimeNonDma
         self.fcpLen = 3
 
     def _setupIO(self, cmd):
@@ -523,6 +1821,10 @@ class FDC:
         self.fcpBuf[8] = self.gapLengthFormat
         self.fcpLen = 9
 
+    def _setupScan(self, cmd):
+        self._setupIO(cmd | 0B01100000)
+        self.fcpBuf[8] = 1   # STP, scan every sector
+
     def _setupFormat(self, cmd):
         self._setupCommand(cmd)
         self.fcpBuf[2] = self.N  # sector size, 2 = 512 bytes
@@ -532,72 +1834,86 @@ class FDC:
         self.fcpLen = 6
 
     def _cfdName(self, x):
-        x = x & 0B1111
+        x = x & 0B11111
         return CFD_NAME.get(x, "UNKNOWN")
 
     def _fop(self):
-        try:
-            fcpBytes = []
-            for i in range(0, self.fcpLen):
-                fcpBytes.append("%02X" % self.fcpBuf[i])
-
-            self.log("FOP <%s> %s ->" % (self._cfdName(self.fcpBuf[0]), (" ".join(fcpBytes))), newline=False)
-
-            result = self._fop_internal()
+        with self.lock:
+            self.motor.touch()
+            return self._fop_locked()
 
-            frbBytes = []
-            for i in range(0, self.frbLen):
-                frbBytes.append("%02X" % ord(self.frb[i]))
-            self.log("-> [result %02X] %s" % (result, (" ".join(frbBytes))))
-            return result
+    def _fop_locked(self):
+        self.fcpStr = "".join([chr(x) for x in self.fcpBuf[:self.fcpLen]])
+        start = self.ext.micros()
+        try:
+            self._fop_internal()
         except FDCException, e:
             print("Exception in _Fop %s, code %2X" % (e, e.fstRC), file=sys.stderr)
             self.fstRC = e.fstRC
-            return self.fstRC
+
+        entry = (self.fcpStr, self.fstRC, self.frb, (self.ext.micros() - start) & 0xFFFFFFFF)
+        if self.trace is not None:
+            self.trace.record(*entry)
+        if self.verbose:
+            self.log(_fopString(entry))
+        return self.fstRC
 
     def _fop_internal(self):
         self.frbLen = 0
         self.fstRC = FRC_OK
+        self.frb = ""
 
-        self.drain()
+        # what, if anything, happens in the execution phase
 
-        time.sleep(0.001)
+        execData = ""
+        execCount = 0
+        if (self.fcpCmd == CFD_READ) or (self.fcpCmd == CFD_READTRK):
+            execKind = EXEC_READ
+            execCount = self.secSize * self.secXfer
+        elif (self.fcpCmd == CFD_WRITE):
+            execKind = EXEC_WRITE
+            execData = self.dskBuf
+            execCount = self.secSize * self.secXfer
+        elif (self.fcpCmd == CFD_FMTTRK):
+            execKind = EXEC_WRITE
+            execData = self.dskBuf
+            execCount = 4 * self.secCount
+        elif (self.fcpCmd == CFD_READID):
+            execKind = EXEC_READID
+        elif (self.fcpCmd in [CFD_SCANEQ, CFD_SCANLOEQ, CFD_SCANHIEQ]):
+            execKind = EXEC_SCAN
+            execData = self.scanBuf
+            execCount = self.secSize * self.secXfer
+        else:
+            execKind = EXEC_NONE
 
-        if (self.get_msr() & 0x90) == 0x90:
+        fcpStr = self.fcpStr
+
+        # drain, command, execution, and result phases all happen in one call
+        if self.timeExec and (execKind in [EXEC_READ, EXEC_READID]):
+            status, blk, frb, self.execTimes = self.ext.execute_timed(fcpStr, execKind, execCount, self.secSize)
+        elif (execKind == EXEC_READ) and (self.readInto is not None):
+            (buf, offset) = self.readInto
+            status, frb = self.ext.execute_into(fcpStr, execKind, buf, offset, execCount)
+            blk = None
+        else:
+            status, blk, frb = self.ext.execute(fcpStr, execKind, execData, execCount)
+
+        if status == FRC_INPROGRESS:
             # Idiot-Check, this should never happen.
             print("Holy Corrupted Floppy Drivers, Batman! We're in the middle of a read or write already!\n", file=sys.stderr)
             self.fdcReady = False;
             self.fstRC = FRC_INPROGRESS
             return self.fstRC
 
-        for i in range(0, self.fcpLen):
-            # DIO=0 and RQM=1 indicate byte is ready to write
-            self.fstRC = self.wait_msr(0xC0, 0x80)
-            if (self.fstRC!=0):
-                self.log("Sendcommand error in wait_msr %02X" % self.fstRC)
-                return self.fstRC
-            self.writeData(self.fcpBuf[i])
-
-        #fcpStr = ""
-        #for i in range(0, self.fcpLen):
-        #    fcpStr = fcpStr + chr(self.fcpBuf[i])
-        #wd37c65_direct_ext.write_command(fcpStr, self.fcpLen)
-
-        # execution phase
+        if status != FRC_OK:
+            raise FDCException(status)
 
-        if (self.fcpCmd == CFD_READ):
-            self.readDataBlock(self.secSize)
-        elif (self.fcpCmd == CFD_WRITE):
-            self.writeDataBlock(self.secSize)
-        elif (self.fcpCmd == CFD_FMTTRK):
-            self.writeDataBlock(4 * self.secCount)
-        elif (self.fcpCmd == CFD_READID):
-            self.waitMSR(0xE0, 0xC0)
-        else:
-            pass  # null
+        if blk is not None and (execKind == EXEC_READ):
+            self.dskBuf = blk
 
-        self.frb = ""
-        self.readResult()
+        self.frb = frb
+        self.frbLen = len(self.frb)
 
         if (self.fcpCmd == CFD_DRVSTAT):
             # driveState has nothing to evaluate
@@ -616,19 +1932,22 @@ class FDC:
 
             # evalst1
             st1 = ord(self.frb[1])
-            if (st1 & 80) == 0x80:
+            if (st1 & 0x80) == 0x80:
                 self.fstRC = FRC_ENDCYL
             elif (st1 & 0x20) == 0x20:
                 self.fstRC = FRC_DATAERR
             elif (st1 & 0x10) == 0x10:
                 self.fstRC = FRC_OVERRUN
-            elif (st1 & 0x04) == 0x08:
+            elif (st1 & 0x04) == 0x04:
                 self.fstRC = FRC_NODATA
-            elif (st1 & 0x02) == 0x04:
-                self.fstRC = FRC_NOWRIT
+            elif (st1 & 0x02) == 0x02:
+                self.fstRC = FRC_NOTWRIT
             elif (st1 & 0x01) == 0x01:
                 self.fstRC = FRC_MISADR
-            
+            else:
+                # not ready, or something ST1 doesn't cover
+                self.fstRC = FRC_ABTERM
+
             return self.fstRC
         elif (st0 & 0B11000000) == 0B10000000:
             # INVCMD
@@ -647,13 +1966,167 @@ class FDC:
         loopCount = 0x1000
         while (loopCount>0):
             self._senseInt()
-            if self.fstRC == FRC_ABTERM:
+            if (self.fstRC in [FRC_ABTERM, FRC_OK]) and (self.frbLen < 2):
+                # SENSE INTERRUPT always gives back ST0 and PCN
+                raise FDCException(FRC_SHORT, "SENSE INTERRUPT returned %d bytes" % self.frbLen)
+            if (self.fstRC in [FRC_ABTERM, FRC_OK]) and ((ord(self.frb[0]) & 0x03) != self.ds):
+                # somebody else's interrupt; that drive's position is anybody's guess now
+                ds = ord(self.frb[0]) & 0x03
+                if ds < NUM_DRIVES:
+                    self.drives[ds].track = 0xFF
+            elif self.fstRC == FRC_ABTERM:
                 # seek error
                 return self.fstRC
             elif self.fstRC == FRC_OK:
                 return self.fstRC
+            else:
+                # still seeking; 0x1000 of these is about 4 seconds
+                self.ext.delay_microseconds(1000)
             loopCount -= 1
 
         self.fstRC = FRC_TOSEEKWT
         return self.fstRC
 
+
+def duplicate(fdc, args):
+    master = fdc.readMaster(args.retries)
+    print("master read, %d tracks" % len(master), file=sys.stderr)
+
+    target = args.drive if args.target is None else args.target
+    copy = 0
+    while (args.copies == 0) or (copy < args.copies):
+        copy += 1
+        print("insert disk %d in drive %d and press enter" % (copy, target), file=sys.stderr)
+        try:
+            raw_input()
+        except EOFError:
+            break
+        fdc.select(target)
+        stats = fdc.writeCopy(master, args.formatMode, args.verify, args.retries)
+        print("disk %d: %d formatted, %d written, %d skipped, %d rewritten, %d bad tracks" % \
+              (copy, stats["formatted"], stats["written"], stats["skipped"], stats["rewritten"], len(stats["badTracks"])),
+              file=sys.stderr)
+        fdc.select(args.drive)
+
+def surface(fdc, args):
+    # Scan the disk in the drive, then as many more as the operator feeds in
+    disk = 1
+    while True:
+        fileName = args.filename
+        if "%" in fileName:
+            fileName = fileName % disk
+        summary = fdc.surfaceScan(fileName, args.retries)["summary"]
+        print("disk %d: %d sectors, %d bad, %d needed retries, median %s us, max %s us -> %s" % \
+              (disk, summary["sectors"], summary["bad"], summary["retried"], summary["microsMedian"], summary["microsMax"], fileName),
+              file=sys.stderr)
+
+        disk += 1
+        if (args.disks != 0) and (disk > args.disks):
+            break
+        print("insert disk %d and press enter" % disk, file=sys.stderr)
+        try:
+            raw_input()
+        except EOFError:
+            break
+        if args.media == "auto":
+            fdc.detectMedia()
+
+def main():
+    parser = argparse.ArgumentParser(description="WD37C65 floppy tool")
+    parser.add_argument("--media", default="144", help="media type: 144, 720, 360, 120, 111, 9836, or auto")
+    parser.add_argument("--drive", type=int, default=0, help="drive select, 0 or 1")
+    parser.add_argument("--verbose", "-v", action="store_true", default=False)
+    parser.add_argument("--emulate", default=None, metavar="IMAGE", help="use an emulated controller with a disk made from IMAGE")
+    parser.add_argument("--profile", default=None, help="drive profile from calibrate, loaded if it exists")
+    parser.add_argument("--trace", action="store_true", default=False, help="dump the last operations and per-command timing at the end")
+    subparsers = parser.add_subparsers(dest="command")
+
+    image_parser = subparsers.add_parser("image", help="image a disk to a file")
+    image_parser.add_argument("filename")
+    image_parser.add_argument("--retries", type=int, default=2)
+    image_parser.add_argument("--map", dest="mapFileName", default=None, help="bad sector map (default: <filename>.map)")
+
+    dup_parser = subparsers.add_parser("duplicate", help="read a master disk once, then write copies of it")
+    dup_parser.add_argument("--target", type=int, default=None, help="drive for the copies (default: the master's drive)")
+    dup_parser.add_argument("--copies", type=int, default=0, help="number of copies (default: until end of input)")
+    dup_parser.add_argument("--format", dest="formatMode", choices=["auto", "always", "never"], default="auto")
+    dup_parser.add_argument("--no-verify", dest="verify", action="store_false", default=True)
+    dup_parser.add_argument("--retries", type=int, default=2)
+
+    scan_parser = subparsers.add_parser("scan", help="search the disk for a pattern on the controller")
+    scan_parser.add_argument("pattern", help="pattern in hex, FF matches anything")
+    scan_parser.add_argument("--mode", choices=sorted(SCAN_MODES.keys()), default="eq")
+    scan_parser.add_argument("--offset", type=int, default=0, help="offset of the pattern in each sector")
+    scan_parser.add_argument("--retries", type=int, default=2)
+
+    surface_parser = subparsers.add_parser("surface", help="read every sector and write a JSON heatmap of status, retries, and timing")
+    surface_parser.add_argument("filename", help="report file; a %%d in it is replaced with the disk number")
+    surface_parser.add_argument("--disks", type=int, default=1, help="number of disks to scan (0: until end of input)")
+    surface_parser.add_argument("--retries", type=int, default=2)
+
+    restore_parser = subparsers.add_parser("restore", help="write an image to the disk, only where the disk differs")
+    restore_parser.add_argument("filename")
+    restore_parser.add_argument("--format", dest="formatMode", choices=["auto", "always", "never"], default="auto")
+    restore_parser.add_argument("--no-verify", dest="verify", action="store_false", default=True)
+    restore_parser.add_argument("--retries", type=int, default=2)
+
+    cal_parser = subparsers.add_parser("calibrate", help="time the drive and find its fastest step rate; saved to --profile")
+    cal_parser.add_argument("--trials", type=int, default=3)
+    cal_parser.add_argument("--margin", type=int, default=1, help="step rate settings to back off from the fastest that worked")
+
+    args = parser.parse_args()
+
+    backend = None
+    if args.emulate:
+        from wd37c65_emul import WD37C65Emulator, emulatedDisk, imageMedia
+        if os.path.exists(args.emulate):
+            disk = emulatedDisk(imageMedia(args.emulate) if args.media == "auto" else args.media, args.emulate)
+        else:
+            disk = emulatedDisk("144" if args.media == "auto" else args.media)
+        backend = WD37C65Emulator(disks=[None] * args.drive + [disk])
+
+    fdc = FDC(media="144" if args.media == "auto" else args.media, verbose=args.verbose, backend=backend)
+    fdc.init()
+    fdc.select(args.drive)
+    if args.profile and os.path.exists(args.profile):
+        fdc.loadProfile(args.profile)
+    try:
+        if args.media == "auto":
+            print("media: %s" % fdc.detectMedia(), file=sys.stderr)
+        if args.command == "image":
+            badCount = fdc.imageDisk(args.filename, retries=args.retries, mapFileName=args.mapFileName)
+            if badCount:
+                print("%d bad sectors, see %s" % (badCount, args.mapFileName or args.filename + ".map"), file=sys.stderr)
+                sys.exit(1)
+        elif args.command == "duplicate":
+            duplicate(fdc, args)
+        elif args.command == "scan":
+            result = fdc.scan(args.pattern.decode("hex"), args.mode, offset=args.offset, retries=args.retries)
+            for (cyl, head, record) in result["matches"]:
+                print("%d %d %d" % (cyl, head, record))
+            if result["bad"] or result["badTracks"]:
+                print("%d bad sectors and %d bad tracks not scanned" % (len(result["bad"]), len(result["badTracks"])), file=sys.stderr)
+                sys.exit(1)
+        elif args.command == "restore":
+            stats = fdc.restoreImage(args.filename, args.formatMode, args.verify, args.retries)
+            print("%d formatted, %d of %d written, %d skipped, %d rewritten, %d bad tracks" % \
+                  (stats["formatted"], stats["written"], stats["differing"], stats["skipped"], stats["rewritten"], len(stats["badTracks"])),
+                  file=sys.stderr)
+            if stats["badTracks"] or (stats["written"] < stats["differing"]):
+                sys.exit(1)
+        elif args.command == "surface":
+            surface(fdc, args)
+        elif args.command == "calibrate":
+            entry = fdc.calibrate(args.trials, args.margin, args.profile)
+            print(json.dumps(entry, indent=2, sort_keys=True))
+    finally:
+        fdc.done(now=True)
+        if args.trace:
+            fdc.trace.dump()
+            print(json.dumps(fdc.trace.report(), indent=2, sort_keys=True), file=sys.stderr)
+        if args.emulate and disk.dirty:
+            open(args.emulate, "wb").write(disk.image())
+
+
+if __name__ == "__main__":
+    main()
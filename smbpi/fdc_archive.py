@@ -0,0 +1,285 @@
+# Archival imaging for FDC
+# Scott Baker, https://www.smbaker.com/
+#
+# Images a disk straight into a compressed, hashed archive in one pass. The
+# calling thread does nothing but read tracks; each track is handed to a
+# process pool that hashes and compresses it, and a writer thread appends
+# the results to the archive in order. The drive never waits on the CPU, so
+# archiving a disk takes as long as reading it.
+#
+#     stats = archiveDisk(fdc, "disk.fda")
+#     extractArchive("disk.fda", "disk.img")
+#
+# An archive is:
+#
+#     "SMBFDARC", u32 length, JSON header (geometry)
+#     per track, in the order read:
+#         "TRAK", u8 cyl, u8 head, u32 raw length, u32 packed length,
+#         one FDC status byte per sector (0 = read fine, else zero-filled),
+#         sha256 of the raw track, zlib compressed track
+#     "DONE", u32 length, JSON trailer (sha256 of the whole flat image,
+#         bad sector list)
+#
+# Integers are big endian. The whole image hash is of the tracks in flat
+# image order, so it matches a hash of the image file imageDisk() writes.
+
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import multiprocessing
+import Queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from fdc import FDC, FRC_OK
+
+ARCHIVE_MAGIC = "SMBFDARC"
+ARCHIVE_VERSION = 1
+TRACK_MAGIC = "TRAK"
+TRAILER_MAGIC = "DONE"
+TRACK_HEADER = ">4sBBII"
+
+class ArchiveException(Exception):
+    pass
+
+def _packTrack(data, level):
+    # runs in the worker processes
+    return (hashlib.sha256(data).digest(), zlib.compress(data, level))
+
+def _trackOrder(numCyl, numHead):
+    # the order imageDisk reads in: cylinders ascending, alternating head order
+    tracks = []
+    for cyl in range(0, numCyl):
+        heads = range(0, numHead)
+        if (cyl % 2) == 1:
+            heads.reverse()
+        tracks.extend([(cyl, head) for head in heads])
+    return tracks
+
+
+# Appends packed tracks to the archive as the pool finishes them, and hashes
+# the raw tracks in flat image order
+class ArchiveWriter(threading.Thread):
+    def __init__(self, f, numCyl, numHead):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.f = f
+        self.queue = Queue.Queue()
+        self.imageOrder = [(cyl, head) for cyl in range(0, numCyl) for head in range(0, numHead)]
+        self.diskHash = hashlib.sha256()
+        self.pending = {}
+        self.hashed = 0
+        self.packedBytes = 0
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                (cyl, head, statuses, data, packing) = item
+                (digest, packed) = packing.get()
+                self.f.write(struct.pack(TRACK_HEADER, TRACK_MAGIC, cyl, head, len(data), len(packed)))
+                self.f.write("".join([chr(x) for x in statuses]))
+                self.f.write(digest)
+                self.f.write(packed)
+                self.packedBytes += len(packed)
+
+                self.pending[(cyl, head)] = data
+                while (self.hashed < len(self.imageOrder)) and (self.imageOrder[self.hashed] in self.pending):
+                    self.diskHash.update(self.pending.pop(self.imageOrder[self.hashed]))
+                    self.hashed += 1
+        except Exception, e:
+            self.error = e
+
+
+def archiveDisk(fdc, fileName, retries=2, workers=None, level=9):
+    # Image the disk in fdc into an archive. Returns a dict of statistics,
+    # including the whole image hash and the bad sectors.
+    start = time.time()
+    header = {"version": ARCHIVE_VERSION,
+              "media": fdc.mediaName,
+              "numCyl": fdc.numCyl,
+              "numHead": fdc.numHead,
+              "sot": fdc.sot,
+              "secCount": fdc.secCount,
+              "secSize": fdc.secSize}
+
+    # start the workers before reading anything, so they're forked from a
+    # process that isn't in the middle of talking to the controller
+    pool = multiprocessing.Pool(workers)
+    f = open(fileName, "wb")
+    writer = ArchiveWriter(f, fdc.numCyl, fdc.numHead)
+    bad = []
+    try:
+        headerJson = json.dumps(header, sort_keys=True)
+        f.write(ARCHIVE_MAGIC + struct.pack(">I", len(headerJson)) + headerJson)
+        writer.start()
+
+        buf = bytearray(fdc.secCount * fdc.secSize)
+        for (cyl, head) in _trackOrder(fdc.numCyl, fdc.numHead):
+            statuses = fdc.readTrackSectors(buf, cyl, head, retries)
+            data = str(buf)
+            for (i, status) in enumerate(statuses):
+                if status != FRC_OK:
+                    bad.append([cyl, head, fdc.sot + i, status])
+            writer.queue.put((cyl, head, statuses, data, pool.apply_async(_packTrack, (data, level))))
+            if writer.error is not None:
+                break
+        readTime = time.time() - start
+
+        writer.queue.put(None)
+        writer.join()
+        if writer.error is not None:
+            raise writer.error
+
+        trailer = {"sha256": writer.diskHash.hexdigest(),
+                   "tracks": fdc.numCyl * fdc.numHead,
+                   "bad": sorted(bad)}
+        trailerJson = json.dumps(trailer, sort_keys=True)
+        f.write(TRAILER_MAGIC + struct.pack(">I", len(trailerJson)) + trailerJson)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        f.close()
+        pool.join()
+
+    return {"sha256": trailer["sha256"],
+            "bad": trailer["bad"],
+            "readTime": readTime,
+            "totalTime": time.time() - start,
+            "rawBytes": fdc.numCyl * fdc.numHead * fdc.secCount * fdc.secSize,
+            "packedBytes": writer.packedBytes}
+
+
+def loadArchive(fileName):
+    # Read and check an archive. Returns (header, tracks, trailer), where
+    # tracks maps (cyl, head) to (statuses, data). Raises ArchiveException
+    # if it's damaged or a hash doesn't match.
+    f = open(fileName, "rb")
+    try:
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ArchiveException("%s is not a disk archive" % fileName)
+        header = json.loads(_readChunk(f))
+        if header["version"] != ARCHIVE_VERSION:
+            raise ArchiveException("Archive version %d isn't supported" % header["version"])
+
+        headerSize = struct.calcsize(TRACK_HEADER)
+        tracks = {}
+        while True:
+            magic = f.read(4)
+            if magic == TRAILER_MAGIC:
+                trailer = json.loads(_readChunk(f))
+                break
+            f.seek(-len(magic), 1)
+            (magic, cyl, head, rawLen, packedLen) = struct.unpack(TRACK_HEADER, _readExactly(f, headerSize))
+            if magic != TRACK_MAGIC:
+                raise ArchiveException("Damaged archive at offset %d" % (f.tell() - headerSize))
+            statuses = [ord(x) for x in _readExactly(f, header["secCount"])]
+            digest = _readExactly(f, 32)
+            try:
+                data = zlib.decompress(_readExactly(f, packedLen))
+            except zlib.error:
+                data = None
+            if (data is None) or (len(data) != rawLen) or (hashlib.sha256(data).digest() != digest):
+                raise ArchiveException("Track %d/%d doesn't match its hash" % (cyl, head))
+            tracks[(cyl, head)] = (statuses, data)
+    finally:
+        f.close()
+
+    diskHash = hashlib.sha256()
+    for cyl in range(0, header["numCyl"]):
+        for head in range(0, header["numHead"]):
+            if (cyl, head) not in tracks:
+                raise ArchiveException("Track %d/%d is missing" % (cyl, head))
+            diskHash.update(tracks[(cyl, head)][1])
+    if diskHash.hexdigest() != trailer["sha256"]:
+        raise ArchiveException("Image doesn't match its hash")
+
+    return (header, tracks, trailer)
+
+def extractArchive(fileName, imageName):
+    # Write an archive out as a flat image, like imageDisk() makes. Returns
+    # the trailer, which has the bad sectors.
+    (header, tracks, trailer) = loadArchive(fileName)
+    f = open(imageName, "wb")
+    try:
+        for cyl in range(0, header["numCyl"]):
+            for head in range(0, header["numHead"]):
+                f.write(tracks[(cyl, head)][1])
+    finally:
+        f.close()
+    return trailer
+
+def _readExactly(f, count):
+    data = f.read(count)
+    if len(data) != count:
+        raise ArchiveException("Archive is truncated")
+    return data
+
+def _readChunk(f):
+    (length,) = struct.unpack(">I", _readExactly(f, 4))
+    return _readExactly(f, length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Floppy archiver")
+    parser.add_argument("--media", default="auto", help="media type: 144, 720, 360, 120, 111, or auto")
+    parser.add_argument("--drive", type=int, default=0, help="drive select, 0 or 1")
+    parser.add_argument("--emulate", default=None, metavar="IMAGE", help="use an emulated controller with a disk made from IMAGE")
+    subparsers = parser.add_subparsers(dest="command")
+
+    archive_parser = subparsers.add_parser("archive", help="image the disk into an archive")
+    archive_parser.add_argument("filename")
+    archive_parser.add_argument("--retries", type=int, default=2)
+    archive_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    archive_parser.add_argument("--level", type=int, default=9, help="zlib compression level")
+
+    extract_parser = subparsers.add_parser("extract", help="check an archive and write it out as a flat image")
+    extract_parser.add_argument("filename")
+    extract_parser.add_argument("image")
+
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        try:
+            trailer = extractArchive(args.filename, args.image)
+        except ArchiveException, e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print("sha256 %s, %d bad sectors" % (trailer["sha256"], len(trailer["bad"])), file=sys.stderr)
+        return
+
+    backend = None
+    if args.emulate:
+        from wd37c65_emul import WD37C65Emulator, emulatedDisk, imageMedia
+        disk = emulatedDisk(imageMedia(args.emulate) if args.media == "auto" else args.media, args.emulate)
+        backend = WD37C65Emulator(disks=[None] * args.drive + [disk])
+
+    fdc = FDC(media="144" if args.media == "auto" else args.media, verbose=False, backend=backend)
+    fdc.init()
+    fdc.select(args.drive)
+    try:
+        if args.media == "auto":
+            print("media: %s" % fdc.detectMedia(), file=sys.stderr)
+        stats = archiveDisk(fdc, args.filename, args.retries, args.workers, args.level)
+    finally:
+        fdc.done(now=True)
+
+    print("sha256 %s" % stats["sha256"], file=sys.stderr)
+    print("%d bytes packed into %d, read in %0.1fs, done in %0.1fs" % \
+          (stats["rawBytes"], stats["packedBytes"], stats["readTime"], stats["totalTime"]), file=sys.stderr)
+    if stats["bad"]:
+        print("%d bad sectors" % len(stats["bad"]), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
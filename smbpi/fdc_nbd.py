@@ -0,0 +1,353 @@
+# NBD (network block device) server for FDC
+# Scott Baker, https://www.smbaker.com/
+#
+# Serves the floppy in an FDC as a block device, so it can be attached with
+# the standard Linux tools and mounted:
+#
+#     python -m smbpi.fdc_nbd --media 144 --socket /tmp/floppy.sock
+#     nbd-client -unix /tmp/floppy.sock /dev/nbd0 -b 512
+#     mount /dev/nbd0 /mnt/floppy
+#
+# Reads are always whole tracks and go through a track cache, so the
+# kernel's read-ahead turns into a few track reads instead of one command
+# per block. Writes land in the cache and are only written out on
+# NBD_CMD_FLUSH, on disconnect, or when a dirty track is pushed out of the
+# cache. Only the fixed newstyle handshake is implemented.
+
+from __future__ import print_function
+import argparse
+import collections
+import errno
+import os
+import socket
+import struct
+import sys
+
+from fdc import FDC, FDCException, FRC_OK
+
+NBD_MAGIC = "NBDMAGIC"
+NBD_OPTS_MAGIC = 0x49484156454F5054   # "IHAVEOPT"
+NBD_REP_MAGIC = 0x3E889045565A9
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+
+NBD_FLAG_FIXED_NEWSTYLE = 0x01
+NBD_FLAG_NO_ZEROES = 0x02
+
+NBD_FLAG_HAS_FLAGS = 0x01
+NBD_FLAG_READ_ONLY = 0x02
+NBD_FLAG_SEND_FLUSH = 0x04
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = 0x80000001
+
+NBD_INFO_EXPORT = 0
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+
+class NBDException(Exception):
+    pass
+
+
+# LRU cache of whole tracks, keyed by (cyl, head), that holds on to writes
+# until flush(). Tracks are bytearrays so a write only touches its sectors.
+class WriteBackCache:
+    def __init__(self, fdc, capacity, retries=2):
+        if capacity < 1:
+            # _insert would throw out the track it had just put in
+            raise NBDException("The cache needs room for at least one track")
+        self.fdc = fdc
+        self.capacity = capacity
+        self.retries = retries
+        self.tracks = collections.OrderedDict()
+        self.dirty = set()
+        self.changeCount = fdc.changeCount
+        self.hits = 0
+        self.misses = 0
+        self.trackReads = 0
+        self.trackWrites = 0
+
+    def trackSize(self):
+        return self.fdc.secCount * self.fdc.secSize
+
+    def size(self):
+        return self.fdc.numCyl * self.fdc.numHead * self.trackSize()
+
+    def read(self, offset, length):
+        parts = []
+        for (key, start, count) in self._split(offset, length):
+            parts.append(str(self._track(key)[start:start+count]))
+        return "".join(parts)
+
+    def write(self, offset, data):
+        pos = 0
+        for (key, start, count) in self._split(offset, len(data)):
+            if count == self.trackSize():
+                # the whole track is being replaced; no need to read it
+                track = self._insert(key, bytearray(data[pos:pos+count]))
+            else:
+                track = self._track(key)
+                track[start:start+count] = data[pos:pos+count]
+            self.dirty.add(key)
+            pos += count
+
+    def flush(self):
+        # write the dirty tracks in one sweep across the disk
+        self._checkDiskChange()
+        for key in sorted(self.dirty):
+            self._writeBack(key)
+
+    def invalidate(self):
+        self.tracks.clear()
+        self.dirty.clear()
+
+    def _split(self, offset, length):
+        # (track key, offset in track, byte count) for each track the range covers
+        trackSize = self.trackSize()
+        pieces = []
+        while length > 0:
+            t = offset // trackSize
+            start = offset % trackSize
+            count = min(length, trackSize - start)
+            pieces.append(((t // self.fdc.numHead, t % self.fdc.numHead), start, count))
+            offset += count
+            length -= count
+        return pieces
+
+    def _track(self, key):
+        self._checkDiskChange()
+        track = self.tracks.pop(key, None)
+        if track is not None:
+            self.tracks[key] = track
+            self.hits += 1
+            return track
+
+        self.misses += 1
+        self.trackReads += 1
+        (cyl, head) = key
+        if self.fdc.readTrack(cyl, head, self.retries) != FRC_OK:
+            raise FDCException(self.fdc.fstRC, "Can't read cyl %d head %d" % (cyl, head))
+        return self._insert(key, bytearray(self.fdc.dskBuf))
+
+    def _insert(self, key, track):
+        self._checkDiskChange()
+        self.tracks.pop(key, None)
+        self.tracks[key] = track
+        while len(self.tracks) > self.capacity:
+            oldest = next(iter(self.tracks))
+            if oldest in self.dirty:
+                self._writeBack(oldest)
+            del self.tracks[oldest]
+        return track
+
+    def _writeBack(self, key):
+        (cyl, head) = key
+        self.trackWrites += 1
+        if self.fdc.writeTrack(cyl, head, self.tracks[key], self.retries) != FRC_OK:
+            raise FDCException(self.fdc.fstRC, "Can't write cyl %d head %d" % (cyl, head))
+        self.dirty.discard(key)
+
+    def _checkDiskChange(self):
+        if self.changeCount == self.fdc.changeCount:
+            return
+        self.changeCount = self.fdc.changeCount
+        lost = len(self.dirty)
+        self.invalidate()
+        if lost:
+            raise NBDException("Disk changed with %d unwritten tracks" % lost)
+
+
+class NBDServer:
+    def __init__(self, fdc, cacheTracks=36, readOnly=False, retries=2, verbose=False):
+        self.fdc = fdc
+        self.cache = WriteBackCache(fdc, cacheTracks, retries)
+        self.readOnly = readOnly
+        self.verbose = verbose
+
+    def log(self, x):
+        if self.verbose:
+            print(x, file=sys.stderr)
+
+    def serve(self, listener):
+        # Serve clients on an already listening socket, one at a time. The
+        # floppy is a single device, so there's nothing to gain from more.
+        while True:
+            (conn, addr) = listener.accept()
+            self.log("connection from %s" % (addr or "unix socket"))
+            try:
+                self.handle(conn)
+            except (socket.error, NBDException), e:
+                self.log("connection dropped: %s" % e)
+            finally:
+                conn.close()
+                self._flush()
+
+    def handle(self, conn):
+        if self._negotiate(conn):
+            self._transmit(conn)
+
+    def _negotiate(self, conn):
+        # Returns True if the client picked the export, False if it gave up
+        conn.sendall(NBD_MAGIC + struct.pack(">QH", NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        (clientFlags,) = struct.unpack(">I", _recvAll(conn, 4))
+        noZeroes = (clientFlags & NBD_FLAG_NO_ZEROES) != 0
+
+        while True:
+            (magic, option, length) = struct.unpack(">QII", _recvAll(conn, 16))
+            if magic != NBD_OPTS_MAGIC:
+                raise NBDException("Bad option magic %X" % magic)
+            _recvAll(conn, length)
+
+            if option == NBD_OPT_EXPORT_NAME:
+                # there's only one export, whatever the name
+                reply = struct.pack(">QH", self.cache.size(), self._transmissionFlags())
+                if not noZeroes:
+                    reply += "\0" * 124
+                conn.sendall(reply)
+                return True
+            elif option in [NBD_OPT_INFO, NBD_OPT_GO]:
+                info = struct.pack(">HQH", NBD_INFO_EXPORT, self.cache.size(), self._transmissionFlags())
+                self._optReply(conn, option, NBD_REP_INFO, info)
+                self._optReply(conn, option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return True
+            elif option == NBD_OPT_ABORT:
+                self._optReply(conn, option, NBD_REP_ACK)
+                return False
+            else:
+                self._optReply(conn, option, NBD_REP_ERR_UNSUP)
+
+    def _transmit(self, conn):
+        while True:
+            (magic, flags, cmd, handle, offset, length) = struct.unpack(">IHHQQI", _recvAll(conn, 28))
+            if magic != NBD_REQUEST_MAGIC:
+                raise NBDException("Bad request magic %X" % magic)
+
+            if cmd == NBD_CMD_DISC:
+                self.log("disconnect")
+                return
+
+            data = None
+            if cmd == NBD_CMD_WRITE:
+                # always take the payload off the socket, even if the write is refused
+                data = _recvAll(conn, length)
+
+            if cmd in [NBD_CMD_READ, NBD_CMD_WRITE] and (offset + length > self.cache.size()):
+                self._reply(conn, handle, errno.ENOSPC if cmd == NBD_CMD_WRITE else errno.EINVAL)
+                continue
+
+            try:
+                if cmd == NBD_CMD_READ:
+                    data = self.cache.read(offset, length)
+                    self._reply(conn, handle, 0, data)
+                elif cmd == NBD_CMD_WRITE:
+                    if self.readOnly:
+                        self._reply(conn, handle, errno.EPERM)
+                    else:
+                        self.cache.write(offset, data)
+                        self._reply(conn, handle, 0)
+                elif cmd == NBD_CMD_FLUSH:
+                    self.cache.flush()
+                    self._reply(conn, handle, 0)
+                else:
+                    self._reply(conn, handle, errno.EINVAL)
+            except (FDCException, NBDException), e:
+                self.log("cmd %d offset %d length %d: %s" % (cmd, offset, length, e))
+                self._reply(conn, handle, errno.EIO)
+
+    def _flush(self):
+        try:
+            self.cache.flush()
+        except (FDCException, NBDException), e:
+            self.log("flush failed: %s" % e)
+
+    def _transmissionFlags(self):
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH
+        if self.readOnly:
+            flags |= NBD_FLAG_READ_ONLY
+        return flags
+
+    def _optReply(self, conn, option, reply, data=""):
+        conn.sendall(struct.pack(">QIII", NBD_REP_MAGIC, option, reply, len(data)) + data)
+
+    def _reply(self, conn, handle, error, data=""):
+        conn.sendall(struct.pack(">IIQ", NBD_REPLY_MAGIC, error, handle) + data)
+
+
+def _recvAll(conn, count):
+    parts = []
+    while count > 0:
+        part = conn.recv(count)
+        if not part:
+            raise NBDException("Connection closed")
+        parts.append(part)
+        count -= len(part)
+    return "".join(parts)
+
+def listen(socketName=None, port=10809):
+    # A unix socket if socketName is given, otherwise TCP on localhost
+    if socketName:
+        if os.path.exists(socketName):
+            os.unlink(socketName)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socketName)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", port))
+    listener.listen(1)
+    return listener
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NBD server for a floppy drive")
+    parser.add_argument("--media", default="auto", help="media type: 144, 720, 360, 120, 111, or auto")
+    parser.add_argument("--drive", type=int, default=0, help="drive select, 0 or 1")
+    parser.add_argument("--emulate", default=None, metavar="IMAGE", help="use an emulated controller with a disk made from IMAGE")
+    parser.add_argument("--socket", default=None, help="listen on this unix socket instead of TCP")
+    parser.add_argument("--port", type=int, default=10809, help="TCP port on localhost")
+    parser.add_argument("--cache", type=int, default=36, help="tracks to cache")
+    parser.add_argument("--read-only", dest="readOnly", action="store_true", default=False)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--verbose", "-v", action="store_true", default=False)
+    args = parser.parse_args()
+    if args.cache < 1:
+        parser.error("--cache must be at least 1")
+
+    backend = None
+    if args.emulate:
+        from wd37c65_emul import WD37C65Emulator, emulatedDisk, imageMedia
+        disk = emulatedDisk(imageMedia(args.emulate) if args.media == "auto" else args.media, args.emulate)
+        backend = WD37C65Emulator(disks=[None] * args.drive + [disk])
+
+    fdc = FDC(media="144" if args.media == "auto" else args.media, verbose=False, backend=backend)
+    fdc.init()
+    fdc.select(args.drive)
+    listener = listen(args.socket, args.port)
+    try:
+        if args.media == "auto":
+            print("media: %s" % fdc.detectMedia(), file=sys.stderr)
+        server = NBDServer(fdc, cacheTracks=args.cache, readOnly=args.readOnly, retries=args.retries, verbose=args.verbose)
+        server.serve(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        fdc.done(now=True)
+        if args.emulate and disk.dirty:
+            open(args.emulate, "wb").write(disk.image())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@
 #include <wiringPi.h>
 #include <unistd.h>
 #include <stdio.h>
+#include <pthread.h>
+#include <time.h>
 
 #include "micros.h"
 
@@ -16,6 +18,14 @@
 #define RESULT_LONG 0x22
 #define RESULT_INPROCESS 0x23
 
+#define EXEC_NONE 0
+#define EXEC_READ 1
+#define EXEC_WRITE 2
+#define EXEC_READID 3
+#define EXEC_SCAN 4
+
+#define RESULT_MAX 1024
+
 #define REG_MSR 0
 #define REG_DATA 1
 
@@ -39,6 +49,17 @@ const int WD_DATAPINS_REVERSED[] = { 4, 25, 24, 23, 22, 27, 18, 17 };
 
 int EnableMyMicros = FALSE;
 
+/* The bus loops below run with the GIL released, so other python threads
+ * keep running during long transfers. bus_lock keeps two threads from
+ * driving the bus at the same time. It must only be taken with the GIL
+ * released, or a thread holding the GIL could block on a thread that is
+ * waiting to get the GIL back.
+ */
+static pthread_mutex_t bus_lock = PTHREAD_MUTEX_INITIALIZER;
+
+#define BUS_BEGIN Py_BEGIN_ALLOW_THREADS pthread_mutex_lock(&bus_lock);
+#define BUS_END pthread_mutex_unlock(&bus_lock); Py_END_ALLOW_THREADS
+
 #define myDigitalWrite(x,y) digitalWrite(x,y)
 #define myDigitalRead(x) digitalRead(x)
 #define myPinModeInput(x) pinMode(x,INPUT)
@@ -54,6 +75,18 @@ void myDelayMicroseconds(int x)
   }
 }
 
+uint32_t myMicros(void)
+{
+  struct timespec ts;
+
+  if (EnableMyMicros) {
+    return micros();
+  }
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  /* tv_sec is 32 bits on Raspbian, so do the multiply in 64 bits and let it wrap */
+  return (uint32_t) ((uint64_t) ts.tv_sec * 1000000u + ts.tv_nsec / 1000);
+}
+
 void wd_config_input(void)
 {
   int i;
@@ -249,6 +282,27 @@ unsigned int wd_wait_msr(unsigned int mask, unsigned int val)
   }
 }
 
+/* Wait up to timeout microseconds for the controller to be ready for a
+ * new command: RQM=1, DIO=0, CB=0. Returns the last MSR read, so the
+ * caller can see what it's still busy with.
+ */
+unsigned int wd_wait_idle(unsigned int timeout)
+{
+  unsigned int msr;
+
+  wd_config_input();
+  while (TRUE) {
+      msr = wd_read_msr();
+      if (((msr & 0xD0) == 0x80) || (timeout < 3)) {
+        return msr;
+      }
+
+      // wiringPi
+      myDelayMicroseconds(3);
+      timeout -= 3;
+  }
+}
+
 unsigned int wd_drain(void)
 {
   unsigned int msr;
@@ -330,6 +384,248 @@ void wd_pulse_dack(void)
   myDigitalWrite(WD_DACK, 1);
 }
 
+unsigned int wd_wait_exec(unsigned int val, unsigned int abort_status)
+{
+  unsigned int msr;
+  unsigned int timeout = 65535 * 3;
+
+  while (TRUE) {
+      // wiringPi
+      myDelayMicroseconds(3);
+
+      msr = wd_read_msr();
+      if (msr == val) {
+        return 0;
+      }
+
+      if (msr == 0xD0) {
+        // fdc left the execution phase early and has result bytes for us
+        return abort_status;
+      }
+
+      timeout--;
+      if (timeout == 0) {
+        fprintf(stderr, "waitexec timedout with %02X\n", msr);
+        return RESULT_TIMEOUT_EXEC;
+      }
+  }
+}
+
+unsigned int wd_write_command(const char *buf, unsigned int count)
+{
+  unsigned int i;
+
+  for (i=0; i<count; i++) {
+      // DIO=0 and RQM=1 indicate byte is ready to write
+      unsigned int status = wd_wait_msr(0xC0, 0x80);
+      if (status!=0) {
+        fprintf(stderr, "write_command status %2X on byte %d\n", status, i);
+        wd_config_input();
+        return status;
+      }
+
+      wd_write_data(*buf);
+      buf++;
+  }
+  wd_config_input();
+  return 0;
+}
+
+/* If times is not NULL, the arrival time of the first byte of every
+ * blockSize bytes is stored in it, and *time_count is bumped for each one.
+ */
+unsigned int wd_read_block_timed(char *buf, unsigned int count, unsigned int blockSize,
+                                 uint32_t *times, unsigned int *time_count)
+{
+  unsigned int i;
+
+  for (i=0; i<count; i++) {
+      unsigned int status = wd_wait_exec(0xF0, RESULT_READ_ERROR);   // RQM=1, DIO=1, NDM=1, BUS=1
+      if (status!=0) {
+        fprintf(stderr, "read_block aborting on index %d with status %02X\n", i, status);
+        return status;
+      }
+
+      buf[i] = wd_read_data();
+
+      if ((times != NULL) && ((i % blockSize) == 0)) {
+        times[(*time_count)++] = myMicros();
+      }
+  }
+
+  // Terminate the transfer
+  wd_pulse_dack();
+
+  return 0;
+}
+
+unsigned int wd_read_block(char *buf, unsigned int count)
+{
+  return wd_read_block_timed(buf, count, 0, NULL, NULL);
+}
+
+unsigned int wd_write_block(const char *buf, unsigned int count, unsigned int autoTerminate)
+{
+  unsigned int i;
+
+  for (i=0; i<count; i++) {
+      unsigned int status = wd_wait_exec(0xB0, RESULT_WRITE_ERROR); // RQM=1, DIO=0, NDM=1, BUS=1
+      if (status!=0) {
+        fprintf(stderr, "write_block aborting on index %d with status %02X\n", i, status);
+        return status;
+      }
+
+      wd_write_data(*buf);
+      buf++;
+  }
+
+  if (autoTerminate) {
+      // Terminate the transfer
+      wd_pulse_dack();
+  }
+
+  return 0;
+}
+
+unsigned int wd_scan_block(const char *buf, unsigned int count)
+{
+  unsigned int i;
+
+  for (i=0; i<count; i++) {
+      unsigned int status = wd_wait_exec(0xB0, RESULT_WRITE_ERROR); // RQM=1, DIO=0, NDM=1, BUS=1
+      if (status == RESULT_WRITE_ERROR) {
+        // the scan was satisfied, or ran off the end of the track
+        return 0;
+      }
+      if (status!=0) {
+        fprintf(stderr, "scan_block aborting on index %d with status %02X\n", i, status);
+        return status;
+      }
+
+      wd_write_data(*buf);
+      buf++;
+  }
+
+  // Terminate the transfer
+  wd_pulse_dack();
+
+  return 0;
+}
+
+unsigned int wd_read_result(char *buf, unsigned int *count)
+{
+  unsigned int maxTime = 10000;
+
+  *count = 0;
+  while (maxTime>0) {
+      unsigned int msr;
+
+      // wiringPi
+      myDelayMicroseconds(10);
+
+      msr = wd_read_msr();
+      if ((msr & 0xF0) == 0xD0) {
+          // RQM=1, DIO=1, BUSY=1 ... byte is ready to read
+          buf[*count] = wd_read_data();
+          (*count)++;
+          maxTime = 10000;
+      } else if ((msr & 0xF0) == 0x80) {
+          // RQM=1, DIO=0, BUSY=0 ... fdc is waiting for next command ... we are done
+          return 0;
+      } else {
+         maxTime--;
+      }
+
+      if (*count>128) {
+        return RESULT_OVER_CMDRES;
+      }
+  }
+
+  return RESULT_TIMEOUT_READRES;
+}
+
+/* Run a complete FDC command: drain, command phase, execution phase and
+ * result phase. For EXEC_READ, count bytes are read into buf. For
+ * EXEC_WRITE, count bytes are written from buf. For EXEC_SCAN, up to count
+ * bytes of comparison data are written from buf; the controller may stop
+ * asking for them early. Execution-phase read/write
+ * errors are not fatal; the result phase is still collected so the caller
+ * can evaluate ST0-ST2.
+ *
+ * If times is not NULL, micros() timestamps are stored in it: one when the
+ * command phase is done, then one for the first byte of each blockSize
+ * bytes of an EXEC_READ, or one when the result of an EXEC_READID is ready.
+ * It needs room for count / blockSize + 2 entries.
+ */
+unsigned int wd_execute_timed(const char *cmd, unsigned int cmd_len, unsigned int kind, char *buf, unsigned int count,
+                              unsigned int blockSize, uint32_t *times, unsigned int *time_count,
+                              char *res, unsigned int *res_count)
+{
+  unsigned int status;
+
+  *res_count = 0;
+  if (time_count != NULL) {
+    *time_count = 0;
+  }
+
+  status = wd_drain();
+  if (status != 0) {
+    return status;
+  }
+
+  // Usually idle straight after the drain; allow it up to 1ms to get there
+  if ((wd_wait_idle(1000) & 0x90) == 0x90) {
+    // we're in the middle of a read or write already
+    return RESULT_INPROCESS;
+  }
+
+  status = wd_write_command(cmd, cmd_len);
+  if (status != 0) {
+    return status;
+  }
+
+  if (times != NULL) {
+    times[(*time_count)++] = myMicros();
+  }
+
+  switch (kind) {
+    case EXEC_READ:
+      status = wd_read_block_timed(buf, count, blockSize, times, time_count);
+      break;
+
+    case EXEC_WRITE:
+      status = wd_write_block(buf, count, TRUE);
+      break;
+
+    case EXEC_READID:
+      status = wd_wait_msr(0xE0, 0xC0);
+      if ((times != NULL) && (status == 0)) {
+        times[(*time_count)++] = myMicros();
+      }
+      break;
+
+    case EXEC_SCAN:
+      status = wd_scan_block(buf, count);
+      break;
+
+    default:
+      status = 0;
+      break;
+  }
+
+  if ((status != 0) && (status != RESULT_READ_ERROR) && (status != RESULT_WRITE_ERROR)) {
+    return status;
+  }
+
+  return wd_read_result(res, res_count);
+}
+
+unsigned int wd_execute(const char *cmd, unsigned int cmd_len, unsigned int kind, char *buf, unsigned int count,
+                        char *res, unsigned int *res_count)
+{
+  return wd_execute_timed(cmd, cmd_len, kind, buf, count, 0, NULL, NULL, res, res_count);
+}
+
 void short_delay(void)
 {
     // Just do nothing for a while. This is to allow the RAM some time to do it's work.
@@ -346,7 +642,9 @@ static PyObject *wd_direct_init(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   wd_init();
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -356,7 +654,9 @@ static PyObject *wd_direct_reset(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &dor)) {
     return NULL;
   }
+  BUS_BEGIN
   wd_reset(dor);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -365,24 +665,36 @@ static PyObject *wd_direct_pulse_dack(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   wd_pulse_dack();
+  BUS_END
   return Py_BuildValue("");
 }
 
 static PyObject *wd_direct_get_tc(PyObject *self, PyObject *args)
 {
+  unsigned int v;
+
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
-  return Py_BuildValue("i", wd_get_tc());
+  BUS_BEGIN
+  v = wd_get_tc();
+  BUS_END
+  return Py_BuildValue("i", v);
 }
 
 static PyObject *wd_direct_get_dc(PyObject *self, PyObject *args)
 {
+  unsigned int v;
+
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
-  return Py_BuildValue("i", wd_get_dc());
+  BUS_BEGIN
+  v = wd_get_dc();
+  BUS_END
+  return Py_BuildValue("i", v);
 }
 
 static PyObject *wd_direct_set_addr(PyObject *self, PyObject *args)
@@ -391,7 +703,9 @@ static PyObject *wd_direct_set_addr(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &addr)) {
     return NULL;    
   }
+  BUS_BEGIN
   wd_set_addr(addr);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -402,7 +716,9 @@ static PyObject *wd_direct_read_byte(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "ii", &cs, &addr)) {
     return NULL;
   }
+  BUS_BEGIN
   data = wd_read_data();
+  BUS_END
   return Py_BuildValue("i", data);
 }
 
@@ -412,11 +728,13 @@ static PyObject *wd_direct_write_byte(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "iii", &cs, &addr, &data)) {
     return NULL;
   }
+  BUS_BEGIN
   wd_config_output();
   wd_set_addr(addr);
   wd_set_data(data);
   wd_pulse_cs_wr(cs);
   wd_config_input();
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -426,7 +744,9 @@ static PyObject *wd_direct_write_data(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &data)) {
     return NULL;
   }
+  BUS_BEGIN
   wd_write_data(data);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -436,7 +756,9 @@ static PyObject *wd_direct_write_dor(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &data)) {
     return NULL;
   }
+  BUS_BEGIN
   wd_write_dor(data);
+  BUS_END
   return Py_BuildValue("");
 }
 
@@ -446,148 +768,281 @@ static PyObject *wd_direct_write_dcr(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &data)) {
     return NULL;
   }
+  BUS_BEGIN
   wd_write_dcr(data);
+  BUS_END
   return Py_BuildValue("");
 }
 
 static PyObject *wd_direct_read_block(PyObject *self, PyObject *args)
 {
   unsigned int count;
-  char buf[1024];
-  int i;
+  unsigned int status;
+  PyObject *data;
 
   if (!PyArg_ParseTuple(args, "i", &count)) {
     return NULL;
   }
 
-  if (count > 1024) {
-      // throw exception?
-      return NULL;
+  data = PyString_FromStringAndSize(NULL, count);
+  if (data == NULL) {
+    return NULL;
   }
 
-  for (i=0; i<count; i++) {
-      unsigned int status = wd_wait_msr(0xFF, 0xF0);   // RQM=1, DIO=1, NDM=1, BUS=1
-      unsigned int msr;
-      if (status!=0) {
-        msr = wd_read_msr();
-        if (msr == 0xD0) {
-            // d0 indicates fdc wants us to read a byte
-            fprintf(stderr, "read_block aborting on index %d with read error\n", i);
-            return Py_BuildValue("is#", RESULT_READ_ERROR, buf, count);
-        } else {
-            fprintf(stderr, "read_block aborting on index %d with msr %02X\n", i, msr);
-            return Py_BuildValue("is#", status, buf, count);
-        }
-      }
+  BUS_BEGIN
+  status = wd_read_block(PyString_AS_STRING(data), count);
+  BUS_END
 
-      buf[i] = wd_read_data();
+  return Py_BuildValue("iN", status, data);
+}
+
+/* read_block_into(buffer, offset, count) -> status
+ *
+ * Like read_block, but fills a caller-supplied bytearray or writable
+ * memoryview, so one buffer can be reused for a whole track or image.
+ */
+static PyObject *wd_direct_read_block_into(PyObject *self, PyObject *args)
+{
+  Py_buffer view;
+  Py_ssize_t offset, count;
+  unsigned int status;
+
+  if (!PyArg_ParseTuple(args, "w*nn", &view, &offset, &count)) {
+    return NULL;
   }
 
-  // Terminate the transfer
-  wd_pulse_dack();
+  if ((offset < 0) || (count < 0) || (offset > view.len - count)) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "offset and count are outside the buffer");
+    return NULL;
+  }
+
+  BUS_BEGIN
+  status = wd_read_block((char *) view.buf + offset, (unsigned int) count);
+  BUS_END
+
+  PyBuffer_Release(&view);
 
-  return Py_BuildValue("is#", 0, buf, count);
+  return Py_BuildValue("i", status);
 }
 
 static PyObject *wd_direct_read_result(PyObject *self, PyObject *args)
 {
   unsigned int count;
-  unsigned int maxTime = 10000;
-  char buf[1024];
+  unsigned int status;
+  char buf[RESULT_MAX];
 
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
 
-  count = 0;
-  while (maxTime>0) {
-      unsigned int msr;
+  BUS_BEGIN
+  status = wd_read_result(buf, &count);
+  BUS_END
 
-      // wiringPi
-      myDelayMicroseconds(10);      
-      
-      msr = wd_read_msr();
-      //fprintf(stderr, "readRes msr %2X\n", msr);
-      if ((msr & 0xF0) == 0xD0) {
-          // RQM=1, DIO=1, BUSY=1 ... byte is ready to read
-          buf[count] = wd_read_data();
-          count++;
-          maxTime = 10000;
-      } else if ((msr & 0xF0) == 0x80) {
-          // RQM=1, DIO=0, BUSY=0 ... fdc is waiting for next command ... we are done
-          return Py_BuildValue("is#", 0, buf, count);
-      } else {
-         maxTime--;
-      }
+  return Py_BuildValue("is#", status, buf, count);
+}
 
-      if (count>128) {
-        return Py_BuildValue("is#", RESULT_OVER_CMDRES, buf, count);
-      }
+static PyObject *wd_direct_write_block(PyObject *self, PyObject *args)
+{
+  Py_buffer view;
+  unsigned int count;
+  unsigned int autoTerminate;
+  unsigned int status;
+
+  if (!PyArg_ParseTuple(args, "s*ii", &view, &count, &autoTerminate)) {
+    return NULL;
   }
 
-  return Py_BuildValue("is#", RESULT_TIMEOUT_READRES, buf, count);
+  if (count > view.len) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "buffer is shorter than count");
+    return NULL;
+  }
+
+  BUS_BEGIN
+  status = wd_write_block(view.buf, count, autoTerminate);
+  BUS_END
+
+  PyBuffer_Release(&view);
+
+  return Py_BuildValue("i", status);
 }
 
-static PyObject *wd_direct_write_block(PyObject *self, PyObject *args)
+static PyObject *wd_direct_write_command(PyObject *self, PyObject *args)
 {
   const char *buf;
   unsigned int buf_len, count;
-  unsigned int autoTerminate;
-  int i;
+  unsigned int status;
 
-  if (!PyArg_ParseTuple(args, "s#ii", &buf, &buf_len, &count, &autoTerminate)) {
+  if (!PyArg_ParseTuple(args, "s#i", &buf, &buf_len, &count)) {
     return NULL;
   }
 
-  for (i=0; i<count; i++) {
-      unsigned int status = wd_wait_msr(0xFF, 0xB0); // RQM=1, DIO=0, NDM=1, BUS=1
-      if (status!=0) {
-        unsigned int msr = wd_read_msr();
-        if (msr == 0xD0) {
-            // d0 indicates fdc wants us to read a byte
-            fprintf(stderr, "write_block aborting on index %d with write error\n", i);
-            return Py_BuildValue("i", RESULT_WRITE_ERROR);
-        } else {
-            fprintf(stderr, "write_block aborting on index %d with msr %02X\n", i, msr);
-            return Py_BuildValue("i", status);
-        }
-      }
+  BUS_BEGIN
+  status = wd_write_command(buf, count);
+  BUS_END
 
-      wd_write_data(*buf);
-      buf++;
+  return Py_BuildValue("i", status);
+}
+
+/* execute(cmd_bytes, exec_kind, buffer, count) -> (status, data, result)
+ *
+ * Runs a complete command without returning to python in between. For
+ * EXEC_READ, count bytes are read and returned as data. For EXEC_WRITE, the
+ * first count bytes of buffer (any buffer-protocol object) are written.
+ */
+static PyObject *wd_direct_execute(PyObject *self, PyObject *args)
+{
+  const char *cmd;
+  unsigned int cmd_len, kind, count;
+  unsigned int status, res_count;
+  char res[RESULT_MAX];
+  Py_buffer view;
+  PyObject *data;
+  char *buf;
+
+  if (!PyArg_ParseTuple(args, "s#is*i", &cmd, &cmd_len, &kind, &view, &count)) {
+    return NULL;
   }
 
-  if (autoTerminate) {
-      // Terminate the transfer
-      wd_pulse_dack();
+  if (((kind == EXEC_WRITE) || (kind == EXEC_SCAN)) && (count > view.len)) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "buffer is shorter than count");
+    return NULL;
   }
 
-  return Py_BuildValue("i", 0);
+  if (kind == EXEC_READ) {
+    data = PyString_FromStringAndSize(NULL, count);
+  } else {
+    data = PyString_FromStringAndSize(NULL, 0);
+  }
+  if (data == NULL) {
+    PyBuffer_Release(&view);
+    return NULL;
+  }
+
+  if (kind == EXEC_READ) {
+    buf = PyString_AS_STRING(data);
+  } else {
+    buf = view.buf;
+  }
+
+  BUS_BEGIN
+  status = wd_execute(cmd, cmd_len, kind, buf, count, res, &res_count);
+  BUS_END
+
+  PyBuffer_Release(&view);
+
+  return Py_BuildValue("iNs#", status, data, res, res_count);
 }
 
-static PyObject *wd_direct_write_command(PyObject *self, PyObject *args)
+/* execute_into(cmd_bytes, exec_kind, buffer, offset, count) -> (status, result)
+ *
+ * Like execute, but the execution phase reads into (or writes from) buffer
+ * at offset instead of allocating a new string.
+ */
+static PyObject *wd_direct_execute_into(PyObject *self, PyObject *args)
 {
-  const char *buf;
-  unsigned int buf_len, count;
-  int i;
+  const char *cmd;
+  unsigned int cmd_len, kind;
+  Py_ssize_t offset, count;
+  unsigned int status, res_count;
+  char res[RESULT_MAX];
+  PyObject *obj;
+  Py_buffer view;
+
+  if (!PyArg_ParseTuple(args, "s#iOnn", &cmd, &cmd_len, &kind, &obj, &offset, &count)) {
+    return NULL;
+  }
 
-  if (!PyArg_ParseTuple(args, "s#i", &buf, &buf_len, &count)) {
+  if (PyObject_GetBuffer(obj, &view, (kind == EXEC_READ) ? PyBUF_WRITABLE : PyBUF_SIMPLE) != 0) {
     return NULL;
   }
 
-  for (i=0; i<count; i++) {
-      unsigned int status = wd_wait_msr(0xC0, 0x80);
-      if (status!=0) {
-        fprintf(stdout, "write_command status %2X on byte %d\n", status, i);
-        wd_config_input();
-        return Py_BuildValue("i", status);
-      }
+  if ((offset < 0) || (count < 0) ||
+      ((kind != EXEC_NONE) && (kind != EXEC_READID) && (offset > view.len - count))) {
+    PyBuffer_Release(&view);
+    PyErr_SetString(PyExc_ValueError, "offset and count are outside the buffer");
+    return NULL;
+  }
 
-      wd_write_data(*buf);
-      buf++;
+  BUS_BEGIN
+  status = wd_execute(cmd, cmd_len, kind, (char *) view.buf + offset, (unsigned int) count, res, &res_count);
+  BUS_END
+
+  PyBuffer_Release(&view);
+
+  return Py_BuildValue("is#", status, res, res_count);
+}
+
+/* execute_timed(cmd_bytes, exec_kind, count, block_size) -> (status, data, result, times)
+ *
+ * Like execute for EXEC_READ and EXEC_READID, but also returns a tuple of
+ * micros() timestamps; see wd_execute_timed.
+ */
+static PyObject *wd_direct_execute_timed(PyObject *self, PyObject *args)
+{
+  const char *cmd;
+  unsigned int cmd_len, kind, count, blockSize;
+  unsigned int status, res_count, time_count, i;
+  char res[RESULT_MAX];
+  uint32_t *times;
+  PyObject *data, *timeTuple;
+
+  if (!PyArg_ParseTuple(args, "s#iii", &cmd, &cmd_len, &kind, &count, &blockSize)) {
+    return NULL;
   }
-  wd_config_input();
-  return Py_BuildValue("i", 0);
+
+  if ((kind != EXEC_READ) && (kind != EXEC_READID)) {
+    PyErr_SetString(PyExc_ValueError, "only EXEC_READ and EXEC_READID can be timed");
+    return NULL;
+  }
+  if (blockSize == 0) {
+    blockSize = (count > 0) ? count : 1;
+  }
+
+  if (kind == EXEC_READ) {
+    data = PyString_FromStringAndSize(NULL, count);
+  } else {
+    count = 0;
+    data = PyString_FromStringAndSize(NULL, 0);
+  }
+  if (data == NULL) {
+    return NULL;
+  }
+
+  times = PyMem_Malloc(sizeof(uint32_t) * (count / blockSize + 2));
+  if (times == NULL) {
+    Py_DECREF(data);
+    return PyErr_NoMemory();
+  }
+
+  BUS_BEGIN
+  status = wd_execute_timed(cmd, cmd_len, kind, PyString_AS_STRING(data), count, blockSize,
+                            times, &time_count, res, &res_count);
+  BUS_END
+
+  timeTuple = PyTuple_New(time_count);
+  if (timeTuple == NULL) {
+    PyMem_Free(times);
+    Py_DECREF(data);
+    return NULL;
+  }
+  for (i=0; i<time_count; i++) {
+    PyTuple_SET_ITEM(timeTuple, i, PyLong_FromUnsignedLong(times[i]));
+  }
+  PyMem_Free(times);
+
+  return Py_BuildValue("iNs#N", status, data, res, res_count, timeTuple);
+}
+
+static PyObject *wd_direct_micros(PyObject *self, PyObject *args)
+{
+  if (!PyArg_ParseTuple(args, "")) {
+    return NULL;
+  }
+  return PyLong_FromUnsignedLong(myMicros());
 }
 
 static PyObject *wd_direct_wait_msr(PyObject *self, PyObject *args)
@@ -597,7 +1052,9 @@ static PyObject *wd_direct_wait_msr(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "ii", &mask, &value)) {
     return NULL;
   }
+  BUS_BEGIN
   status = wd_wait_msr(mask, value);
+  BUS_END
   return Py_BuildValue("i", status);
 }
 
@@ -607,7 +1064,9 @@ static PyObject *wd_direct_get_msr(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   msr = wd_read_msr();
+  BUS_END
   return Py_BuildValue("i", msr);
 }
 
@@ -617,7 +1076,9 @@ static PyObject *wd_direct_drain(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "")) {
     return NULL;
   }
+  BUS_BEGIN
   status = wd_drain();
+  BUS_END
   return Py_BuildValue("i", status);
 }
 
@@ -627,7 +1088,9 @@ static PyObject *wd_direct_delay_microseconds(PyObject *self, PyObject *args)
   if (!PyArg_ParseTuple(args, "i", &amount)) {
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   myDelayMicroseconds(amount);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("i", 0);
 }
 
@@ -655,6 +1118,7 @@ static PyMethodDef wd_direct_methods[] = {
   {"write_dor", wd_direct_write_dor, METH_VARARGS, "Write dor reg"},
   {"write_dcr", wd_direct_write_dcr, METH_VARARGS, "Write dcr reg"},
   {"read_block", wd_direct_read_block, METH_VARARGS, "Read block"},
+  {"read_block_into", wd_direct_read_block_into, METH_VARARGS, "Read block into a buffer"},
   {"write_block", wd_direct_write_block, METH_VARARGS, "Write block"},
   {"read_result", wd_direct_read_result, METH_VARARGS, "Read command result"},
   {"get_msr", wd_direct_get_msr, METH_VARARGS, "get the msr"},
@@ -662,13 +1126,28 @@ static PyMethodDef wd_direct_methods[] = {
   {"delay_microseconds", wd_direct_delay_microseconds, METH_VARARGS, "delay microseconds"},
   {"enable_my_delay_micros", wd_direct_enable_my_delay_micros, METH_VARARGS, "enable my delay_micros function"},
   {"drain", wd_direct_drain, METH_VARARGS, "drain data"},
+  {"execute", wd_direct_execute, METH_VARARGS, "Execute command, execution, and result phases"},
+  {"execute_into", wd_direct_execute_into, METH_VARARGS, "Execute command, with execution phase into a buffer"},
+  {"execute_timed", wd_direct_execute_timed, METH_VARARGS, "Execute command, with timestamps for the execution phase"},
+  {"micros", wd_direct_micros, METH_VARARGS, "Microsecond clock"},
   {NULL, NULL, 0, NULL}
 };
 
 PyMODINIT_FUNC initwd37c65_direct_ext(void)
 {
+  PyObject *m;
+
   EnableMyMicros = FALSE;
   wiringPiSetupGpio();
 
-  (void) Py_InitModule("wd37c65_direct_ext", wd_direct_methods);
+  m = Py_InitModule("wd37c65_direct_ext", wd_direct_methods);
+  if (m == NULL) {
+    return;
+  }
+
+  PyModule_AddIntConstant(m, "EXEC_NONE", EXEC_NONE);
+  PyModule_AddIntConstant(m, "EXEC_READ", EXEC_READ);
+  PyModule_AddIntConstant(m, "EXEC_WRITE", EXEC_WRITE);
+  PyModule_AddIntConstant(m, "EXEC_READID", EXEC_READID);
+  PyModule_AddIntConstant(m, "EXEC_SCAN", EXEC_SCAN);
 }
@@ -0,0 +1,973 @@
+# Software model of a WD37C65 floppy controller and drives
+# Scott Baker, https://www.smbaker.com/
+#
+# Has the same function surface as wd37c65_direct_ext, so it can be handed to
+# FDC as its backend:
+#
+#     fdc = FDC(media="144", backend=WD37C65Emulator(disks=[emulatedDisk("144")]))
+#
+# The controller is modeled at the register level (MSR, data FIFO, DOR, DCR),
+# and the block/result/execute helpers are implemented on top of the
+# registers the same way the C extension does it. Time is kept on a virtual
+# microsecond clock that advances for seeks, rotational latency, and data
+# transfer, so the cost of an access pattern can be measured without a
+# drive. With realtime=True, the virtual clock is kept in step with the wall
+# clock, so seeks and rotation take real time as well.
+
+from __future__ import print_function
+import os
+import random
+import sys
+import time
+
+from fdc import CFD_READ, CFD_READDEL, CFD_WRITE, CFD_WRITEDEL, CFD_READTRK, CFD_READID, \
+                CFD_FMTTRK, CFD_SCANEQ, CFD_SCANLOEQ, CFD_SCANHIEQ, CFD_RECAL, CFD_SENSEINT, \
+                CFD_SPECIFY, CFD_DRVSTAT, CFD_SEEK, CFD_VERSION, \
+                EXEC_NONE, EXEC_READ, EXEC_WRITE, EXEC_READID, EXEC_SCAN
+
+# same values as the RESULT_ codes in wd37c65_direct_ext.c
+RESULT_OKAY = 0
+RESULT_TIMEOUT_EXEC = 0x14
+RESULT_OVER_DRAIN = 0x16
+RESULT_OVER_CMDRES = 0x17
+RESULT_TIMEOUT_READRES = 0x18
+RESULT_READ_ERROR = 0x19
+RESULT_WRITE_ERROR = 0x20
+RESULT_INPROCESS = 0x23
+
+# (numCyl, numHead, secCount, secSize, dcr)
+MEDIA = {"144": (80, 2, 18, 512, 0),
+         "720": (80, 2, 9, 512, 1),
+         "360": (40, 2, 9, 512, 1),
+         "120": (80, 2, 15, 512, 0),
+         "111": (40, 2, 15, 512, 0),
+         "9836": (35, 2, 15, 256, 1)}
+
+CMD_LEN = {CFD_READ: 9, CFD_READDEL: 9, CFD_WRITE: 9, CFD_WRITEDEL: 9, CFD_READTRK: 9,
+           CFD_SCANEQ: 9, CFD_SCANLOEQ: 9, CFD_SCANHIEQ: 9, CFD_READID: 2, CFD_FMTTRK: 6,
+           CFD_RECAL: 2, CFD_SENSEINT: 1, CFD_SPECIFY: 3, CFD_DRVSTAT: 2, CFD_SEEK: 3,
+           CFD_VERSION: 1}
+
+# controller phases
+PH_IDLE = 0
+PH_COMMAND = 1
+PH_EXEC_READ = 2
+PH_EXEC_WRITE = 3
+PH_RESULT = 4
+
+ST0_ABTERM = 0x40
+ST0_INVCMD = 0x80
+ST0_READY_CHANGE = 0xC0
+ST0_SEEK_END = 0x20
+ST0_EQUIP_CHECK = 0x10
+ST0_NOT_READY = 0x08
+
+ST1_END_CYL = 0x80
+ST1_DATA_ERR = 0x20
+ST1_NO_DATA = 0x04
+ST1_NOT_WRIT = 0x02
+ST1_MISS_ADR = 0x01
+
+ST2_DATA_ERR = 0x20
+ST2_WRONG_CYL = 0x10
+ST2_SCAN_HIT = 0x08
+ST2_SCAN_NOT = 0x04
+
+def _sizeToN(size):
+    n = 0
+    while (128 << n) < size:
+        n += 1
+    return n
+
+
+class EmulatedSector:
+    def __init__(self, c, h, r, n, data):
+        self.c = c
+        self.h = h
+        self.r = r
+        self.n = n
+        self.data = data
+
+
+# A disk in the emulated drive. Tracks are lists of sectors in physical
+# order, so non-standard formats and interleaves can be modeled.
+class EmulatedDisk:
+    def __init__(self, numCyl=80, numHead=2, secCount=18, secSize=512, dcr=0, fill=0xE5,
+                 interleave=1, formatted=True):
+        self.numCyl = numCyl
+        self.numHead = numHead
+        self.secCount = secCount
+        self.secSize = secSize
+        self.dcr = dcr
+        self.writeProtect = False
+        self.dirty = False
+
+        # (cyl, head, record) -> "crc" or "missing"
+        self.badSectors = {}
+
+        self.tracks = {}
+        if formatted:
+            for cyl in range(0, numCyl):
+                for head in range(0, numHead):
+                    self.formatTrack(cyl, head, [(cyl, head, r, _sizeToN(secSize)) for r in self._interleave(interleave)], fill)
+
+    def _interleave(self, interleave):
+        order = [None] * self.secCount
+        pos = 0
+        for r in range(1, self.secCount + 1):
+            while order[pos] is not None:
+                pos = (pos + 1) % self.secCount
+            order[pos] = r
+            pos = (pos + interleave) % self.secCount
+        return order
+
+    def formatTrack(self, cyl, head, ids, fill):
+        self.tracks[(cyl, head)] = [EmulatedSector(c, h, r, n, bytearray(chr(fill) * (128 << n))) for (c, h, r, n) in ids]
+        self.dirty = True
+
+    def loadImage(self, data):
+        # raw image in (cyl, head, record) order, as written by FDC.imageDisk
+        trackSize = self.secCount * self.secSize
+        for cyl in range(0, self.numCyl):
+            for head in range(0, self.numHead):
+                offset = ((cyl * self.numHead) + head) * trackSize
+                for sector in self.tracks.get((cyl, head), []):
+                    start = offset + (sector.r - 1) * self.secSize
+                    chunk = data[start:start + self.secSize]
+                    if len(chunk) == self.secSize:
+                        sector.data = bytearray(chunk)
+        self.dirty = False
+
+    def image(self):
+        data = bytearray(self.numCyl * self.numHead * self.secCount * self.secSize)
+        for ((cyl, head), sectors) in self.tracks.items():
+            if (cyl >= self.numCyl) or (head >= self.numHead):
+                continue
+            offset = ((cyl * self.numHead) + head) * self.secCount * self.secSize
+            for sector in sectors:
+                if (sector.r >= 1) and (sector.r <= self.secCount) and (len(sector.data) == self.secSize):
+                    start = offset + (sector.r - 1) * self.secSize
+                    data[start:start + self.secSize] = sector.data
+        return str(data)
+
+
+def emulatedDisk(media="144", fileName=None, **kwargs):
+    (numCyl, numHead, secCount, secSize, dcr) = MEDIA[media]
+    disk = EmulatedDisk(numCyl, numHead, secCount, secSize, dcr, **kwargs)
+    if fileName is not None:
+        disk.loadImage(open(fileName, "rb").read())
+    return disk
+
+def imageMedia(fileName):
+    # the media an image file is for, going by its size
+    size = os.path.getsize(fileName)
+    for (media, (numCyl, numHead, secCount, secSize, dcr)) in MEDIA.items():
+        if numCyl * numHead * secCount * secSize == size:
+            return media
+    raise ValueError("%s isn't the size of any known media" % fileName)
+
+
+class EmulatedDrive:
+    def __init__(self, numCyl):
+        self.numCyl = numCyl
+        self.disk = None
+        self.headPos = 0           # where the head physically is
+        self.pcn = 0               # where the controller thinks it is
+        self.seekDone = 0          # clock value when the current seek finishes
+        self.motorOnAt = None      # clock value when the motor was turned on
+
+
+class WD37C65Emulator:
+    def __init__(self, disks=None, driveCyls=80, rpm=300, stepTime=None, settleTime=15000,
+                 spinUpTime=300000, errorRate=0.0, seekErrorRate=0.0, seed=None, realtime=False,
+                 minStepTime=None):
+        # disks is a list of EmulatedDisk (or None), one per drive select
+        self.drives = [EmulatedDrive(driveCyls) for i in range(0, 4)]
+        for (ds, disk) in enumerate(disks or []):
+            self.drives[ds].disk = disk
+
+        self.period = 60000000 // rpm
+        self.fixedStepTime = stepTime
+        self.stepTime = stepTime or 3000
+        self.settleTime = settleTime
+        # the drive misses steps that come faster than minStepTime
+        self.minStepTime = minStepTime
+        self.spinUpTime = spinUpTime
+        self.errorRate = errorRate
+        self.seekErrorRate = seekErrorRate
+        self.random = random.Random(seed)
+        self.realtime = realtime
+
+        self.clock = 0
+        self.wallStart = time.time()
+
+        # counters, for benchmarking
+        self.seeks = 0
+        self.steps = 0
+        self.commands = 0
+
+        self._resetController()
+        self.dor = 0
+        self.dcr = 0
+
+    # ------------ media -----------------
+
+    def insert(self, ds, disk):
+        self.drives[ds].disk = disk
+        self._interrupt(ST0_READY_CHANGE | ds, self.drives[ds].pcn)
+
+    def eject(self, ds):
+        self.drives[ds].disk = None
+        self._interrupt(ST0_READY_CHANGE | ds, self.drives[ds].pcn)
+
+    # ------------ clock -----------------
+
+    def _sync(self):
+        if not self.realtime:
+            return
+        wall = (time.time() - self.wallStart) * 1000000
+        if wall > self.clock:
+            self.clock = wall
+        else:
+            time.sleep((self.clock - wall) / 1000000.0)
+
+    def _advance(self, us):
+        self.clock += us
+        self._sync()
+
+    def _byteTime(self):
+        if self.dcr == 0:
+            return 16   # 500 kbps MFM
+        return 32       # 250 kbps MFM
+
+    def elapsed(self):
+        # virtual seconds since the emulator was created
+        return self.clock / 1000000.0
+
+    # ------------ controller state -----------------
+
+    def _resetController(self):
+        self.phase = PH_IDLE
+        self.cmd = []
+        self.result = []
+        self.interrupts = []
+        self.xfer = None
+        self.srt = 0
+
+    def _interrupt(self, st0, pcn, at=None):
+        if at is None:
+            at = self.clock
+        self.interrupts.append((at, st0, pcn))
+
+    def _drive(self):
+        return self.drives[self.cmd[1] & 0x03]
+
+    def _ready(self, drive):
+        return (drive.disk is not None) and (drive.motorOnAt is not None) and \
+               (self.clock - drive.motorOnAt >= self.spinUpTime)
+
+    def _physTrack(self, drive):
+        # A 40-track disk in an 80-track drive sits on every other track
+        disk = drive.disk
+        if drive.numCyl >= 2 * disk.numCyl:
+            return drive.headPos // 2
+        return drive.headPos
+
+    def _track(self, drive, head):
+        disk = drive.disk
+        if (disk is None) or (head >= disk.numHead) or (self.dcr != disk.dcr):
+            return None
+        return disk.tracks.get((self._physTrack(drive), head))
+
+    def _waitSlot(self, sectors, index):
+        # advance the clock to the start of physical sector slot index
+        slot = self.period // len(sectors)
+        start = index * slot
+        angle = self.clock % self.period
+        wait = (start - angle) % self.period
+        self._advance(wait)
+        return self.clock
+
+    def _nextSlot(self, sectors):
+        # index of the next sector slot to come under the head
+        slot = self.period // len(sectors)
+        return int(((self.clock % self.period) + slot - 1) // slot) % len(sectors)
+
+    def _finishSeek(self, drive):
+        if drive.seekDone > self.clock:
+            self._advance(drive.seekDone - self.clock)
+
+    # ------------ registers -----------------
+
+    def get_msr(self):
+        self._sync()
+        busy = 0
+        for (ds, drive) in enumerate(self.drives):
+            if drive.seekDone > self.clock:
+                busy |= (1 << ds)
+
+        if self.phase == PH_IDLE:
+            return 0x80 | busy
+        elif self.phase == PH_COMMAND:
+            return 0x90 | busy
+        elif self.phase == PH_EXEC_READ:
+            self._execPoll()
+            if self.phase == PH_EXEC_READ:
+                return 0xF0
+        elif self.phase == PH_EXEC_WRITE:
+            self._execPoll()
+            if self.phase == PH_EXEC_WRITE:
+                return 0xB0
+        return 0xD0
+
+    def write_data(self, d):
+        d = d & 0xFF
+        if self.phase in [PH_IDLE, PH_COMMAND]:
+            self.cmd.append(d)
+            self.phase = PH_COMMAND
+            if len(self.cmd) >= CMD_LEN.get(self.cmd[0] & 0x1F, 1):
+                self._command()
+        elif (self.phase == PH_EXEC_WRITE) and self.xfer.get("format"):
+            self._formatByte(d)
+        elif self.phase == PH_EXEC_WRITE:
+            self._execWrite(d)
+        # writes in any other phase are ignored
+
+    def _readData(self):
+        if self.phase == PH_EXEC_READ:
+            return self._execRead()
+        elif self.phase == PH_RESULT:
+            d = self.result.pop(0)
+            if not self.result:
+                self.phase = PH_IDLE
+            return d
+        return 0xFF
+
+    def write_dor(self, dor):
+        if (self.dor & 0x04) and not (dor & 0x04):
+            # reset asserted
+            self._resetController()
+        elif not (self.dor & 0x04) and (dor & 0x04):
+            # reset released; every drive reports a ready change
+            self._resetController()
+            for ds in range(0, 4):
+                self._interrupt(ST0_READY_CHANGE | ds, self.drives[ds].pcn)
+
+        for (ds, drive) in enumerate(self.drives):
+            if dor & (0x10 << ds):
+                if drive.motorOnAt is None:
+                    drive.motorOnAt = self.clock
+            else:
+                drive.motorOnAt = None
+        self.dor = dor
+
+    def write_dcr(self, dcr):
+        self.dcr = dcr & 0x03
+
+    def pulse_dack(self):
+        # TC; terminates the execution phase normally
+        if (self.phase in [PH_EXEC_READ, PH_EXEC_WRITE]) and not self.xfer.get("format"):
+            self._execEnd(0, 0, 0, tc=True)
+
+    # ------------ commands -----------------
+
+    def _command(self):
+        self.commands += 1
+        op = self.cmd[0] & 0x1F
+        self.cmd = self.cmd[:CMD_LEN.get(op, 1)]
+        handler = {CFD_READ: self._cmdRead,
+                   CFD_READDEL: self._cmdRead,
+                   CFD_WRITE: self._cmdWrite,
+                   CFD_WRITEDEL: self._cmdWrite,
+                   CFD_READTRK: self._cmdReadTrack,
+                   CFD_READID: self._cmdReadID,
+                   CFD_SCANEQ: self._cmdScan,
+                   CFD_SCANLOEQ: self._cmdScan,
+                   CFD_SCANHIEQ: self._cmdScan,
+                   CFD_FMTTRK: self._cmdFormat,
+                   CFD_RECAL: self._cmdRecal,
+                   CFD_SENSEINT: self._cmdSenseInt,
+                   CFD_SPECIFY: self._cmdSpecify,
+                   CFD_DRVSTAT: self._cmdDriveStat,
+                   CFD_SEEK: self._cmdSeek,
+                   CFD_VERSION: self._cmdVersion}.get(op, self._cmdInvalid)
+        handler()
+
+    def _setResult(self, result):
+        self.result = [x & 0xFF for x in result]
+        if self.result:
+            self.phase = PH_RESULT
+        else:
+            self.phase = PH_IDLE
+        self.cmd = []
+
+    def _cmdInvalid(self):
+        self._setResult([ST0_INVCMD])
+
+    def _cmdVersion(self):
+        self._setResult([0x80])
+
+    def _cmdSpecify(self):
+        self.srt = self.cmd[1] >> 4
+        if not self.fixedStepTime:
+            # step rate time is in 1 ms units at 500 kbps, 2 ms at 250 kbps
+            self.stepTime = (16 - self.srt) * 1000
+            if self.dcr != 0:
+                self.stepTime *= 2
+        self._setResult([])
+
+    def _cmdDriveStat(self):
+        ds = self.cmd[1] & 0x03
+        hd = (self.cmd[1] >> 2) & 0x01
+        drive = self.drives[ds]
+        st3 = ds | (hd << 2)
+        if drive.disk is not None:
+            if drive.disk.numHead > 1:
+                st3 |= 0x08
+            if drive.disk.writeProtect:
+                st3 |= 0x40
+        if self._ready(drive):
+            st3 |= 0x20
+        if drive.headPos == 0:
+            st3 |= 0x10
+        self._setResult([st3])
+
+    def _seekTo(self, drive, ds, ncn, maxSteps=None):
+        self._finishSeek(drive)
+        self.seeks += 1
+        steps = abs(ncn - drive.pcn)
+        st0 = ST0_SEEK_END | ds
+        if maxSteps is not None:
+            # recalibrate; only steps out so far looking for track 0
+            steps = min(drive.headPos, maxSteps)
+            drive.headPos -= self._stepsTaken(steps)
+            if drive.headPos != 0:
+                st0 |= ST0_ABTERM | ST0_EQUIP_CHECK
+        else:
+            drive.headPos += self._stepsTaken(ncn - drive.pcn)
+            if self.seekErrorRate and (self.random.random() < self.seekErrorRate):
+                drive.headPos += self.random.choice([-1, 1])
+            drive.headPos = max(0, min(drive.numCyl - 1, drive.headPos))
+        drive.pcn = ncn
+        self.steps += steps
+        drive.seekDone = self.clock + steps * self.stepTime + self.settleTime
+        self._interrupt(st0, ncn, at=drive.seekDone)
+        self._setResult([])
+
+    def _stepsTaken(self, steps):
+        # how many of the step pulses the drive actually follows
+        if self.minStepTime and (self.stepTime < self.minStepTime):
+            return int(steps * float(self.stepTime) / self.minStepTime)
+        return steps
+
+    def _cmdSeek(self):
+        ds = self.cmd[1] & 0x03
+        self._seekTo(self.drives[ds], ds, self.cmd[2])
+
+    def _cmdRecal(self):
+        ds = self.cmd[1] & 0x03
+        self._seekTo(self.drives[ds], ds, 0, maxSteps=77)
+
+    def _cmdSenseInt(self):
+        for i in range(0, len(self.interrupts)):
+            (at, st0, pcn) = self.interrupts[i]
+            if at <= self.clock:
+                del self.interrupts[i]
+                self._setResult([st0, pcn])
+                return
+        self._setResult([ST0_INVCMD])
+
+    def _abterm(self, st1, st2=0, revolutions=2):
+        # the controller gives up after seeing the index hole twice
+        self._advance(revolutions * self.period)
+        ds = self.cmd[1] & 0x03
+        hd = (self.cmd[1] >> 2) & 0x01
+        self._setResult([ST0_ABTERM | (hd << 2) | ds, st1, st2] + (self.cmd + [0] * 4)[2:6])
+
+    def _notReady(self):
+        ds = self.cmd[1] & 0x03
+        hd = (self.cmd[1] >> 2) & 0x01
+        self._setResult([ST0_ABTERM | ST0_NOT_READY | (hd << 2) | ds, 0, 0] + (self.cmd + [0] * 4)[2:6])
+
+    def _cmdReadID(self):
+        drive = self._drive()
+        hd = (self.cmd[1] >> 2) & 0x01
+        if drive.disk is None:
+            return self._notReady()
+        self._finishSeek(drive)
+        sectors = self._track(drive, hd)
+        if (not self._ready(drive)) or (not sectors):
+            return self._abterm(ST1_MISS_ADR)
+        index = self._nextSlot(sectors)
+        self._waitSlot(sectors, index)
+        sector = sectors[index]
+        self._setResult([(hd << 2) | (self.cmd[1] & 0x03), 0, 0, sector.c, sector.h, sector.r, sector.n])
+
+    def _findSector(self, drive, c, h, r, n):
+        # returns (slot index, sector), or (None, st2) if it isn't on the track
+        sectors = self._track(drive, (self.cmd[1] >> 2) & 0x01)
+        if not sectors:
+            return (None, None)
+        st2 = 0
+        start = self._nextSlot(sectors)
+        for i in range(0, len(sectors)):
+            index = (start + i) % len(sectors)
+            sector = sectors[index]
+            if (sector.r == r) and (sector.h == h) and (sector.n == n):
+                if sector.c == c:
+                    return (index, sector)
+                st2 |= ST2_WRONG_CYL
+        return (None, st2)
+
+    def _startXfer(self, writing, scan=None, raw=False):
+        drive = self._drive()
+        if drive.disk is None:
+            return self._notReady()
+        self._finishSeek(drive)
+        if not self._ready(drive):
+            return self._abterm(ST1_MISS_ADR)
+        if writing and drive.disk.writeProtect:
+            return self._setResult([ST0_ABTERM | (self.cmd[1] & 0x07), ST1_NOT_WRIT, 0] + self.cmd[2:6])
+
+        self.xfer = {"drive": drive,
+                     "writing": writing,
+                     "c": self.cmd[2],
+                     "h": self.cmd[3],
+                     "r": self.cmd[4],
+                     "n": self.cmd[5],
+                     "eot": self.cmd[6],
+                     "mt": (self.cmd[0] & 0x80) != 0,
+                     "scan": scan,
+                     "raw": raw,
+                     "slot": 0,
+                     "st1": 0}
+        if raw:
+            # READ TRACK starts at the index hole
+            self._advance((self.period - (self.clock % self.period)) % self.period)
+        self._xferSector()
+
+    def _xferSector(self):
+        xfer = self.xfer
+        if xfer["raw"]:
+            return self._xferRawSector()
+        (index, sector) = self._findSector(xfer["drive"], xfer["c"], xfer["h"], xfer["r"], xfer["n"])
+        if index is None:
+            if sector is None:
+                return self._abterm(ST1_MISS_ADR)
+            return self._abterm(ST1_NO_DATA, sector)
+
+        disk = xfer["drive"].disk
+        bad = disk.badSectors.get((sector.c, sector.h, sector.r))
+        if bad == "missing":
+            return self._abterm(ST1_NO_DATA)
+
+        sectors = self._track(xfer["drive"], (self.cmd[1] >> 2) & 0x01)
+        xfer["start"] = self._waitSlot(sectors, index)
+        xfer["sector"] = sector
+        xfer["pos"] = 0
+        xfer["crc"] = (bad == "crc") or (self.errorRate and (self.random.random() < self.errorRate))
+        if xfer["scan"] is not None:
+            # the CPU supplies comparison bytes, so it looks like a write
+            xfer["equal"] = True
+            xfer["satisfied"] = True
+            self.phase = PH_EXEC_WRITE
+        elif xfer["writing"]:
+            xfer["data"] = bytearray(len(sector.data))
+            self.phase = PH_EXEC_WRITE
+        else:
+            self.phase = PH_EXEC_READ
+
+    def _xferRawSector(self):
+        # READ TRACK takes the sectors in physical order, whatever their IDs
+        # say, and doesn't stop for errors
+        xfer = self.xfer
+        sectors = self._track(xfer["drive"], (self.cmd[1] >> 2) & 0x01)
+        if not sectors:
+            return self._abterm(ST1_MISS_ADR)
+        index = xfer["slot"] % len(sectors)
+        sector = sectors[index]
+        if sector.r != xfer["r"]:
+            xfer["st1"] |= ST1_NO_DATA
+        bad = xfer["drive"].disk.badSectors.get((sector.c, sector.h, sector.r))
+        if (bad == "crc") or (self.errorRate and (self.random.random() < self.errorRate)):
+            xfer["st1"] |= ST1_DATA_ERR
+        xfer["start"] = self._waitSlot(sectors, index)
+        xfer["sector"] = sector
+        xfer["pos"] = 0
+        xfer["crc"] = False
+        self.phase = PH_EXEC_READ
+
+    def _cmdRead(self):
+        self._startXfer(False)
+
+    def _cmdReadTrack(self):
+        self._startXfer(False, raw=True)
+
+    def _cmdWrite(self):
+        self._startXfer(True)
+
+    def _cmdScan(self):
+        self._startXfer(False, scan=self.cmd[0] & 0x1F)
+
+    def _execRead(self):
+        self._execPoll()
+        if self.phase != PH_EXEC_READ:
+            return 0xFF
+        xfer = self.xfer
+        # the byte isn't there until the disk has turned far enough
+        self.clock = max(self.clock, xfer["start"] + (xfer["pos"] + 1) * self._byteTime())
+        d = xfer["sector"].data[xfer["pos"]]
+        xfer["pos"] += 1
+        return d
+
+    def _execWrite(self, d):
+        self._execPoll()
+        if self.phase != PH_EXEC_WRITE:
+            return
+        xfer = self.xfer
+        self.clock = max(self.clock, xfer["start"] + (xfer["pos"] + 1) * self._byteTime())
+        if xfer["scan"] is not None:
+            return self._scanByte(d)
+        xfer["data"][xfer["pos"]] = d
+        xfer["pos"] += 1
+        if xfer["pos"] == len(xfer["data"]):
+            xfer["sector"].data = xfer["data"]
+            xfer["drive"].disk.dirty = True
+
+    def _scanByte(self, d):
+        xfer = self.xfer
+        sector = xfer["sector"]
+        disk = sector.data[xfer["pos"]]
+        xfer["pos"] += 1
+        # 0xFF on either side matches anything
+        if (d != 0xFF) and (disk != 0xFF):
+            if disk != d:
+                xfer["equal"] = False
+            if (xfer["scan"] == CFD_SCANEQ) and (disk != d):
+                xfer["satisfied"] = False
+            elif (xfer["scan"] == CFD_SCANLOEQ) and (disk > d):
+                xfer["satisfied"] = False
+            elif (xfer["scan"] == CFD_SCANHIEQ) and (disk < d):
+                xfer["satisfied"] = False
+        if xfer["pos"] < len(sector.data):
+            return
+
+        # sector done; decide right away so TC after the last byte can't hide it
+        if xfer["crc"]:
+            return self._execEnd(ST0_ABTERM, ST1_DATA_ERR, ST2_DATA_ERR)
+        if xfer["satisfied"]:
+            # R is left on the sector that satisfied the scan
+            if xfer["equal"]:
+                return self._execEnd(0, 0, ST2_SCAN_HIT, nextR=False)
+            return self._execEnd(0, 0, 0, nextR=False)
+        xfer["r"] += max(1, self.cmd[8])
+        if xfer["r"] > xfer["eot"]:
+            xfer["r"] = xfer["eot"]
+            return self._execEnd(ST0_ABTERM, ST1_END_CYL, ST2_SCAN_NOT)
+        self._xferSector()
+
+    def _execPoll(self):
+        # Once a whole sector has been moved, the controller goes on to the
+        # next one unless TC stopped it first.
+        xfer = self.xfer
+        if (xfer is None) or ("sector" not in xfer) or (xfer["pos"] < len(xfer["sector"].data)):
+            return
+        if xfer["scan"] is not None:
+            # _scanByte has already moved on
+            return
+        if xfer["crc"]:
+            return self._execEnd(ST0_ABTERM, ST1_DATA_ERR, ST2_DATA_ERR)
+        if xfer["raw"]:
+            xfer["slot"] += 1
+            if xfer["slot"] >= xfer["eot"]:
+                return self._execEnd(ST0_ABTERM, ST1_END_CYL | xfer["st1"], 0)
+            xfer["r"] += 1
+            return self._xferSector()
+        if xfer["r"] >= xfer["eot"]:
+            if xfer["mt"] and ((self.cmd[1] & 0x04) == 0):
+                # multi-track; continue on head 1
+                self.cmd[1] |= 0x04
+                xfer["h"] = 1
+                xfer["r"] = 1
+                return self._xferSector()
+            return self._execEnd(ST0_ABTERM, ST1_END_CYL, 0)
+        xfer["r"] += 1
+        self._xferSector()
+
+    def _execEnd(self, st0, st1, st2, tc=False, nextR=True):
+        xfer = self.xfer
+        if tc and ("sector" in xfer) and (xfer["pos"] >= len(xfer["sector"].data)) and xfer["crc"]:
+            # the sector that was just finished failed its CRC check
+            st0, st1, st2 = ST0_ABTERM, ST1_DATA_ERR, ST2_DATA_ERR
+        if tc and xfer.get("st1"):
+            # READ TRACK kept going past these
+            st0, st1 = ST0_ABTERM, st1 | xfer["st1"]
+        r = xfer["r"]
+        if (st0 == 0) and nextR:
+            r += 1
+        self.xfer = None
+        self._setResult([st0 | (self.cmd[1] & 0x07), st1, st2, xfer["c"], xfer["h"], r, xfer["n"]])
+
+    def _cmdFormat(self):
+        drive = self._drive()
+        if drive.disk is None:
+            return self._notReady()
+        self._finishSeek(drive)
+        if not self._ready(drive):
+            return self._abterm(ST1_MISS_ADR)
+        if drive.disk.writeProtect:
+            return self._setResult([ST0_ABTERM | (self.cmd[1] & 0x07), ST1_NOT_WRIT, 0, 0, 0, 0, 0])
+
+        # formatting starts at the index hole
+        self._advance((self.period - (self.clock % self.period)) % self.period)
+        self.xfer = {"format": True, "drive": drive, "ids": [], "bytes": []}
+        self.phase = PH_EXEC_WRITE
+
+    def _formatByte(self, d):
+        xfer = self.xfer
+        xfer["bytes"].append(d)
+        if len(xfer["bytes"]) == 4:
+            xfer["ids"].append(tuple(xfer["bytes"]))
+            xfer["bytes"] = []
+        n = self.cmd[2]
+        sc = self.cmd[3]
+        if len(xfer["ids"]) == sc:
+            drive = xfer["drive"]
+            hd = (self.cmd[1] >> 2) & 0x01
+            drive.disk.formatTrack(self._physTrack(drive), hd, xfer["ids"], self.cmd[5])
+            self._advance(self.period)
+            last = xfer["ids"][-1]
+            self.xfer = None
+            self._setResult([self.cmd[1] & 0x07, 0, 0, last[0], last[1], last[2], n])
+
+    # ------------ wd37c65_direct_ext function surface -----------------
+
+    def init(self):
+        self._resetController()
+
+    def reset(self, dor):
+        self.write_dor(0)
+        self.delay_microseconds(17)
+        self.write_dor(dor)
+        self.delay_microseconds(2400)
+
+    def delay_microseconds(self, amount):
+        self._advance(amount)
+        return 0
+
+    def enable_my_delay_micros(self):
+        return 0
+
+    def micros(self):
+        self._sync()
+        return int(self.clock) & 0xFFFFFFFF
+
+    def wait_msr(self, mask, val):
+        self._advance(3)
+        if (self.get_msr() & mask) == val:
+            return 0
+        # nothing changes by just waiting, except for seeks finishing
+        for drive in self.drives:
+            self._finishSeek(drive)
+        if (self.get_msr() & mask) == val:
+            return 0
+        self._advance(3 * 65535 * 3)
+        print("waitmsr timedout with %02X" % self.get_msr(), file=sys.stderr)
+        return RESULT_TIMEOUT_EXEC
+
+    def _waitExec(self, val, abortStatus):
+        self._advance(3)
+        msr = self.get_msr()
+        if msr == val:
+            return 0
+        if msr == 0xD0:
+            return abortStatus
+        self._advance(3 * 65535 * 3)
+        print("waitexec timedout with %02X" % msr, file=sys.stderr)
+        return RESULT_TIMEOUT_EXEC
+
+    def write_command(self, buf, count):
+        for i in range(0, count):
+            status = self.wait_msr(0xC0, 0x80)
+            if status != 0:
+                print("write_command status %2X on byte %d" % (status, i), file=sys.stderr)
+                return status
+            self.write_data(ord(buf[i]))
+        return 0
+
+    def _readBlock(self, count, blockSize=0, times=None):
+        buf = bytearray(count)
+        for i in range(0, count):
+            status = self._waitExec(0xF0, RESULT_READ_ERROR)
+            if status != 0:
+                print("read_block aborting on index %d with status %02X" % (i, status), file=sys.stderr)
+                return (status, str(buf))
+            buf[i] = self._readData()
+            if (times is not None) and ((i % blockSize) == 0):
+                times.append(self.micros())
+        self.pulse_dack()
+        return (0, str(buf))
+
+    def read_block(self, count):
+        return self._readBlock(count)
+
+    def read_block_into(self, buf, offset, count):
+        if offset + count > len(buf):
+            raise ValueError("offset + count is past the end of the buffer")
+        (status, data) = self._readBlock(count)
+        buf[offset:offset + count] = data
+        return status
+
+    def write_block(self, buf, count, autoTerminate=True):
+        for i in range(0, count):
+            status = self._waitExec(0xB0, RESULT_WRITE_ERROR)
+            if status != 0:
+                print("write_block aborting on index %d with status %02X" % (i, status), file=sys.stderr)
+                return status
+            d = buf[i]
+            if not isinstance(d, int):
+                d = ord(d)
+            self.write_data(d)
+        if autoTerminate:
+            self.pulse_dack()
+        return 0
+
+    def _scanBlock(self, buf, count):
+        for i in range(0, count):
+            status = self._waitExec(0xB0, RESULT_WRITE_ERROR)
+            if status == RESULT_WRITE_ERROR:
+                # the scan was satisfied, or ran off the end of the track
+                return 0
+            if status != 0:
+                print("scan_block aborting on index %d with status %02X" % (i, status), file=sys.stderr)
+                return status
+            d = buf[i]
+            if not isinstance(d, int):
+                d = ord(d)
+            self.write_data(d)
+        self.pulse_dack()
+        return 0
+
+    def read_result(self):
+        result = ""
+        maxTime = 10000
+        while maxTime > 0:
+            self._advance(10)
+            msr = self.get_msr()
+            if (msr & 0xF0) == 0xD0:
+                result += chr(self._readData())
+                maxTime = 10000
+            elif (msr & 0xF0) == 0x80:
+                return (0, result)
+            else:
+                # nothing is going to change by waiting
+                return (RESULT_TIMEOUT_READRES, result)
+            if len(result) > 128:
+                return (RESULT_OVER_CMDRES, result)
+        return (RESULT_TIMEOUT_READRES, result)
+
+    def execute_into(self, cmd, kind, buf, offset, count):
+        if (kind in [EXEC_READ, EXEC_WRITE, EXEC_SCAN]) and (offset + count > len(buf)):
+            raise ValueError("offset + count is past the end of the buffer")
+        if kind == EXEC_READ:
+            (status, data, result) = self.execute(cmd, kind, "", count)
+            buf[offset:offset + count] = data
+        else:
+            (status, data, result) = self.execute(cmd, kind, buf[offset:offset + count], count)
+        return (status, result)
+
+    def _waitIdle(self, timeout):
+        # wd_wait_idle: until RQM=1, DIO=0, CB=0, returning the last MSR
+        while True:
+            msr = self.get_msr()
+            if ((msr & 0xD0) == 0x80) or (timeout < 3):
+                return msr
+            self._advance(3)
+            timeout -= 3
+
+    def drain(self):
+        for i in range(0, 1024):
+            self._advance(10)
+            if (self.get_msr() & 0xC0) != 0xC0:
+                return 0
+            self._readData()
+        return RESULT_OVER_DRAIN
+
+    def execute(self, cmd, kind, buf, count):
+        return self._execute(cmd, kind, buf, count)
+
+    def execute_timed(self, cmd, kind, count, blockSize):
+        if kind not in [EXEC_READ, EXEC_READID]:
+            raise ValueError("only EXEC_READ and EXEC_READID can be timed")
+        if blockSize == 0:
+            blockSize = max(count, 1)
+        times = []
+        (status, data, result) = self._execute(cmd, kind, "", count, blockSize, times)
+        return (status, data, result, tuple(times))
+
+    def _execute(self, cmd, kind, buf, count, blockSize=0, times=None):
+        status = self.drain()
+        if status != 0:
+            return (status, "", "")
+
+        if (self._waitIdle(1000) & 0x90) == 0x90:
+            return (RESULT_INPROCESS, "", "")
+
+        status = self.write_command(cmd, len(cmd))
+        if status != 0:
+            return (status, "", "")
+
+        if times is not None:
+            times.append(self.micros())
+
+        data = ""
+        if kind == EXEC_READ:
+            (status, data) = self._readBlock(count, blockSize, times)
+        elif kind == EXEC_WRITE:
+            if len(buf) < count:
+                raise ValueError("buffer is shorter than count")
+            status = self.write_block(buf, count, True)
+        elif kind == EXEC_READID:
+            status = self.wait_msr(0xE0, 0xC0)
+            if (times is not None) and (status == 0):
+                times.append(self.micros())
+        elif kind == EXEC_SCAN:
+            if len(buf) < count:
+                raise ValueError("buffer is shorter than count")
+            status = self._scanBlock(buf, count)
+        else:
+            status = 0
+
+        if status not in [0, RESULT_READ_ERROR, RESULT_WRITE_ERROR]:
+            return (status, data, "")
+
+        (status, result) = self.read_result()
+        return (status, data, result)
+
+
+def main():
+    # Compare a few access patterns on an emulated 1.44M disk
+    from fdc import FDC
+
+    def run(name, fn, **kwargs):
+        emul = WD37C65Emulator(disks=[emulatedDisk("144")], seed=1)
+        fdc = FDC(media="144", verbose=False, backend=emul, motorIdleTime=0, **kwargs)
+        fdc.init()
+        start = emul.clock
+        fn(fdc)
+        fdc.done()
+        print("%-30s %8.2f s  %5d seeks  %6d steps  %5d commands" % \
+              (name, (emul.clock - start) / 1000000.0, emul.seeks, emul.steps, emul.commands))
+
+    rand = random.Random(1)
+    sectors = [(rand.randrange(0, 80), rand.randrange(0, 2), rand.randrange(1, 19)) for i in range(0, 200)]
+
+    run("random, one at a time", lambda fdc: [fdc.read(c, h, r) for (c, h, r) in sectors])
+    run("random, readMany", lambda fdc: fdc.readMany(sectors))
+    run("random twice, cached", lambda fdc: [fdc.read(c, h, r) for (c, h, r) in sectors * 2], cacheTracks=160)
+    run("sequential sectors", lambda fdc: [fdc.read(c, h, r) for c in range(0, 80) for h in range(0, 2) for r in range(1, 19)])
+    run("sequential tracks", lambda fdc: [fdc.readTrack(c, h) for c in range(0, 80) for h in range(0, 2)])
+
+
+if __name__ == "__main__":
+    main()
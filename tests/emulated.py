@@ -0,0 +1,29 @@
+# Emulated controllers and disks for the tests
+# Scott Baker, https://www.smbaker.com/
+
+from smbpi.fdc import FDC
+from smbpi.wd37c65_emul import WD37C65Emulator, emulatedDisk
+
+def sectorPattern(cyl, head, record, size, seed=0):
+    # different data in every sector, and on every seed
+    stamp = "%d/%d/%d/%d " % (seed, cyl, head, record)
+    return (stamp * (size // len(stamp) + 1))[:size]
+
+def patternDisk(media="360", seed=0, **kwargs):
+    disk = emulatedDisk(media, **kwargs)
+    for ((cyl, head), sectors) in disk.tracks.items():
+        for sector in sectors:
+            sector.data = bytearray(sectorPattern(cyl, head, sector.r, len(sector.data), seed))
+    disk.dirty = False
+    return disk
+
+def emulatedFDC(disks, media="360", minStepTime=None, **kwargs):
+    # The drives are as big as the disks, since FDC doesn't double step a
+    # 40 track disk in an 80 track drive. motorIdleTime defaults to 0 so
+    # that no motor timers outlive a test.
+    driveCyls = max([disk.numCyl for disk in disks if disk is not None])
+    backend = WD37C65Emulator(disks=disks, driveCyls=driveCyls, minStepTime=minStepTime)
+    kwargs.setdefault("motorIdleTime", 0)
+    fdc = FDC(media=media, verbose=False, backend=backend, **kwargs)
+    fdc.init()
+    return fdc
@@ -0,0 +1,139 @@
+# Tests for the FAT12 reader against the emulated controller
+# Scott Baker, https://www.smbaker.com/
+
+import random
+import struct
+import unittest
+
+from smbpi.fat12 import FAT12, FAT12Exception
+from smbpi.fdc import CFD_READ
+from smbpi.wd37c65_emul import emulatedDisk
+from emulated import emulatedFDC
+
+# 360K: bytes per sector, sectors per cluster, reserved, FATs, root entries,
+# total sectors, media byte, sectors per FAT, sectors per track, heads
+BPB = (512, 2, 1, 2, 112, 720, 0xFD, 2, 9, 2)
+
+class FATBuilder:
+    # Just enough of a FAT12 formatter to lay out a few files
+    def __init__(self):
+        (self.bps, self.spc, reserved, self.numFATs, rootEntries, total, media, self.spf, spt, heads) = BPB
+        self.image = bytearray(total * self.bps)
+        self.image[11:28] = struct.pack("<HBHBHHBHHH", *BPB)
+        self.image[510:512] = "\x55\xAA"
+        self.fatStart = reserved
+        self.rootStart = reserved + self.numFATs * self.spf
+        self.dataStart = self.rootStart + rootEntries * 32 // self.bps
+        self.fat = bytearray(self.spf * self.bps)
+        self.setFAT(0, 0xF00 | media)
+        self.setFAT(1, 0xFFF)
+        self.nextCluster = 2
+        self.root = []
+
+    def setFAT(self, cluster, value):
+        offset = cluster * 3 // 2
+        if cluster & 1:
+            self.fat[offset] = (self.fat[offset] & 0x0F) | ((value << 4) & 0xF0)
+            self.fat[offset + 1] = (value >> 4) & 0xFF
+        else:
+            self.fat[offset] = value & 0xFF
+            self.fat[offset + 1] = (self.fat[offset + 1] & 0xF0) | ((value >> 8) & 0x0F)
+
+    def store(self, data, gap=0):
+        # write data to a chain of clusters, leaving gap free clusters
+        # between each one so the file is fragmented
+        clusterSize = self.spc * self.bps
+        clusters = []
+        for i in range(0, max(1, (len(data) + clusterSize - 1) // clusterSize)):
+            clusters.append(self.nextCluster)
+            self.nextCluster += 1 + gap
+        for (i, cluster) in enumerate(clusters):
+            if i + 1 < len(clusters):
+                self.setFAT(cluster, clusters[i + 1])
+            else:
+                self.setFAT(cluster, 0xFFF)
+            offset = (self.dataStart + (cluster - 2) * self.spc) * self.bps
+            chunk = data[i * clusterSize:(i + 1) * clusterSize]
+            self.image[offset:offset + len(chunk)] = chunk
+        return clusters[0]
+
+    def entry(self, name, attr, cluster, size):
+        raw = bytearray(32)
+        raw[0:11] = name
+        raw[11] = attr
+        raw[22:32] = struct.pack("<HHHI", 0, 0, cluster, size)
+        return raw
+
+    def finish(self):
+        for i in range(0, self.numFATs):
+            offset = (self.fatStart + i * self.spf) * self.bps
+            self.image[offset:offset + len(self.fat)] = self.fat
+        root = "".join([str(e) for e in self.root])
+        offset = self.rootStart * self.bps
+        self.image[offset:offset + len(root)] = root
+        return str(self.image)
+
+
+class FAT12Test(unittest.TestCase):
+    def setUp(self):
+        r = random.Random(1)
+        self.big = "".join([chr(r.randrange(0, 256)) for i in range(0, 20000)])
+        self.hello = "hello world\r\n"
+        self.nested = "in a subdirectory " * 100
+
+        fat = FATBuilder()
+        bigCluster = fat.store(self.big, gap=1)
+        helloCluster = fat.store(self.hello)
+        nestedCluster = fat.store(self.nested)
+        subdir = fat.entry(".          ", 0x10, 0, 0) + fat.entry("..         ", 0x10, 0, 0) + \
+                 fat.entry("NESTED  TXT", 0x20, nestedCluster, len(self.nested))
+        subdirCluster = fat.store(str(subdir))
+        fat.root = [fat.entry("MYDISK     ", 0x08, 0, 0),
+                    fat.entry("BIG     BIN", 0x20, bigCluster, len(self.big)),
+                    fat.entry("\xE5ELETED TXT", 0x20, helloCluster, 5),
+                    fat.entry("HELLO   TXT", 0x20, helloCluster, len(self.hello)),
+                    fat.entry("SUBDIR     ", 0x10, subdirCluster, 0)]
+
+        disk = emulatedDisk("360")
+        disk.loadImage(fat.finish())
+        self.fdc = emulatedFDC([disk], traceSize=4096)
+        self.fs = FAT12(self.fdc)
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def readCount(self):
+        return len([e for e in self.fdc.trace.entries if (ord(e[0][0]) & 0x1F) == CFD_READ])
+
+    def test_listdir(self):
+        self.assertEqual([e.name for e in self.fs.listdir("/")], ["BIG.BIN", "HELLO.TXT", "SUBDIR"])
+        self.assertEqual([e.name for e in self.fs.listdir("/subdir")], ["NESTED.TXT"])
+
+    def test_read_files(self):
+        self.assertEqual("".join(self.fs.readFile("/HELLO.TXT")), self.hello)
+        self.assertEqual("".join(self.fs.readFile("big.bin")), self.big)
+        self.assertEqual("".join(self.fs.readFile("/SubDir/Nested.txt")), self.nested)
+
+    def test_stat(self):
+        entry = self.fs.stat("/big.bin")
+        self.assertEqual((entry.name, entry.size, entry.isDir()), ("BIG.BIN", len(self.big), False))
+        self.assertTrue(self.fs.stat("/subdir").isDir())
+
+    def test_errors(self):
+        self.assertRaises(FAT12Exception, self.fs.stat, "/missing.txt")
+        self.assertRaises(FAT12Exception, lambda: list(self.fs.readFile("/subdir")))
+        self.assertRaises(FAT12Exception, self.fs.listdir, "/hello.txt")
+
+    def test_mount_cached_until_disk_change(self):
+        self.fs.listdir("/")
+        self.fdc.trace.reset()
+        self.fs.listdir("/")
+        self.assertEqual(self.readCount(), 0)
+
+        self.fdc._diskChanged(0)
+        self.fs.listdir("/")
+        self.assertTrue(self.readCount() > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,672 @@
+# Tests for FDC against the emulated controller
+# Scott Baker, https://www.smbaker.com/
+#
+# Run from the top of the repository with:
+#
+#     python -m unittest discover -s tests
+
+import gc
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+import weakref
+
+import smbpi.fdc
+from smbpi.fdc import CFD_READ, CFD_RECAL, CFD_SEEK, CFD_SPECIFY, FDCException, FRC_DATAERR, FRC_ERROR, FRC_MISADR, FRC_OK, FRC_SHORT
+from emulated import emulatedFDC, patternDisk, sectorPattern
+
+TRACKS_360 = 40 * 2
+SECTORS_360 = TRACKS_360 * 9
+
+class Interrupted(Exception):
+    pass
+
+
+class ImageDiskTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "disk.img")
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk])
+        self.imageTrack = self.fdc._imageTrack
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def countTracks(self, stopAfter=None):
+        # wrap _imageTrack to see which tracks get read, and optionally
+        # blow up part way through like a ^C would
+        tracks = []
+        def counting(f, cyl, head, bad):
+            if len(tracks) == stopAfter:
+                raise Interrupted()
+            tracks.append((cyl, head))
+            self.imageTrack(f, cyl, head, bad)
+        self.fdc._imageTrack = counting
+        return tracks
+
+    def test_image(self):
+        self.assertEqual(self.fdc.imageDisk(self.fileName), 0)
+        self.assertEqual(open(self.fileName, "rb").read(), self.disk.image())
+
+    def test_resume_after_interrupt(self):
+        tracks = self.countTracks(stopAfter=10)
+        self.assertRaises(Interrupted, self.fdc.imageDisk, self.fileName)
+        self.assertEqual(len(tracks), 10)
+
+        tracks = self.countTracks()
+        self.assertEqual(self.fdc.imageDisk(self.fileName), 0)
+        self.assertEqual(len(tracks), TRACKS_360 - 10)
+        self.assertEqual(open(self.fileName, "rb").read(), self.disk.image())
+
+    def test_image_synced_before_map(self):
+        # every map rename comes after an fsync of the image file, including
+        # the one after the bad sectors are retried
+        self.disk.badSectors[(5, 1, 4)] = "crc"
+        events = []
+        (fsync, rename) = (os.fsync, os.rename)
+        def syncing(fd):
+            events.append(("fsync", os.readlink("/proc/self/fd/%d" % fd)))
+            fsync(fd)
+        def renaming(src, dst):
+            events.append(("rename", dst))
+            rename(src, dst)
+        smbpi.fdc.os.fsync = syncing
+        smbpi.fdc.os.rename = renaming
+        try:
+            self.assertEqual(self.fdc.imageDisk(self.fileName, retries=0), 1)
+        finally:
+            (smbpi.fdc.os.fsync, smbpi.fdc.os.rename) = (fsync, rename)
+
+        renames = [i for (i, e) in enumerate(events) if e[0] == "rename"]
+        self.assertEqual(len(renames), TRACKS_360 + 1)
+        for i in renames:
+            self.assertEqual(events[i - 2], ("fsync", self.fileName))
+            self.assertEqual(events[i - 1], ("fsync", self.fileName + ".map.tmp"))
+
+    def test_resume_retries_bad_sectors(self):
+        self.disk.badSectors[(5, 1, 4)] = "crc"
+        self.assertEqual(self.fdc.imageDisk(self.fileName, retries=0), 1)
+        badMap = json.load(open(self.fileName + ".map"))
+        self.assertEqual(badMap["bad"], [[5, 1, 4, FRC_DATAERR]])
+
+        # only the bad sector is read again, not whole tracks
+        del self.disk.badSectors[(5, 1, 4)]
+        tracks = self.countTracks()
+        self.assertEqual(self.fdc.imageDisk(self.fileName, retries=0), 0)
+        self.assertEqual(tracks, [])
+        self.assertEqual(json.load(open(self.fileName + ".map"))["bad"], [])
+        self.assertEqual(open(self.fileName, "rb").read(), self.disk.image())
+
+
+class ReadManyTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = patternDisk("360")
+        # big enough to hold all the SENSE INTERRUPTs while seeking
+        self.fdc = emulatedFDC([self.disk], traceSize=4096)
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def reads(self):
+        return [(ord(fcp[2]), ord(fcp[3]), ord(fcp[4])) for (fcp, fstRC, frb, elapsed) in self.fdc.trace.entries
+                if (ord(fcp[0]) & 0x1F) == CFD_READ]
+
+    def test_elevator_order(self):
+        self.assertEqual(self.fdc.read(20, 0, 1), FRC_OK)
+        self.fdc.trace.reset()
+
+        requests = [(5, 0, 1), (30, 0, 3), (25, 1, 2), (30, 0, 4), (30, 0, 5), (10, 0, 9), (35, 1, 1), (25, 0, 7)]
+        results = self.fdc.readMany(requests)
+
+        # up from cylinder 20, then back down; adjacent records in one command
+        self.assertEqual(self.reads(), [(25, 0, 7), (25, 1, 2), (30, 0, 3), (35, 1, 1), (10, 0, 9), (5, 0, 1)])
+        self.assertEqual(sorted(results.keys()), sorted(requests))
+        for (cyl, head, record) in requests:
+            self.assertEqual(results[(cyl, head, record)], sectorPattern(cyl, head, record, 512))
+
+    def test_bad_sector_in_run(self):
+        self.disk.badSectors[(7, 0, 5)] = "missing"
+        results = self.fdc.readMany([(7, 0, r) for r in range(3, 8)])
+        self.assertEqual(results[(7, 0, 5)], None)
+        for r in [3, 4, 6, 7]:
+            self.assertEqual(results[(7, 0, r)], sectorPattern(7, 0, r, 512))
+
+
+class WriteCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.master = patternDisk("360")
+        self.fdc = emulatedFDC([self.master, None])
+        self.tracks = self.fdc.readMaster()
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def target(self, disk):
+        self.fdc.ext.insert(1, disk)
+        self.fdc.select(1)
+        return disk
+
+    def test_copy(self):
+        for verify in [True, False]:
+            copy = self.target(patternDisk("360", seed=1))
+            stats = self.fdc.writeCopy(self.tracks, verify=verify)
+            self.assertEqual(stats["badTracks"], [])
+            self.assertEqual(stats["differing"], SECTORS_360)
+            self.assertEqual(stats["written"], SECTORS_360)
+            self.assertEqual(copy.image(), self.master.image())
+
+    def test_only_differing_sectors_written(self):
+        copy = self.target(patternDisk("360"))
+        for (cyl, head, record) in [(3, 0, 4), (3, 0, 5), (20, 1, 9)]:
+            [s for s in copy.tracks[(cyl, head)] if s.r == record][0].data = bytearray("x" * 512)
+
+        stats = self.fdc.writeCopy(self.tracks)
+        self.assertEqual((stats["written"], stats["skipped"], stats["badTracks"]), (3, SECTORS_360 - 3, []))
+        self.assertEqual(copy.image(), self.master.image())
+
+    def test_blank_target_formatted(self):
+        copy = self.target(patternDisk("360", formatted=False))
+        stats = self.fdc.writeCopy(self.tracks)
+        self.assertEqual(stats["formatted"], TRACKS_360)
+        self.assertEqual(stats["badTracks"], [])
+        self.assertEqual(copy.image(), self.master.image())
+
+    def test_write_protected(self):
+        for verify in [True, False]:
+            copy = self.target(patternDisk("360", seed=1))
+            copy.writeProtect = True
+            before = copy.image()
+            stats = self.fdc.writeCopy(self.tracks, verify=verify)
+            self.assertEqual(stats["written"], 0)
+            self.assertEqual(stats["rewritten"], 0)
+            self.assertEqual(len(stats["badTracks"]), TRACKS_360)
+            self.assertEqual(copy.image(), before)
+
+    def test_restore(self):
+        fileName = os.path.join(self.dir, "disk.img")
+        open(fileName, "wb").write(self.master.image())
+        for verify in [True, False]:
+            copy = self.target(patternDisk("360", seed=1))
+            stats = self.fdc.restoreImage(fileName, verify=verify)
+            self.assertEqual((stats["written"], stats["differing"], stats["badTracks"]), (SECTORS_360, SECTORS_360, []))
+            self.assertEqual(copy.image(), self.master.image())
+
+    def test_restore_write_protected(self):
+        fileName = os.path.join(self.dir, "disk.img")
+        open(fileName, "wb").write(self.master.image())
+        for verify in [True, False]:
+            copy = self.target(patternDisk("360", seed=1))
+            copy.writeProtect = True
+            stats = self.fdc.restoreImage(fileName, verify=verify)
+            self.assertTrue(stats["written"] < stats["differing"])
+            self.assertEqual(len(stats["badTracks"]), TRACKS_360)
+
+
+class RetryStatsTest(unittest.TestCase):
+    def test_bad_sector_counted_once(self):
+        disk = patternDisk("360")
+        disk.badSectors[(5, 1, 4)] = "crc"
+        fdc = emulatedFDC([disk])
+        try:
+            statuses = fdc.readTrackSectors(bytearray(9 * 512), 5, 1, retries=2)
+        finally:
+            fdc.done(now=True)
+        self.assertEqual(statuses, [FRC_OK] * 3 + [FRC_DATAERR] + [FRC_OK] * 5)
+        [track] = fdc.healthReport()["tracks"]
+        self.assertEqual((track["failed"], track["errorCount"]), (1, 3))
+
+
+class SurfaceScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.disk = patternDisk("360")
+        self.disk.badSectors[(5, 1, 4)] = "crc"
+        self.fdc = emulatedFDC([self.disk])
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def test_report(self):
+        fileName = os.path.join(self.dir, "surface.json")
+        report = self.fdc.surfaceScan(fileName, retries=1)
+        self.assertEqual(json.load(open(fileName)), json.loads(json.dumps(report)))
+
+        summary = report["summary"]
+        self.assertEqual((summary["sectors"], summary["bad"], summary["retried"]), (SECTORS_360, 1, 1))
+        self.assertEqual(summary["status"], {"OK": SECTORS_360 - 1, "DATAERR": 1})
+        # 9 sectors a revolution at 300 rpm
+        self.assertTrue(abs(summary["microsMedian"] - 200000 // 9) < 1000)
+
+        track = [t for t in report["tracks"] if (t["cyl"], t["head"]) == (5, 1)][0]
+        self.assertEqual(track["status"], [FRC_OK] * 3 + [FRC_DATAERR] + [FRC_OK] * 5)
+        self.assertEqual(track["retries"], [0, 0, 0, 1, 0, 0, 0, 0, 0])
+
+    def test_bad_sector_counted_once(self):
+        self.fdc.surfaceScan(retries=1)
+        [track] = self.fdc.healthReport()["tracks"]
+        self.assertEqual((track["cyl"], track["head"], track["failed"], track["errorCount"]), (5, 1, 1, 2))
+
+
+class ScanTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk])
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def test_match(self):
+        result = self.fdc.scan("0/7/1/3 ")
+        self.assertEqual(result, {"matches": [(7, 1, 3)], "bad": [], "badTracks": []})
+        # every sector on cylinder 12 has its cylinder at offset 2
+        result = self.fdc.scan("12/", offset=2, cylRange=[11, 12, 13])
+        self.assertEqual(result["matches"], [(12, h, r) for h in [0, 1] for r in range(1, 10)])
+
+    def test_failures_returned(self):
+        self.disk.badSectors[(12, 0, 4)] = "crc"
+        self.disk.tracks[(13, 1)] = []
+        result = self.fdc.scan("0/12/0/", cylRange=[12, 13])
+        # the scan carries on past the bad sector
+        self.assertEqual(result["matches"], [(12, 0, r) for r in [1, 2, 3, 5, 6, 7, 8, 9]])
+        self.assertEqual(result["bad"], [(12, 0, 4)])
+        self.assertEqual(result["badTracks"], [(13, 1)])
+
+
+class SelectTest(unittest.TestCase):
+    def setUp(self):
+        self.disks = [patternDisk("720"), patternDisk("144", seed=1)]
+        self.fdc = emulatedFDC(self.disks, media="720", traceSize=4096)
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def commands(self):
+        return [ord(fcp[0]) & 0x1F for (fcp, fstRC, frb, elapsed) in self.fdc.trace.entries]
+
+    def readBack(self, cyl, head, record, seed):
+        self.assertEqual(self.fdc.read(cyl, head, record), FRC_OK)
+        self.assertEqual(self.fdc.dskBuf, sectorPattern(cyl, head, record, 512, seed))
+
+    def test_drives_keep_their_state(self):
+        self.readBack(30, 0, 1, 0)
+        self.fdc.select(1)
+        self.fdc.setMedia("144")
+        self.readBack(60, 1, 17, 1)
+
+        # back and forth on the same cylinders: no recal, no seek, and each
+        # drive still has its own media
+        self.fdc.trace.reset()
+        for i in range(0, 2):
+            self.fdc.select(0)
+            self.assertEqual((self.fdc.mediaName, self.fdc.secCount), ("720", 9))
+            self.readBack(30, 0, 2 + i, 0)
+            self.fdc.select(1)
+            self.assertEqual((self.fdc.mediaName, self.fdc.secCount), ("144", 18))
+            self.readBack(60, 1, 15 + i, 1)
+        self.assertFalse(set(self.commands()) & set([CFD_RECAL, CFD_SEEK]))
+
+    def test_short_sense_interrupt(self):
+        senseInt = self.fdc._senseInt
+        def short():
+            senseInt()
+            self.fdc.frb = self.fdc.frb[:1]
+            self.fdc.frbLen = len(self.fdc.frb)
+            return self.fdc.fstRC
+        self.fdc._senseInt = short
+        with self.assertRaises(FDCException) as cm:
+            self.fdc.read(30, 0, 1)
+        self.assertEqual(cm.exception.fstRC, FRC_SHORT)
+
+
+class TrackCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk], cacheTracks=2, traceSize=4096)
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def reads(self):
+        return [(ord(fcp[2]), ord(fcp[3]), ord(fcp[4])) for (fcp, fstRC, frb, elapsed) in self.fdc.trace.entries
+                if (ord(fcp[0]) & 0x1F) == CFD_READ]
+
+    def readBack(self, cyl, head, record):
+        self.assertEqual(self.fdc.read(cyl, head, record), FRC_OK)
+        return str(self.fdc.dskBuf)
+
+    def test_whole_track_read_once(self):
+        for record in range(1, 10):
+            self.assertEqual(self.readBack(3, 1, record), sectorPattern(3, 1, record, 512))
+        self.assertEqual(self.reads(), [(3, 1, 1)])
+        self.assertEqual((self.fdc.cache.hits, self.fdc.cache.misses), (8, 1))
+
+    def test_least_recently_used_evicted(self):
+        for (cyl, head) in [(3, 0), (4, 0), (3, 0), (5, 0)]:
+            self.readBack(cyl, head, 2)
+        self.fdc.trace.reset()
+        self.readBack(3, 0, 5)
+        self.readBack(4, 0, 5)
+        self.assertEqual(self.reads(), [(4, 0, 1)])
+
+    def test_write_through(self):
+        self.readBack(6, 0, 1)
+        self.assertEqual(self.fdc.writeSectors(6, 0, 4, 2, "x" * 1024), FRC_OK)
+        self.fdc.trace.reset()
+        self.assertEqual(self.readBack(6, 0, 4) + self.readBack(6, 0, 5), "x" * 1024)
+        self.assertEqual(self.readBack(6, 0, 6), sectorPattern(6, 0, 6, 512))
+        self.assertEqual(self.reads(), [])
+        self.assertEqual([str(s.data) for s in self.disk.tracks[(6, 0)] if s.r == 4], ["x" * 512])
+
+    def test_write_to_uncached_track(self):
+        self.assertEqual(self.fdc.writeSectors(7, 1, 2, 1, "y" * 512), FRC_OK)
+        self.assertEqual(self.readBack(7, 1, 2), "y" * 512)
+        self.assertEqual(self.reads(), [(7, 1, 1)])
+
+    def test_bad_sector_not_cached(self):
+        self.disk.badSectors[(8, 0, 3)] = "crc"
+        self.assertEqual(self.readBack(8, 0, 5), sectorPattern(8, 0, 5, 512))
+        self.assertEqual(self.fdc.read(8, 0, 3), FRC_DATAERR)
+        self.assertEqual(len(self.fdc.cache.tracks), 0)
+
+
+class ReadTracksTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk])
+        self.read = []
+        readTrack = self.fdc.readTrack
+        def counting(cyl, head, retries=0):
+            self.read.append((cyl, head))
+            return readTrack(cyl, head, retries)
+        self.fdc.readTrack = counting
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def waitForReads(self, count):
+        # until the reader thread has got as far as it's going to
+        deadline = time.time() + 10
+        while (len(self.read) < count) and (time.time() < deadline):
+            time.sleep(0.01)
+        time.sleep(0.2)
+        return len(self.read)
+
+    def test_all_tracks(self):
+        for readAhead in [0, 2]:
+            image = "".join([str(data) for (cyl, head, status, data) in self.fdc.readTracks(readAhead=readAhead)])
+            self.assertEqual(image, self.disk.image())
+
+    def test_read_ahead_bounded(self):
+        tracks = self.fdc.readTracks(readAhead=2)
+        self.assertEqual(tracks.next()[:3], (0, 0, FRC_OK))
+        # the one handed over, two in the queue and one waiting to go in
+        self.assertEqual(self.waitForReads(4), 4)
+        self.assertEqual([t[:2] for t in tracks], [(cyl, head) for cyl in range(0, 40) for head in range(0, 2)][1:])
+
+    def test_close_stops_reader(self):
+        tracks = self.fdc.readTracks([(5, 0), (5, 1), (6, 0), (6, 1), (7, 0), (7, 1)], readAhead=1)
+        tracks.next()
+        # close() waits for the reader thread to finish
+        tracks.close()
+        count = len(self.read)
+        self.assertTrue(count <= 3)
+        self.assertEqual(self.fdc.read(9, 1, 1), FRC_OK)
+        time.sleep(0.2)
+        self.assertEqual(len(self.read), count)
+
+    def test_bad_track_status(self):
+        self.disk.badSectors[(2, 1, 6)] = "crc"
+        statuses = dict([((cyl, head), status) for (cyl, head, status, data) in self.fdc.readTracks([(2, 0), (2, 1), (3, 0)])])
+        self.assertEqual(statuses, {(2, 0): FRC_OK, (2, 1): FRC_DATAERR, (3, 0): FRC_OK})
+
+    def test_reader_exception_raised(self):
+        def failing(cyl, head, retries=0):
+            raise FDCException(FRC_SHORT)
+        self.fdc.readTrack = failing
+        self.assertRaises(FDCException, list, self.fdc.readTracks())
+
+
+class MotorTest(unittest.TestCase):
+    def setUp(self):
+        self.fdc = emulatedFDC([patternDisk("360")], motorIdleTime=0.3)
+        # every timer, so that tearDown can wait for them to finish
+        self.timers = []
+        arm = self.fdc.motor._arm
+        def recording(delay):
+            arm(delay)
+            self.timers.append(self.fdc.motor.timer)
+        self.fdc.motor._arm = recording
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        for timer in self.timers:
+            timer.join()
+
+    def test_idle_timeout(self):
+        self.assertEqual(self.fdc.read(3, 0, 1), FRC_OK)
+        self.assertTrue(self.fdc.motorIsOn())
+        # done() leaves it running for the next burst of work
+        self.fdc.done()
+        self.assertTrue(self.fdc.motorIsOn())
+        time.sleep(0.6)
+        self.assertFalse(self.fdc.anyMotorOn())
+        self.assertEqual(self.fdc.motor.timer, None)
+
+    def test_activity_keeps_motor_on(self):
+        for i in range(0, 5):
+            self.assertEqual(self.fdc.read(3, 0, 1 + i), FRC_OK)
+            time.sleep(0.15)
+        self.assertTrue(self.fdc.motorIsOn())
+        time.sleep(0.6)
+        self.assertFalse(self.fdc.anyMotorOn())
+
+    def test_done_now(self):
+        self.assertEqual(self.fdc.read(3, 0, 1), FRC_OK)
+        self.fdc.done(now=True)
+        self.assertFalse(self.fdc.anyMotorOn())
+        self.assertEqual(self.fdc.motor.timer, None)
+
+    def test_shutdown_at_exit(self):
+        self.assertEqual(self.fdc.read(3, 0, 1), FRC_OK)
+        smbpi.fdc._shutdownMotors()
+        self.assertFalse(self.fdc.anyMotorOn())
+        self.assertEqual(self.fdc.motor.timer, None)
+
+    def test_managers_not_kept_alive(self):
+        fdc = emulatedFDC([patternDisk("360")])
+        manager = weakref.ref(fdc.motor)
+        self.assertTrue(manager() in smbpi.fdc._motorManagers)
+        del fdc
+        gc.collect()
+        self.assertEqual(manager(), None)
+
+
+class RawTrackTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = patternDisk("360", interleave=2)
+        self.fdc = emulatedFDC([self.disk])
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def test_physical_order(self):
+        self.assertEqual(self.fdc.readRawTrack(4, 1), FRC_OK)
+        # 9 sectors a revolution at 300 rpm
+        self.assertTrue(abs(self.fdc.rotationTime - 200000) < 1000)
+
+        sectors = self.disk.tracks[(4, 1)]
+        self.assertEqual([r for (c, h, r, n, offset, data) in self.fdc.rawTrack], [s.r for s in sectors])
+        self.assertEqual([r for (c, h, r, n, offset, data) in self.fdc.rawTrack], [1, 6, 2, 7, 3, 8, 4, 9, 5])
+        for (i, (c, h, r, n, offset, data)) in enumerate(self.fdc.rawTrack):
+            self.assertEqual((c, h, n), (4, 1, 2))
+            self.assertEqual(str(data), sectorPattern(4, 1, r, 512))
+            self.assertTrue(abs(offset - i * 200000 // 9) < 1000)
+
+    def test_odd_ids(self):
+        # IDs are reported as they are on the disk
+        self.disk.tracks[(6, 0)][3].c = 17
+        self.assertEqual(self.fdc.readRawTrack(6, 0), FRC_OK)
+        self.assertEqual(self.fdc.rawTrack[3][:4], (17, 0, 7, 2))
+
+    def test_bad_sector(self):
+        self.disk.badSectors[(5, 0, 2)] = "crc"
+        self.assertEqual(self.fdc.readRawTrack(5, 0), FRC_DATAERR)
+        self.assertEqual(len(self.fdc.rawTrack), 9)
+        self.assertEqual(self.fdc.rawTrack[2][:4], (5, 0, 2, 2))
+
+
+class DetectMediaTest(unittest.TestCase):
+    def detect(self, disk, media="360"):
+        self.fdc = emulatedFDC([disk], media=media, traceSize=4096)
+        return self.fdc.detectMedia()
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+
+    def test_media(self):
+        for media in ["144", "120", "111", "720", "360", "9836"]:
+            for start in ["360", "144"]:
+                disk = patternDisk(media)
+                self.assertEqual(self.detect(disk, start), media)
+                self.assertEqual(self.fdc.mediaName, media)
+                self.fdc.done(now=True)
+
+    def test_kept_until_disk_change(self):
+        self.assertEqual(self.detect(patternDisk("720")), "720")
+        self.fdc.setMedia("144")
+        self.fdc.trace.reset()
+        self.assertEqual(self.fdc.detectMedia(), "720")
+        self.assertEqual(self.fdc.mediaName, "720")
+        self.assertEqual(len(self.fdc.trace.entries), 0)
+
+        self.fdc._diskChanged(0)
+        self.assertEqual(self.fdc.detectMedia(), "720")
+        self.assertTrue(len(self.fdc.trace.entries) > 0)
+
+    def test_unknown_format(self):
+        # 250 kbps, 10 sectors
+        disk = patternDisk("720")
+        for ((cyl, head), sectors) in disk.tracks.items():
+            disk.formatTrack(cyl, head, [(cyl, head, r, 2) for r in range(1, 11)], 0xE5)
+        with self.assertRaises(FDCException) as cm:
+            self.detect(disk, "144")
+        self.assertEqual(cm.exception.fstRC, FRC_ERROR)
+        self.assertEqual(self.fdc.mediaName, "144")
+
+    def test_blank(self):
+        with self.assertRaises(FDCException) as cm:
+            self.detect(patternDisk("144", formatted=False))
+        self.assertEqual(cm.exception.fstRC, FRC_MISADR)
+        self.assertEqual(self.fdc.mediaName, "360")
+
+
+class CalibrateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "profile.json")
+        self.fdc = None
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def calibrated(self, minStepTime, margin):
+        if self.fdc is not None:
+            self.fdc.done(now=True)
+        self.fdc = emulatedFDC([patternDisk("144")], media="144", minStepTime=minStepTime, traceSize=4096)
+        return self.fdc.calibrate(trials=1, margin=margin, fileName=self.fileName)
+
+    def specified(self):
+        return [(ord(fcp[1]), ord(fcp[2])) for (fcp, fstRC, frb, elapsed) in self.fdc.trace.entries
+                if (ord(fcp[0]) & 0x1F) == CFD_SPECIFY]
+
+    def test_step_rate(self):
+        # 1.44M default is SRT 13, 3ms; the drive keeps up with 1ms, 2ms
+        for (minStepTime, margin, srt) in [(1000, 0, 15), (1000, 1, 14), (2000, 0, 14), (2000, 1, 13), (3000, 0, 13)]:
+            entry = self.calibrated(minStepTime, margin)
+            self.assertEqual(entry["stepRate"] >> 4, srt)
+            self.assertEqual(entry["headLoadTimeNonDma"], (8 << 1) | 1)
+            self.assertTrue(abs(entry["rotationTime"] - 200000) < 1000)
+            # give or take some rotational latency
+            self.assertTrue(abs(entry["stepTime"] - (16 - srt) * 1000) < 200 * (16 - srt))
+            self.assertTrue(entry["settleTime"] >= 15000)
+
+    def test_profile_used_by_specify(self):
+        entry = self.calibrated(1000, 1)
+        # only for the media it was calibrated on
+        for (media, timing) in [("720", ((13 << 4), (4 << 1) | 1)), ("144", (entry["stepRate"], entry["headLoadTimeNonDma"]))]:
+            self.fdc.setMedia(media)
+            self.fdc.trace.reset()
+            # the disk is 1.44M, so the read at 720K fails, but not before the SPECIFY
+            self.fdc.read(40, 0, 1)
+            self.assertEqual(self.specified(), [timing])
+        self.assertEqual(self.fdc.fstRC, FRC_OK)
+
+    def test_save_and_load(self):
+        entry = self.calibrated(1000, 1)
+        self.assertEqual(json.load(open(self.fileName)), {"ds": 0, "media": {"144": json.loads(json.dumps(entry))}})
+
+        self.fdc.done(now=True)
+        self.fdc = emulatedFDC([patternDisk("144")], media="144")
+        self.fdc.loadProfile(self.fileName)
+        self.assertEqual(self.fdc._timing(), (entry["stepRate"], entry["headLoadTimeNonDma"]))
+        self.assertEqual(self.fdc.drives[1].profile, {})
+
+
+class FopTraceTest(unittest.TestCase):
+    def test_ring_and_report(self):
+        trace = smbpi.fdc.FopTrace(4)
+        for i in range(0, 10):
+            trace.record("\x08", FRC_OK, "\x80\x00", i * 100)
+        trace.record("\x46\x00\x03\x00\x01\x02\x09\x2A\xFF", FRC_DATAERR, "\x40\x20\x20\x03\x00\x01\x02", 200000)
+        self.assertEqual([elapsed for (fcp, fstRC, frb, elapsed) in trace.entries], [700, 800, 900, 200000])
+
+        # the report counts everything, not just what's left in the ring
+        report = trace.report()
+        self.assertEqual(sorted(report.keys()), ["READ", "SENSEINT"])
+        self.assertEqual(report["SENSEINT"]["count"], 10)
+        self.assertEqual(report["SENSEINT"]["micros"], 4500)
+        self.assertEqual(report["SENSEINT"]["meanMicros"], 450)
+        self.assertEqual(report["SENSEINT"]["histogram"], {1: 1, 128: 1, 256: 1, 512: 3, 1024: 4})
+        self.assertEqual(report["READ"]["histogram"], {262144: 1})
+
+        f = StringIO.StringIO()
+        trace.dump(f)
+        self.assertEqual(f.getvalue().splitlines()[-1],
+                         "FOP <READ> 46 00 03 00 01 02 09 2A FF -> [result 0C] 40 20 20 03 00 01 02 (200000 us)")
+
+        trace.reset()
+        self.assertEqual((len(trace.entries), trace.report()), (0, {}))
+
+    def test_fdc_records(self):
+        fdc = emulatedFDC([patternDisk("360")])
+        try:
+            self.assertEqual(fdc.read(3, 1, 4), FRC_OK)
+            (fcp, fstRC, frb, elapsed) = fdc.trace.entries[-1]
+            self.assertEqual((ord(fcp[0]) & 0x1F, [ord(x) for x in fcp[1:6]], fstRC, [ord(x) for x in frb[3:7]]),
+                             (CFD_READ, [0x04, 3, 1, 4, 2], FRC_OK, [3, 1, 5, 2]))
+            # at most a revolution to come round to the sector, then the sector itself
+            self.assertTrue(0 < elapsed < 200000 + 200000 // 9)
+        finally:
+            fdc.done(now=True)
+
+    def test_off(self):
+        fdc = emulatedFDC([patternDisk("360")], traceSize=0)
+        try:
+            self.assertEqual(fdc.trace, None)
+            self.assertEqual(fdc.read(3, 1, 4), FRC_OK)
+        finally:
+            fdc.done(now=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# Tests for archival imaging against the emulated controller
+# Scott Baker, https://www.smbaker.com/
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from smbpi.fdc import FRC_DATAERR
+from smbpi.fdc_archive import ArchiveException, archiveDisk, extractArchive, loadArchive
+from emulated import emulatedFDC, patternDisk
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.dir, "disk.fda")
+        self.image = os.path.join(self.dir, "disk.img")
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk])
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        stats = archiveDisk(self.fdc, self.archive, workers=2)
+        self.assertEqual(stats["sha256"], hashlib.sha256(self.disk.image()).hexdigest())
+        self.assertEqual(stats["bad"], [])
+        self.assertTrue(stats["packedBytes"] < stats["rawBytes"])
+
+        trailer = extractArchive(self.archive, self.image)
+        self.assertEqual(trailer["sha256"], stats["sha256"])
+        self.assertEqual(open(self.image, "rb").read(), self.disk.image())
+
+    def test_bad_sector(self):
+        self.disk.badSectors[(5, 1, 4)] = "crc"
+        stats = archiveDisk(self.fdc, self.archive, retries=0, workers=2)
+        self.assertEqual(stats["bad"], [[5, 1, 4, FRC_DATAERR]])
+
+        (header, tracks, trailer) = loadArchive(self.archive)
+        (statuses, data) = tracks[(5, 1)]
+        self.assertEqual(statuses, [0, 0, 0, FRC_DATAERR, 0, 0, 0, 0, 0])
+        self.assertEqual(data[3 * 512:4 * 512], "\0" * 512)
+        self.assertEqual(trailer["bad"], stats["bad"])
+
+    def test_damaged(self):
+        archiveDisk(self.fdc, self.archive, workers=2)
+        data = bytearray(open(self.archive, "rb").read())
+
+        # a flipped byte in the middle of the compressed tracks
+        damaged = bytearray(data)
+        damaged[len(data) // 2] ^= 0xFF
+        open(self.archive, "wb").write(damaged)
+        self.assertRaises(ArchiveException, loadArchive, self.archive)
+
+        open(self.archive, "wb").write(data[:len(data) - 100])
+        self.assertRaises(ArchiveException, loadArchive, self.archive)
+
+
+if __name__ == "__main__":
+    unittest.main()
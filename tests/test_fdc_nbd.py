@@ -0,0 +1,186 @@
+# Tests for the NBD server, with a scripted client, against the emulated controller
+# Scott Baker, https://www.smbaker.com/
+
+import errno
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from smbpi.fdc_nbd import NBDException, NBDServer, WriteBackCache, listen, \
+     NBD_CMD_DISC, NBD_CMD_FLUSH, NBD_CMD_READ, NBD_CMD_WRITE, NBD_FLAG_READ_ONLY, \
+     NBD_FLAG_SEND_FLUSH, NBD_OPT_EXPORT_NAME, NBD_OPT_GO, NBD_OPTS_MAGIC, \
+     NBD_REP_ACK, NBD_REP_INFO, NBD_REPLY_MAGIC, NBD_REQUEST_MAGIC
+from emulated import emulatedFDC, patternDisk
+
+DISK_SIZE = 40 * 2 * 9 * 512
+TRACK_SIZE = 9 * 512
+
+class NBDClient:
+    # Just enough of an NBD client to drive the server
+    def __init__(self, socketName, go=True):
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.connect(socketName)
+        self.handle = 0
+
+        greeting = self.recv(18)
+        assert greeting[:8] == "NBDMAGIC"
+        if go:
+            # fixed newstyle, no zeroes, then NBD_OPT_GO with an empty name and no info requests
+            self.conn.sendall(struct.pack(">I", 3))
+            self.conn.sendall(struct.pack(">QII", NBD_OPTS_MAGIC, NBD_OPT_GO, 6) + struct.pack(">IH", 0, 0))
+            while True:
+                (magic, option, reply, length) = struct.unpack(">QIII", self.recv(20))
+                data = self.recv(length)
+                if reply == NBD_REP_INFO:
+                    (info, self.size, self.flags) = struct.unpack(">HQH", data)
+                elif reply == NBD_REP_ACK:
+                    break
+        else:
+            # fixed newstyle with the zero padding, and the old NBD_OPT_EXPORT_NAME
+            self.conn.sendall(struct.pack(">I", 1))
+            self.conn.sendall(struct.pack(">QII", NBD_OPTS_MAGIC, NBD_OPT_EXPORT_NAME, 0))
+            (self.size, self.flags) = struct.unpack(">QH", self.recv(10))
+            self.recv(124)
+
+    def recv(self, count):
+        data = ""
+        while len(data) < count:
+            part = self.conn.recv(count - len(data))
+            assert part, "server closed the connection"
+            data += part
+        return data
+
+    def request(self, cmd, offset=0, length=0, data=""):
+        # returns (error, data)
+        self.handle += 1
+        self.conn.sendall(struct.pack(">IHHQQI", NBD_REQUEST_MAGIC, 0, cmd, self.handle, offset, length) + data)
+        (magic, error, handle) = struct.unpack(">IIQ", self.recv(16))
+        assert (magic, handle) == (NBD_REPLY_MAGIC, self.handle)
+        if (cmd == NBD_CMD_READ) and (error == 0):
+            return (error, self.recv(length))
+        return (error, "")
+
+    def read(self, offset, length):
+        return self.request(NBD_CMD_READ, offset, length)
+
+    def write(self, offset, data):
+        return self.request(NBD_CMD_WRITE, offset, len(data), data)[0]
+
+    def flush(self):
+        return self.request(NBD_CMD_FLUSH)[0]
+
+    def disconnect(self):
+        self.conn.sendall(struct.pack(">IHHQQI", NBD_REQUEST_MAGIC, 0, NBD_CMD_DISC, 0, 0, 0))
+        self.conn.close()
+
+
+class NBDServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socketName = os.path.join(self.dir, "nbd.sock")
+        self.disk = patternDisk("360")
+        self.fdc = emulatedFDC([self.disk])
+
+    def tearDown(self):
+        self.fdc.done(now=True)
+        shutil.rmtree(self.dir)
+
+    def serve(self, **kwargs):
+        # the server waits in accept() until the process exits, like it would for real
+        self.server = NBDServer(self.fdc, **kwargs)
+        thread = threading.Thread(target=self.server.serve, args=(listen(self.socketName),))
+        thread.daemon = True
+        thread.start()
+
+    def test_handshake(self):
+        self.serve()
+        for go in [True, False]:
+            client = NBDClient(self.socketName, go)
+            self.assertEqual(client.size, DISK_SIZE)
+            self.assertTrue(client.flags & NBD_FLAG_SEND_FLUSH)
+            self.assertFalse(client.flags & NBD_FLAG_READ_ONLY)
+            self.assertEqual(client.read(0, 1024), (0, self.disk.image()[:1024]))
+            client.disconnect()
+
+    def test_read(self):
+        self.serve()
+        client = NBDClient(self.socketName)
+        self.assertEqual(client.read(0, DISK_SIZE), (0, self.disk.image()))
+        # a second pass comes out of the cache as far as it holds
+        hits = self.server.cache.hits
+        self.assertEqual(client.read(DISK_SIZE - 5000, 5000), (0, self.disk.image()[-5000:]))
+        self.assertTrue(self.server.cache.hits > hits)
+        client.disconnect()
+
+    def test_write_back_and_flush(self):
+        self.serve(cacheTracks=4)
+        client = NBDClient(self.socketName)
+        expected = bytearray(self.disk.image())
+        r = random.Random(2)
+
+        # a few writes to a few tracks stay in the cache
+        for offset in [100, TRACK_SIZE + 700, 3 * TRACK_SIZE - 10]:
+            data = "".join([chr(r.randrange(0, 256)) for i in range(0, 600)])
+            self.assertEqual(client.write(offset, data), 0)
+            expected[offset:offset + len(data)] = data
+        self.assertEqual(self.server.cache.trackWrites, 0)
+        self.assertNotEqual(self.disk.image(), str(expected))
+        self.assertEqual(client.read(0, 4 * TRACK_SIZE), (0, str(expected[:4 * TRACK_SIZE])))
+
+        # writes all over push dirty tracks out of the cache
+        for i in range(0, 30):
+            offset = r.randrange(0, DISK_SIZE - 3000)
+            data = "".join([chr(r.randrange(0, 256)) for i in range(0, r.randrange(1, 3000))])
+            self.assertEqual(client.write(offset, data), 0)
+            expected[offset:offset + len(data)] = data
+        self.assertTrue(self.server.cache.trackWrites > 0)
+
+        self.assertEqual(client.flush(), 0)
+        self.assertEqual(self.server.cache.dirty, set())
+        self.assertEqual(self.disk.image(), str(expected))
+        self.assertEqual(client.read(0, DISK_SIZE), (0, str(expected)))
+        client.disconnect()
+
+    def test_whole_track_write_not_read_first(self):
+        self.serve()
+        client = NBDClient(self.socketName)
+        self.assertEqual(client.write(2 * TRACK_SIZE, "x" * (2 * TRACK_SIZE)), 0)
+        self.assertEqual(self.server.cache.trackReads, 0)
+        self.assertEqual(client.flush(), 0)
+        self.assertEqual(self.disk.image()[2 * TRACK_SIZE:4 * TRACK_SIZE], "x" * (2 * TRACK_SIZE))
+        client.disconnect()
+
+    def test_errors(self):
+        self.serve()
+        client = NBDClient(self.socketName)
+        self.assertEqual(client.read(DISK_SIZE - 10, 20)[0], errno.EINVAL)
+        self.assertEqual(client.write(DISK_SIZE - 10, "x" * 20), errno.ENOSPC)
+        # still in step after the refused write's payload
+        self.assertEqual(client.read(0, 512), (0, self.disk.image()[:512]))
+        client.disconnect()
+
+    def test_read_only(self):
+        self.serve(readOnly=True)
+        client = NBDClient(self.socketName)
+        self.assertTrue(client.flags & NBD_FLAG_READ_ONLY)
+        self.assertEqual(client.write(0, "x" * 512), errno.EPERM)
+        self.assertEqual(client.read(0, 512), (0, self.disk.image()[:512]))
+        client.disconnect()
+
+    def test_cache_capacity(self):
+        self.assertRaises(NBDException, WriteBackCache, self.fdc, 0)
+        cache = WriteBackCache(self.fdc, 1)
+        cache.write(0, "y" * 512)
+        cache.write(TRACK_SIZE, "z" * 512)
+        cache.flush()
+        self.assertEqual(self.disk.image()[:512], "y" * 512)
+        self.assertEqual(self.disk.image()[TRACK_SIZE:TRACK_SIZE + 512], "z" * 512)
+
+
+if __name__ == "__main__":
+    unittest.main()